@@ -34,6 +34,12 @@ amazon_s3_prefix = 's3://mms_backups/'
 # max raw file size for a single tar file, currently 4GB
 max_tar_size = 4 * 1024 * 1024 * 1024
 
+# tarballs waiting to be uploaded (and uploaded tarballs waiting to be inventoried)
+tarball_queue_depth = 1
+
+# max bytes of built tarballs in tarball_directory that haven't been cleaned up
+max_tarball_bytes_in_flight = 3 * max_tar_size
+
 # set to True to gzip the tarballs
 use_gzip = True
 
@@ -44,3 +50,28 @@ use_upload = True
 # set to True to delete tarballs after successful upload
 # otherwise, they are moved to uploaded_tarball_directory
 delete_tarball = True
+
+# size of each part of a multipart Glacier upload, 1MB times a power of 2
+# (raised automatically if a tarball would need more than 10,000 parts)
+glacier_part_size = 64 * 1024 * 1024
+
+# number of parts uploaded at once
+glacier_upload_threads = 4
+
+# number of times an upload (or a single part) is retried
+glacier_upload_retries = 3
+
+# set to True to hash files whose modification time changed but whose size
+# didn't, and archive them again only if their md5 hash changed
+use_content_hash = False
+
+# number of files hashed at once, and the size of the chunks they are read in
+content_hash_threads = 4
+content_hash_chunk_size = 1024 * 1024
+
+# number of touched files hashed before the walk for new or changed files goes on
+content_hash_batch_size = 1000
+
+# number of rows inserted at once when a tarball's files are added to the inventory
+# (kept under sqlite's limit of 999 variables per statement)
+inventory_insert_batch_size = 150
@@ -0,0 +1,201 @@
+'''Multipart, parallel and resumable uploads of tarballs to Glacier.
+
+A tarball is uploaded in parts of config.glacier_part_size bytes on
+config.glacier_upload_threads threads.  The SHA256 tree hash of each part is
+computed as the part is read, and the archive tree hash is built from the part
+hashes (parts are 1MB times a power of 2 so they align with the tree).  The
+upload id and the hash of every part Glacier has received are kept in the
+local inventory database, so an interrupted upload resumes with the parts
+that are missing.
+'''
+import os
+import hashlib
+import logging
+import datetime
+import binascii
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex, minimum_part_size
+from boto.glacier.exceptions import UnexpectedHTTPResponseError
+
+from . import config
+from . import models
+from .models import GlacierUpload, GlacierUploadPart
+
+logger = logging.getLogger('aws_archiving.glacier_upload')
+logger.setLevel(logging.INFO)
+
+
+def part_hashes(data):
+    '''Returns the (linear hash, tree hash) hex digests of a part.'''
+    return hashlib.sha256(data).hexdigest(), tree_hash_hex(tree_hash(chunk_hashes(data)))
+
+
+def archive_tree_hash(part_tree_hashes):
+    '''Returns the tree hash hex digest of an archive from the tree hashes of its parts, in order.'''
+    return tree_hash_hex(tree_hash([binascii.unhexlify(h) for h in part_tree_hashes]))
+
+
+def tree_hash_hex(digest):
+    '''Returns the hex digest as a str, the way Glacier lists part hashes (boto's bytes_to_hex
+    returns bytes on Python 3, which never compare equal to them).'''
+    return bytes_to_hex(digest).decode('ascii')
+
+
+def get_part_size(file_size, part_size=None):
+    '''Returns the part size used to upload a file of file_size bytes.'''
+    return minimum_part_size(file_size, part_size or config.glacier_part_size)
+
+
+class MultipartUploader(object):
+    '''Uploads files to a Glacier vault with resumable multipart uploads.'''
+
+    def __init__(self, vault, glacier_vault, part_size=None, threads=None, retries=None):
+        '''
+        Arguments
+            vault - the boto Glacier vault
+            glacier_vault - the GlacierVault of the vault in the local inventory
+            part_size - optional part size, defaults to config.glacier_part_size
+            threads - optional number of parts uploaded at once, defaults to config.glacier_upload_threads
+            retries - optional number of times a part is retried, defaults to config.glacier_upload_retries
+        '''
+        self.vault = vault
+        self.glacier_vault = glacier_vault
+        self.part_size = part_size or config.glacier_part_size
+        self.threads = threads or config.glacier_upload_threads
+        self.retries = retries if retries is not None else config.glacier_upload_retries
+        models.create_upload_tables()
+
+    def get_upload(self, file_path, file_size, modification_time, part_size, description):
+        '''Returns the GlacierUpload of the file, resuming an earlier upload of the
+        same file if there is one and starting a new upload otherwise.'''
+        for upload in GlacierUpload.select().where(GlacierUpload.glacier_vault == self.glacier_vault,
+                                                   GlacierUpload.file_path == file_path):
+            if upload.file_size == file_size and upload.modification_time == modification_time and \
+                    upload.part_size == part_size and self.reconcile_parts(upload):
+                logger.info('Resuming upload %s of %s with %d parts uploaded',
+                            upload.upload_id, file_path, upload.parts.count())
+                return upload
+            self.discard_upload(upload)
+
+        response = self.vault.layer1.initiate_multipart_upload(self.vault.name, part_size, description)
+        logger.info('Started upload %s of %s', response['UploadId'], file_path)
+        return GlacierUpload.create(glacier_vault=self.glacier_vault,
+                                    file_path=file_path,
+                                    file_size=file_size,
+                                    modification_time=modification_time,
+                                    part_size=part_size,
+                                    upload_id=response['UploadId'],
+                                    when_started=datetime.datetime.utcnow())
+
+    def reconcile_parts(self, upload):
+        '''Brings the recorded parts in line with the parts Glacier has received.  Returns
+        False if Glacier no longer knows the upload (uploads expire after a period of inactivity).'''
+        received = {}
+        marker = None
+        try:
+            while True:
+                response = self.vault.layer1.list_parts(self.vault.name, upload.upload_id, marker=marker)
+                for part in response['Parts']:
+                    start = int(part['RangeInBytes'].split('-')[0])
+                    received[start // upload.part_size] = part['SHA256TreeHash']
+                marker = response.get('Marker')
+                if not marker:
+                    break
+        except UnexpectedHTTPResponseError as e:
+            if e.status == 404:
+                return False
+            raise
+        with models.db.transaction():
+            for part in upload.parts:
+                received_tree_hash = received.pop(part.part_index, None)
+                if received_tree_hash is None:
+                    part.delete_instance()
+                elif received_tree_hash != part.tree_hash:
+                    # the part was uploaded again after it was recorded, Glacier's copy counts
+                    part.tree_hash = received_tree_hash
+                    part.save()
+            # parts received after the last one recorded before the interruption
+            for part_index, part_tree_hash in received.items():
+                GlacierUploadPart.create(glacier_upload=upload, part_index=part_index, tree_hash=part_tree_hash)
+        return True
+
+    def discard_upload(self, upload):
+        '''Aborts an upload that can't be resumed and forgets it.'''
+        logger.info('Discarding upload %s of %s', upload.upload_id, upload.file_path)
+        try:
+            self.vault.layer1.abort_multipart_upload(self.vault.name, upload.upload_id)
+        except UnexpectedHTTPResponseError as e:
+            if e.status != 404:
+                logger.warn('Unable to abort upload %s: %s', upload.upload_id, e)
+        with models.db.transaction():
+            GlacierUploadPart.delete().where(GlacierUploadPart.glacier_upload == upload).execute()
+            upload.delete_instance()
+
+    def upload_part(self, file_path, upload_id, part_index, part_size):
+        '''Reads, hashes and uploads one part.  Returns the (part index, tree hash).'''
+        start = part_index * part_size
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            data = f.read(part_size)
+        linear_hash, part_tree_hash = part_hashes(data)
+        byte_range = (start, start + len(data) - 1)
+        retries = 0
+        while True:
+            try:
+                self.vault.layer1.upload_part(self.vault.name, upload_id, linear_hash, part_tree_hash, byte_range, data)
+                return part_index, part_tree_hash
+            except Exception:
+                if retries >= self.retries:
+                    raise
+                retries += 1
+                logger.warn('Retrying part %d of %s', part_index, file_path)
+
+    def upload(self, file_path, description=None):
+        '''Uploads a file, resuming an earlier interrupted upload of it.
+
+        Returns the archive id created at Glacier.
+
+        Arguments
+            file_path - full absolute path to the file
+            description - optional archive description, defaults to file_path
+        '''
+        file_size = os.path.getsize(file_path)
+        modification_time = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
+        part_size = get_part_size(file_size, self.part_size)
+        upload = self.get_upload(file_path, file_size, modification_time, part_size, description or file_path)
+
+        part_count = max(1, (file_size + part_size - 1) // part_size)
+        tree_hashes = dict((part.part_index, part.tree_hash) for part in upload.parts)
+        pending = [i for i in range(part_count) if i not in tree_hashes]
+        error = None
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = [executor.submit(self.upload_part, file_path, upload.upload_id, i, part_size) for i in pending]
+            # parts are recorded as they complete so an interrupted upload resumes from them
+            for future in as_completed(futures):
+                try:
+                    part_index, part_tree_hash = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                GlacierUploadPart.create(glacier_upload=upload, part_index=part_index, tree_hash=part_tree_hash)
+                tree_hashes[part_index] = part_tree_hash
+        if error is not None:
+            raise error
+
+        response = self.vault.layer1.complete_multipart_upload(self.vault.name, upload.upload_id,
+                                                               archive_tree_hash(tree_hashes[i] for i in range(part_count)),
+                                                               file_size)
+        with models.db.transaction():
+            GlacierUploadPart.delete().where(GlacierUploadPart.glacier_upload == upload).execute()
+            upload.delete_instance()
+        logger.info('Completed upload of %s in %d parts (%d resumed)', file_path, part_count, part_count - len(pending))
+        return response['ArchiveId']
+
+
+def get_pending_uploads(glacier_vault):
+    '''Returns the paths of the files whose upload to the vault was interrupted and can be resumed.'''
+    models.create_upload_tables()
+    return [upload.file_path for upload in
+            GlacierUpload.select().where(GlacierUpload.glacier_vault == glacier_vault).order_by(GlacierUpload.when_started)
+            if os.path.isfile(upload.file_path)]
@@ -7,7 +7,8 @@ from peewee import Model, SqliteDatabase
 from peewee import TextField, ForeignKeyField, DateTimeField, IntegerField
 
 
-db = SqliteDatabase(config.db_uri)
+# write-ahead logging, so inventory inserts don't block readers
+db = SqliteDatabase(config.db_uri, pragmas=[('journal_mode', 'wal')])
 
 
 class BaseModel(Model):
@@ -57,6 +58,9 @@ class GlacierArchiveFile(BaseModel):
 
     class Meta:
         db_table = "glacier_archive_files"
+        indexes = (
+            (('file_path',), False),
+        )
 
     glacier_archive = ForeignKeyField(GlacierArchive, related_name='files')
     file_path = TextField()
@@ -71,6 +75,26 @@ class GlacierArchiveFile(BaseModel):
     __repr__ = __str__
 
 
+class LatestGlacierArchiveFile(BaseModel):
+    '''Latest archived version of each file in each vault (a view, see create_inventory_views)'''
+
+    class Meta:
+        db_table = "latest_glacier_archive_files"
+
+    glacier_vault = ForeignKeyField(GlacierVault, related_name='latest_files')
+    file_path = TextField()
+    file_size = IntegerField()
+    md5_hash = TextField()
+    modification_time = DateTimeField()
+    when_archived = DateTimeField()
+
+    def __str__(self):
+        '''Returns a string representation of this object.'''
+        return '%s %d %s' % (self.file_path, self.file_size, self.modification_time)
+
+    __repr__ = __str__
+
+
 class ErrorLog(BaseModel):
     '''Error log.'''
 
@@ -85,3 +109,60 @@ class ErrorLog(BaseModel):
         return "%s: %s" % (self.when_logged, self.error_message)
 
     __repr__ = __str__
+
+
+class GlacierUpload(BaseModel):
+    '''Multipart upload of a tarball that hasn't completed'''
+
+    class Meta:
+        db_table = "glacier_uploads"
+
+    glacier_vault = ForeignKeyField(GlacierVault, related_name='uploads')
+    file_path = TextField()
+    file_size = IntegerField()
+    modification_time = DateTimeField()
+    part_size = IntegerField()
+    upload_id = TextField()
+    when_started = DateTimeField()
+
+    def __str__(self):
+        '''Returns a string representation of this object.'''
+        return '%s %s %s' % (self.file_path, self.upload_id, self.when_started)
+
+    __repr__ = __str__
+
+
+class GlacierUploadPart(BaseModel):
+    '''Part of a multipart upload that Glacier has received'''
+
+    class Meta:
+        db_table = "glacier_upload_parts"
+
+    glacier_upload = ForeignKeyField(GlacierUpload, related_name='parts')
+    part_index = IntegerField()
+    tree_hash = TextField()
+
+    def __str__(self):
+        '''Returns a string representation of this object.'''
+        return '%s %d %s' % (self.glacier_upload.file_path, self.part_index, self.tree_hash)
+
+    __repr__ = __str__
+
+
+def create_upload_tables():
+    '''Creates the multipart upload tables if they don't exist yet.'''
+    db.create_tables([GlacierUpload, GlacierUploadPart], safe=True)
+
+
+def create_inventory_views():
+    '''Creates the file path index of glacier_archive_files and the latest_glacier_archive_files
+    view if they don't exist yet.  The view relies on SQLite taking the bare columns of
+    an aggregate query from the row holding the MAX.'''
+    db.execute_sql('CREATE INDEX IF NOT EXISTS glacier_archive_files_file_path '
+                   'ON glacier_archive_files (file_path)')
+    db.execute_sql('CREATE VIEW IF NOT EXISTS latest_glacier_archive_files AS '
+                   'SELECT f.id AS id, a.glacier_vault_id AS glacier_vault_id, f.file_path AS file_path, '
+                   'f.file_size AS file_size, f.md5_hash AS md5_hash, f.modification_time AS modification_time, '
+                   'MAX(a.when_archived) AS when_archived '
+                   'FROM glacier_archive_files f JOIN glacier_archives a ON a.id = f.glacier_archive_id '
+                   'GROUP BY a.glacier_vault_id, f.file_path')
@@ -10,6 +10,8 @@ import os
 import logging
 import boto
 import json
+import queue
+import threading
 from datetime import tzinfo, timedelta
 import smtplib
 import datetime
@@ -17,11 +19,13 @@ import hashlib
 import tarfile
 from optparse import OptionParser
 from subprocess import Popen, PIPE, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
 
 from .singleton import SingleInstance
 from . import models
 from . import config
-from .models import GlacierVault, GlacierArchive, GlacierArchiveFile, ErrorLog
+from .models import GlacierVault, GlacierArchive, GlacierArchiveFile, LatestGlacierArchiveFile, ErrorLog
+from .glacier_upload import MultipartUploader, get_pending_uploads
 
 
 # define log formatter
@@ -204,14 +208,59 @@ def get_dict_of_files_in_vault(aws_region, vault_name):
     ends up in the dict.
     '''
     vault = GlacierVault.get(GlacierVault.aws_region == aws_region, GlacierVault.vault_name == vault_name)
-    archives = [a for a in vault.archives.order_by(GlacierArchive.when_archived)]
-    d = {}
-    for archive in archives:
-        for file_ in archive.files:
-            d[file_.file_path] = {'file_size': file_.file_size,
-                                  'md5_hash': file_.md5_hash,
-                                  'modification_time': file_.modification_time}
-    return d
+    return dict((file_.file_path, {'file_size': file_.file_size,
+                                   'md5_hash': file_.md5_hash,
+                                   'modification_time': file_.modification_time})
+                for file_ in get_latest_archived_files(vault))
+
+
+def get_latest_archived_files(glacier_vault):
+    '''Returns an iterator over the latest archived version of each file in the
+    vault (LatestGlacierArchiveFile), ordered by file path.  Rows are streamed
+    from the database rather than loaded at once.
+    '''
+    models.create_inventory_views()
+    return (LatestGlacierArchiveFile.select()
+            .where(LatestGlacierArchiveFile.glacier_vault == glacier_vault)
+            .order_by(LatestGlacierArchiveFile.file_path)
+            .iterator())
+
+
+def walk_files(root_directory, excluded_directories=[]):
+    '''Walks the directory tree and yields a (path, stat) tuple for each file, ordered
+    by path.  Each file is stat'ed once.  Excluded directories and symbolic links to
+    directories are not descended into.  Errors are logged and the walk goes on.
+
+    Arguments
+        root_directory - top of the directory tree
+        excluded_directories - optional. Holds list of directories that are not walked.
+    '''
+    def sorted_entries(directory):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            log_error(e)
+            return iter([])
+        # a directory sorts as its name followed by a separator, so the
+        # files are yielded in the order of their full paths
+        return iter(sorted(entries, key=lambda entry: entry.name + os.sep if entry.is_dir() else entry.name))
+
+    if path_is_excluded(root_directory, excluded_directories):
+        return
+    stack = [sorted_entries(root_directory)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink() and not path_is_excluded(entry.path, excluded_directories):
+                    stack.append(sorted_entries(entry.path))
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+        except OSError as e:
+            log_error(e)
 
 
 def path_is_excluded(path, excluded_directories):
@@ -224,15 +273,15 @@ def path_is_excluded(path, excluded_directories):
     return False
 
 
-def add_file_to_dict(fn, result_dict):
-    '''Add filename fn to result_dict, using a named tuple containing file_size and modification_time.
+def add_file_to_dict(fn, st, result_dict):
+    '''Add filename fn to result_dict, using a dict containing the file_size and modification_time
+    from the file's stat st.
 
     Returns the file_size.
     '''
-    file_size = os.path.getsize(fn)
-    result_dict[fn] = {'file_size': file_size,
-                       'modification_time': datetime.datetime.fromtimestamp(os.path.getmtime(fn))}
-    return file_size
+    result_dict[fn] = {'file_size': st.st_size,
+                       'modification_time': datetime.datetime.fromtimestamp(st.st_mtime)}
+    return st.st_size
 
 
 def equal_datetimes(date_from_db, date_from_disk):
@@ -257,6 +306,13 @@ def get_dict_of_new_or_changed_files(root_directory, aws_region, vault_name, exc
     vault or have changed since they were last sent to the vault.
 
     Information about the inventory in Glacier is fetched from the database.
+    The files found by walk_files and the latest archived files are both
+    ordered by path, so they are compared by merging the two streams and
+    only the new or changed files are held in memory.
+
+    If config.use_content_hash is True, a file whose size is unchanged but whose
+    modification time changed is only archived again if its content changed
+    (see dedup_by_content_hash).
 
     Arguments
         root_directory - top of the directory tree that will be walked to
@@ -265,45 +321,69 @@ def get_dict_of_new_or_changed_files(root_directory, aws_region, vault_name, exc
         vault_name - name of the vault
         excluded_directories - optional. Holds list of directories that are to be excluded from the archive.
     '''
-    logger.info("Getting dict of files in database")
-    vault_dict = get_dict_of_files_in_vault(aws_region, vault_name)
-    logger.info("Got %d files from database" % len(vault_dict))
+    vault = GlacierVault.get(GlacierVault.aws_region == aws_region, GlacierVault.vault_name == vault_name)
     logger.info("Getting dict of files to archive now")
+    archived_files = get_latest_archived_files(vault)
+    archived = next(archived_files, None)
     result_dict = {}
     total_size = 0
-    for path, dirs, files in os.walk(root_directory, onerror=log_error, topdown=True, followlinks=False):
-
-        # Filter out excluded directories.
-        dirs[:] = [os.path.join(path, d) for d in dirs]
-        dirs[:] = [d for d in dirs if not path_is_excluded(d, excluded_directories)]
-
-        if not path_is_excluded(path, excluded_directories):
-            for f in files:
-                fn = os.path.join(path, f)
-                if os.path.isfile(fn):
-                    try:
-                        if not fn in vault_dict:
-                            total_size += add_file_to_dict(fn, result_dict)
-                        else:  # it has been sent to Glacier before
-                            v = vault_dict[fn]
-                            if v['file_size'] != os.path.getsize(fn):  # file size has changed
-                                total_size += add_file_to_dict(fn, result_dict)
-                            elif not equal_datetimes(v['modification_time'],
-                                                     datetime.datetime.fromtimestamp(os.path.getmtime(fn))):
-                                total_size += add_file_to_dict(fn, result_dict)
-#                             else:
-#                                 with open(fn) as f:
-#                                     md5_hash = hashlib.md5(f.read()).hexdigest()
-#                                 if v['md5_hash'] != md5_hash:
-#                                     total_size += add_file_to_dict(fn, result_dict)
-
-                    except Exception as e:
-                        log_error(e)
+    touched = []
+    for fn, st in walk_files(root_directory, excluded_directories):
+        while archived is not None and archived.file_path < fn:
+            archived = next(archived_files, None)
+        try:
+            if archived is None or archived.file_path != fn:
+                total_size += add_file_to_dict(fn, st, result_dict)
+            # it has been sent to Glacier before
+            elif archived.file_size != st.st_size:  # file size has changed
+                total_size += add_file_to_dict(fn, st, result_dict)
+            elif not equal_datetimes(archived.modification_time,
+                                     datetime.datetime.fromtimestamp(st.st_mtime)):
+                if config.use_content_hash and archived.md5_hash:
+                    touched.append((fn, st, archived.id, archived.md5_hash))
+                    if len(touched) >= config.content_hash_batch_size:
+                        total_size += dedup_by_content_hash(touched, result_dict)
+                        touched = []
+                else:
+                    total_size += add_file_to_dict(fn, st, result_dict)
+        except Exception as e:
+            log_error(e)
+    total_size += dedup_by_content_hash(touched, result_dict)
 
     logger.info("Got %d files of total size %d to archive" % (len(result_dict), total_size))
     return result_dict
 
 
+def dedup_by_content_hash(touched, result_dict):
+    '''Hashes files whose modification time changed but whose size didn't and adds the ones
+    whose content changed to result_dict, with their md5_hash.  For the files whose content
+    is unchanged the new modification time is stored in the inventory, so they aren't hashed
+    again on the next run.
+
+    Returns the total size of the files added to result_dict.
+
+    Arguments
+        touched - list of (path, stat, GlacierArchiveFile id, archived md5 hash) tuples
+        result_dict - dict of the files to archive, see add_file_to_dict
+    '''
+    total_size = 0
+    unchanged = []
+    md5_hashes = get_md5_hashes([fn for fn, _, _, _ in touched])
+    for (fn, st, archive_file_id, archived_md5_hash), md5_hash in zip(touched, md5_hashes):
+        if md5_hash == archived_md5_hash:
+            unchanged.append((archive_file_id, datetime.datetime.fromtimestamp(st.st_mtime)))
+        elif md5_hash is not None:
+            total_size += add_file_to_dict(fn, st, result_dict)
+            result_dict[fn]['md5_hash'] = md5_hash
+    with models.db.transaction():
+        for archive_file_id, modification_time in unchanged:
+            GlacierArchiveFile.update(modification_time=modification_time).where(
+                GlacierArchiveFile.id == archive_file_id).execute()
+    if touched:
+        logger.info("Hashed %d touched files, %d are unchanged", len(touched), len(unchanged))
+    return total_size
+
+
 def log_error(error):
     error_st = str(error)
     utc_now = datetime.datetime.utcnow()
@@ -335,13 +415,23 @@ def send_email(message):
     smtpObj.sendmail(sender, receivers, message)
 
 
+# format of the modification times in tarball manifests
+MANIFEST_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
 def build_tarball(file_dict):
     '''Returns the name of a tarball that holds the files in the 
     list of file paths, up to raw size config.max_tar_size.
 
+    The files are hashed while tar reads them and the archive is hashed as tar
+    writes it.  The hashes, sizes and modification times are written to the
+    tarball's manifest (see write_tarball_manifest) so neither the tarball nor its
+    files are read back by add_archive_to_inventory.
+
     Argument
         file_dict - dictionary of files: keys are absolute paths,
-            values are a named tuple including file_size.
+            values are a dict including file_size, modification_time
+            and optionally md5_hash.
     '''
     utcnow = datetime.datetime.utcnow()
     tarball_ext = 'tar.gz' if config.use_gzip else 'tar'
@@ -361,12 +451,17 @@ def build_tarball(file_dict):
     file_paths = sorted(file_dict.keys())
     raw_size = 0
     file_count = 0
+    members = []
 
     # note -C / allows using relative paths
     # to avoid: Removing leading `/' from member names
     # --ignore-failed-read avoids failing if file has disappeared since list was made
+    # the archive is written to stdout (-f -) so it can be hashed on its way to the tarball,
+    # the added files (-v) are listed in the index file under their actual names
     tar_opts = '-cvzf' if config.use_gzip else '-cvf'
-    initial_args = ['/bin/tar', '-C', '/', '--ignore-failed-read', tar_opts, tarball_path]
+    index_path = tarball_path + '.index'
+    initial_args = ['/bin/tar', '-C', '/', '--ignore-failed-read', '--quoting-style=literal',
+                    '--index-file=' + index_path, tar_opts, '-']
     args = list(initial_args)
     # max arg len from `getconf ARG_MAX`
     # divide by 2 to avoid error from pushing too close
@@ -381,15 +476,32 @@ def build_tarball(file_dict):
         file_size = file_dict[p]['file_size']
         raw_size += file_size
         file_count += 1
-        del file_dict[p]
+        members.append((p, file_dict.pop(p)))
         if raw_size > config.max_tar_size:
             if file_size > 100000000:
                 # log if the file is over 100MB
                 logger.info('Last file in tar has size %d and path %s:', file_size, p)
             break
 
-    p = Popen(args, stdout=PIPE, stderr=PIPE)
-    output, error = p.communicate()
+    unhashed = [fn for fn, info in members if not info.get('md5_hash')]
+    tarball_hasher = hashlib.md5()
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # hash the files while tar reads them, so they are read from the page cache
+            md5_future = executor.submit(get_md5_hashes, unhashed)
+            with Popen(args, stdout=PIPE, stderr=PIPE) as p:
+                error_future = executor.submit(p.stderr.read)
+                with open(tarball_path, 'wb') as f:
+                    for chunk in iter(lambda: p.stdout.read(config.content_hash_chunk_size), b''):
+                        tarball_hasher.update(chunk)
+                        f.write(chunk)
+                error = error_future.result()
+            md5_hashes = dict(zip(unhashed, md5_future.result()))
+        with open(index_path, 'rb') as f:
+            output = f.read()
+    finally:
+        if os.path.isfile(index_path):
+            os.remove(index_path)
     returncode = p.returncode
     if returncode > 1:
         # exit code 1 means 'Some files differ'
@@ -402,13 +514,65 @@ def build_tarball(file_dict):
     if output:
         logger.debug('Added files:\n%s', output)
 
+    # files that disappeared before tar read them are skipped by tar, leave them out
+    added = set(os.path.join('/', name) for name in os.fsdecode(output).splitlines())
+    write_tarball_manifest(tarball_path, tarball_hasher.hexdigest(), [(fn, info) for fn, info in members if fn in added], md5_hashes)
     logger.info("Created tarball %s with file_count %d, raw_size %d, tar_size %d" %
                 (tarball_path, file_count, raw_size, os.path.getsize(tarball_path)))
     return tarball_path
 
 
+def get_manifest_path(tarball_pathname):
+    '''Returns the path of the manifest written next to the tarball.'''
+    return tarball_pathname + '.manifest'
+
+
+def write_tarball_manifest(tarball_pathname, tarball_md5_hash, members, md5_hashes):
+    '''Writes the manifest of a tarball that was just built: a JSON header with the md5
+    hash of the tarball followed by one JSON line per file with its path, size,
+    modification time and md5 hash.  Files that couldn't be hashed are left out.
+
+    Arguments
+        tarball_pathname - full absolute path to the tarball
+        tarball_md5_hash - md5 hash of the tarball, computed while it was written
+        members - list of (path, file_dict entry) of the files tar added
+        md5_hashes - dict of md5 hashes computed for the files whose entry has none
+    '''
+    manifest_path = get_manifest_path(tarball_pathname)
+    with open(manifest_path + '.tmp', 'w') as f:
+        f.write(json.dumps({'md5_hash': tarball_md5_hash}) + '\n')
+        for fn, info in members:
+            md5_hash = info.get('md5_hash') or md5_hashes.get(fn)
+            if md5_hash is None:
+                continue
+            f.write(json.dumps([fn, info['file_size'],
+                                info['modification_time'].strftime(MANIFEST_TIME_FORMAT),
+                                md5_hash]) + '\n')
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def read_tarball_manifest(tarball_pathname):
+    '''Returns the (tarball md5 hash, list of inventory row dicts) of the manifest written
+    by write_tarball_manifest, or None if the tarball has no manifest.'''
+    manifest_path = get_manifest_path(tarball_pathname)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        header = json.loads(next(f))
+        rows = []
+        for line in f:
+            fn, file_size, modification_time, md5_hash = json.loads(line)
+            rows.append({'file_path': fn,
+                         'file_size': file_size,
+                         'modification_time': datetime.datetime.strptime(modification_time, MANIFEST_TIME_FORMAT),
+                         'md5_hash': md5_hash})
+    return header['md5_hash'], rows
+
+
 def send_archive_to_glacier(tarball_filename, aws_region, vault_name):
-    '''Sends the archive to Glacier. 
+    '''Sends the archive to Glacier with a multipart upload (see glacier_upload).
+    A retry, or a later call after an interruption, resumes the upload with the
+    parts Glacier hasn't received.
 
     Returns the archive id created at Glacier.
 
@@ -418,16 +582,16 @@ def send_archive_to_glacier(tarball_filename, aws_region, vault_name):
         vault_name - name of the Glacier vault
     '''
     assert os.path.isfile(tarball_filename)
+    glacier_vault = GlacierVault.get(GlacierVault.aws_region == aws_region, GlacierVault.vault_name == vault_name)
     retries = 0
-    max_retries = 3
     while True:
         vault = get_vault(region_name=aws_region, vault_name=vault_name)
         try:
-            archive_id = vault.upload_archive(tarball_filename, tarball_filename)
+            archive_id = MultipartUploader(vault, glacier_vault).upload(tarball_filename, tarball_filename)
             break
         except Exception:
             # log_error(e)
-            if retries < max_retries:
+            if retries < config.glacier_upload_retries:
                 logger.warn('Retrying upload of %s', tarball_filename)
             else:
                 raise
@@ -441,14 +605,39 @@ def get_md5_hash(fn):
     '''
     hasher = hashlib.md5()
     with open(fn, "rb") as f:
-        for chunk in iter(lambda: f.read(1048576), b""):
+        for chunk in iter(lambda: f.read(config.content_hash_chunk_size), b""):
             hasher.update(chunk)
     return hasher.hexdigest()
 
 
+def get_md5_hashes(file_paths):
+    '''Returns the md5 hexdigests of the files, in order, hashing config.content_hash_threads
+    files at once (hashlib releases the GIL while it hashes a chunk).  The hash of a file
+    that can't be read is None and the error is logged.
+    '''
+    def md5_hash_or_none(fn):
+        try:
+            return get_md5_hash(fn)
+        except (IOError, OSError) as e:
+            if 'No such file' in str(e):
+                logger.warn(e)
+            else:
+                log_error(e)
+            return None
+
+    if not file_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=config.content_hash_threads) as executor:
+        return list(executor.map(md5_hash_or_none, file_paths))
+
+
 def add_archive_to_inventory(tarball_filename, glacier_id, aws_region, vault_name):
     '''Adds the files that are in the tarball to the local inventory.
 
+    The files are taken from the tarball's manifest (see build_tarball) and inserted
+    config.inventory_insert_batch_size rows at a time.  A tarball built without a
+    manifest is read back to list its files.
+
     Arguments
         tarball_filename - name of the tarball (archive in Glacier-speak) that was sent to glacier
         glacier_id - id of the archive in the Glacier vault
@@ -456,29 +645,43 @@ def add_archive_to_inventory(tarball_filename, glacier_id, aws_region, vault_nam
         vault_name - name of the Glacier vault, e.g. maven-sdc-vault
     '''
     vault = GlacierVault.get(GlacierVault.aws_region == aws_region, GlacierVault.vault_name == vault_name)
+    manifest = read_tarball_manifest(tarball_filename)
+    if manifest is None:
+        logger.warn('No manifest for tarball %s, reading its file list', tarball_filename)
+        manifest = get_md5_hash(tarball_filename), list(get_tarball_rows(tarball_filename))
+    tarball_md5_hash, rows = manifest
     with models.db.transaction():
         archive = GlacierArchive.create(glacier_vault=vault,
                                         glacier_id=glacier_id,
                                         glacier_description=tarball_filename,
-                                        md5_hash=get_md5_hash(tarball_filename),
+                                        md5_hash=tarball_md5_hash,
                                         when_archived=datetime.datetime.utcnow())
-        tarfile_opts = 'r:gz' if config.use_gzip else 'r'
-        with tarfile.open(tarball_filename, tarfile_opts) as tf:
-            for fn in tf.getnames():
-                full_fn = os.path.join('/', fn)
-                try:
-                    modification_time = datetime.datetime.fromtimestamp(os.path.getmtime(full_fn))
-                    _ = GlacierArchiveFile.create(glacier_archive=archive,
-                                                  file_path=full_fn,
-                                                  file_size=os.path.getsize(full_fn),
-                                                  md5_hash=get_md5_hash(full_fn),
-                                                  modification_time=modification_time)
-                except (IOError, OSError) as e:
-                    if 'No such file' in str(e):
-                        logger.warn(e)
-                    else:
-                        log_error(e)
-    logger.info('Saved database inventory for tarball %s' % tarball_filename)
+        for i in range(0, len(rows), config.inventory_insert_batch_size):
+            batch = rows[i:i + config.inventory_insert_batch_size]
+            for row in batch:
+                row['glacier_archive'] = archive
+            GlacierArchiveFile.insert_many(batch).execute()
+    logger.info('Saved database inventory of %d files for tarball %s' % (len(rows), tarball_filename))
+
+
+def get_tarball_rows(tarball_filename):
+    '''Yields the inventory row dicts of the files in a tarball that has no manifest,
+    stat'ing and hashing the files on disk.'''
+    tarfile_opts = 'r:gz' if config.use_gzip else 'r'
+    with tarfile.open(tarball_filename, tarfile_opts) as tf:
+        for fn in tf.getnames():
+            full_fn = os.path.join('/', fn)
+            try:
+                st = os.stat(full_fn)
+                yield {'file_path': full_fn,
+                       'file_size': st.st_size,
+                       'md5_hash': get_md5_hash(full_fn),
+                       'modification_time': datetime.datetime.fromtimestamp(st.st_mtime)}
+            except (IOError, OSError) as e:
+                if 'No such file' in str(e):
+                    logger.warn(e)
+                else:
+                    log_error(e)
 
 
 def clean_tarball(tarball_pathname):
@@ -486,6 +689,9 @@ def clean_tarball(tarball_pathname):
     and optionally uploaded, clean up the tarball by deleting it or moving it to
     an appropriate location.
     '''
+    manifest_path = get_manifest_path(tarball_pathname)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
     if config.use_upload:
         if config.delete_tarball:
             if os.path.isfile(tarball_pathname):
@@ -502,6 +708,123 @@ def clean_tarball(tarball_pathname):
         os.rename(tarball_pathname, os.path.join(config.completed_tarball_directory, os.path.basename(tarball_pathname)))
 
 
+class TarballBudget(object):
+    '''Limits the bytes of the tarballs in config.tarball_directory that have been built
+    but not yet added to the inventory and cleaned up.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def wait(self, stop):
+        '''Blocks until another tarball of up to config.max_tar_size bytes fits in the budget.
+        A tarball is always allowed when none are in flight.'''
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + config.max_tar_size > self.limit and not stop.is_set():
+                self.condition.wait(1)
+
+    def add(self, size):
+        with self.condition:
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+def put_unless_stopped(q, item, stop):
+    '''Puts item on the bounded queue q unless the pipeline is stopped first.'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def get_unless_stopped(q, stop):
+    '''Returns the next item of q or None once the pipeline is stopped and q is empty.'''
+    while True:
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
+
+def build_tarballs(file_dict, tarballs, budget, stop):
+    '''Pipeline stage that partitions file_dict into tarballs (see build_tarball) and queues them.'''
+    try:
+        while len(file_dict) > 0 and not stop.is_set():
+            budget.wait(stop)
+            tarball_pathname = build_tarball(file_dict)
+            budget.add(os.path.getsize(tarball_pathname))
+            put_unless_stopped(tarballs, tarball_pathname, stop)
+    except Exception as e:
+        log_error(e)
+        stop.set()
+    finally:
+        put_unless_stopped(tarballs, None, stop)
+
+
+def upload_tarballs(tarballs, uploaded, aws_region, vault_name, stop):
+    '''Pipeline stage that uploads the queued tarballs and queues them with their archive ids.
+    A tarball that has been uploaded is always queued, even once the pipeline is stopped,
+    since its upload can't be resumed anymore; the inventory stage drains the queue.'''
+    try:
+        while not stop.is_set():
+            tarball_pathname = get_unless_stopped(tarballs, stop)
+            if tarball_pathname is None:
+                break
+            if config.use_upload:
+                glacier_archive_id = send_archive_to_glacier(tarball_pathname, aws_region, vault_name)
+            else:
+                # assume it's going to s3 with glacier backing
+                glacier_archive_id = config.amazon_s3_prefix + os.path.basename(tarball_pathname)
+            uploaded.put((tarball_pathname, glacier_archive_id))
+    except Exception as e:
+        log_error(e)
+        stop.set()
+    finally:
+        uploaded.put(None)
+
+
+def archive_new_or_changed_files(new_or_changed_dict, aws_region, vault_name):
+    '''Builds, uploads and inventories the tarballs of new_or_changed_dict as a pipeline:
+    one thread builds tarballs while another uploads the previous ones and the calling
+    thread adds the uploaded tarballs to the inventory.  Bounded queues, and a cap of
+    config.max_tarball_bytes_in_flight bytes of tarballs on disk, keep the builder from
+    running too far ahead of the upload.  The pipeline stops at the first error, leaving
+    the tarballs that weren't uploaded in place.  Tarballs already uploaded are still added
+    to the inventory, otherwise their files would be archived again by the next run.
+    '''
+    stop = threading.Event()
+    budget = TarballBudget(config.max_tarball_bytes_in_flight)
+    tarballs = queue.Queue(maxsize=config.tarball_queue_depth)
+    uploaded = queue.Queue(maxsize=config.tarball_queue_depth)
+    stages = [threading.Thread(target=build_tarballs, args=(new_or_changed_dict, tarballs, budget, stop)),
+              threading.Thread(target=upload_tarballs, args=(tarballs, uploaded, aws_region, vault_name, stop))]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+    try:
+        # drain until the upload stage is done, it blocks until its uploads are taken
+        for tarball_pathname, glacier_archive_id in iter(uploaded.get, None):
+            try:
+                tarball_size = os.path.getsize(tarball_pathname)
+                add_archive_to_inventory(tarball_pathname, glacier_archive_id, aws_region, vault_name)
+                clean_tarball(tarball_pathname)
+                budget.release(tarball_size)
+            except Exception as e:
+                log_error(e)
+                stop.set()
+    finally:
+        for stage in stages:
+            stage.join()
+
+
 def archive_files(root_directory, aws_region, vault_name, excluded_directories=[]):
     '''Performs all the steps for uploading files to Glacier:
         - finds files that are new or changed compared to previous archives
@@ -509,10 +832,8 @@ def archive_files(root_directory, aws_region, vault_name, excluded_directories=[
         - uploads the tarballs to glacier
         - adds entries for each uploaded file to the sqlite local inventory
 
-    The code does an upload as soon as the files in the tarball exceed config.max_tar_size bytes, 
-    and then starts another archive if needed.
-
-    Tarballs created locally are kept.
+    Each tarball holds up to config.max_tar_size bytes of files.  The next tarball is
+    built while the previous one uploads (see archive_new_or_changed_files).
 
     Arguments
         root_directory - top of the directory tree that will be walked to
@@ -522,21 +843,27 @@ def archive_files(root_directory, aws_region, vault_name, excluded_directories=[
         excluded_directories - optional. Holds list of directories that are to be excluded from the archive.
     '''
     try:
+        if config.use_upload:
+            resume_uploads(aws_region, vault_name)
         new_or_changed_dict = get_dict_of_new_or_changed_files(root_directory, aws_region,
                                                                vault_name, excluded_directories)
-        while len(new_or_changed_dict) > 0:
-            tarball_pathname = build_tarball(new_or_changed_dict)
-            if config.use_upload:
-                glacier_archive_id = send_archive_to_glacier(tarball_pathname, aws_region, vault_name)
-            else:
-                # assume it's going to s3 with glacier backing
-                glacier_archive_id = config.amazon_s3_prefix + os.path.basename(tarball_pathname)
-            add_archive_to_inventory(tarball_pathname, glacier_archive_id, aws_region, vault_name)
-            clean_tarball(tarball_pathname)
+        archive_new_or_changed_files(new_or_changed_dict, aws_region, vault_name)
     except Exception as e:
         log_error(e)
 
 
+def resume_uploads(aws_region, vault_name):
+    '''Finishes the uploads of tarballs that were interrupted by an earlier run,
+    then adds them to the inventory and cleans them up.
+    '''
+    glacier_vault = GlacierVault.get(GlacierVault.aws_region == aws_region, GlacierVault.vault_name == vault_name)
+    for tarball_pathname in get_pending_uploads(glacier_vault):
+        logger.info('Resuming the upload of %s', tarball_pathname)
+        glacier_archive_id = send_archive_to_glacier(tarball_pathname, aws_region, vault_name)
+        add_archive_to_inventory(tarball_pathname, glacier_archive_id, aws_region, vault_name)
+        clean_tarball(tarball_pathname)
+
+
 def clean_directory_name(dn):
     '''Check the given directory name dn. If it is not None 
     and its length is greater than zero, append a trailing 
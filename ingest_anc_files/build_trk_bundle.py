@@ -6,19 +6,23 @@ Created on Sep 23, 2015
 '''
 
 import os
+import dbm
 import tarfile
 import pytz
-import hashlib
-from datetime import datetime, timedelta
-import shelve
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
 from maven_utilities import time_utilities
 from maven_database.models import AncillaryFilesMetadata
 from maven_status import status, MAVEN_SDC_COMPONENT, MAVEN_SDC_EVENTS
 from maven_utilities import constants
+from maven_utilities.utilities import HashingReader
+from ingest_anc_files.trk_bundle_manifest import open_manifest
 
+# Legacy shelve manifest, migrated into the sqlite manifest on first use
 shelf_file = '/maven/mavenpro/.trk_bundle_manifest'
+manifest_db_file = '/maven/mavenpro/.trk_bundle_manifest.sqlite3'
 
 logger = logging.getLogger('maven.ingest_anc_files.build_trk_bundle.log')
 
@@ -35,19 +39,32 @@ def get_dt_from_yydoy(year, doy):
     return dt.replace(tzinfo=pytz.UTC)
 
 
-def get_manifest(manifest_file=None, writeback=True, persist=False):
-    '''Method used to deserialize the shelve file into a manifest
+def is_shelf_file(manifest_file):
+    '''Method used to determine if a manifest is a legacy shelve manifest
+    Returns:
+        True if manifest_file is a shelve (dbm) file rather than a sqlite manifest
+    '''
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'rb') as f:
+            if f.read(16) == b'SQLite format 3\x00':
+                return False
+    return bool(dbm.whichdb(manifest_file))
+
+
+def get_manifest(manifest_file=None):
+    '''Method used to open the TRK bundle manifest.  If the default manifest is empty
+    and the legacy shelve manifest exists, the shelve is migrated into it.  A manifest_file
+    that is a legacy shelve is migrated into <manifest_file>.sqlite3, which is opened instead.
     Arguments:
-        manifest_file - The fully qualified path to the shelve file
+        manifest_file - The fully qualified path to the manifest (defaults to manifest_db_file)
     Returns:
-        The opened shelve
+        The opened TrkBundleManifest
     '''
     if manifest_file is None:
-        manifest_file = shelf_file
-    if not os.path.isfile(manifest_file):
-        touch_shelf = shelve.open(manifest_file)
-        touch_shelf.close()
-    return shelve.open(manifest_file, writeback=writeback, flag='c' if persist else 'r')
+        return open_manifest(manifest_db_file, shelf_file=shelf_file)
+    if is_shelf_file(manifest_file):
+        return open_manifest(manifest_file + '.sqlite3', shelf_file=manifest_file)
+    return open_manifest(manifest_file)
 
 
 def dump_manifest(manifest):
@@ -56,90 +73,172 @@ def dump_manifest(manifest):
         print ('{}:{}'.format(_n, manifest[_n]))
 
 
-def get_manifest_entry(bundle_file):
-    '''Method used to generate an manifest entry for the trk bundle generated'''
-    manifest_entry = {'file_name': bundle_file,
-                      'md5': hashlib.md5(open(bundle_file, 'rb').read()).hexdigest()}
+def get_bundle_name(start_dt, end_dt, out_dir):
+    '''Method used to get the fully qualified TRK bundle name for a window'''
+    bundle_name = 'mvn_anc_trk_{0}_{1}.tgz'.format(get_yydoy(start_dt),
+                                                   get_yydoy(end_dt))
+    return os.path.join(out_dir, bundle_name)
 
-    return manifest_entry
+
+def add_to_bundle(tar_file, file_to_add):
+    '''Method used to stream a file into an open tar, hashing the bytes as they are written
+    Arguments:
+        tar_file - The open TarFile to add to
+        file_to_add - The fully qualified file to add
+    Returns:
+        The manifest entry for the bundled file
+    '''
+    tar_info = tar_file.gettarinfo(file_to_add)
+    with open(file_to_add, 'rb') as f:
+        reader = HashingReader(f)
+        tar_file.addfile(tar_info, fileobj=reader)
+    return {'file_name': file_to_add,
+            'md5': reader.hexdigest()}
 
 
-def build_bundle_latest(end_dt, out_dir, day_increment, manifest_file):
+def build_bundle_latest(end_dt, out_dir, day_increment, manifest_file, jobs=1):
     '''Method used to build a TRK bundle using the last entry in the manifest
     as the start date and UTC now as the end date'''
-    m = get_manifest(manifest_file=manifest_file, writeback=False)
-    # determine last generation time
-    last_generation_dt = constants.MAVEN_MISSION_START if len(m.values()) == 0 else max([next_entry['end'] for next_entry in m.values()])
-    m.close()
+    with get_manifest(manifest_file=manifest_file) as m:
+        # determine last generation time
+        last_generation_dt = m.latest_end() or constants.MAVEN_MISSION_START
 
     if end_dt > last_generation_dt:
         # run bundle generation
-        build_bundles(last_generation_dt, end_dt, out_dir, day_increment, manifest_file)
+        build_bundles(last_generation_dt, end_dt, out_dir, day_increment, manifest_file, jobs)
 
 
-def build_bundle_full(end_dt, out_dir, day_increment, manifest_file):
+def build_bundle_full(end_dt, out_dir, day_increment, manifest_file, jobs=1):
     '''Method used to run a full TRK bundle.  This will compare the manifest with
     what is currently on disk and rebuild the bundle if things have changed
     Arguments:
         end_dt - the end time to use when querying for trk files
         out_dir - output directory for the bundle file
         day_increment - Fractional day between TRK bundles
-        manifest_file - The manifest shelve file to use
+        manifest_file - The manifest file to use
+        jobs - The number of bundles to build in parallel
     '''
 
     # run a latest to build any new bundles
-    build_bundle_latest(end_dt, out_dir, day_increment, manifest_file)
+    build_bundle_latest(end_dt, out_dir, day_increment, manifest_file, jobs)
 
-    manifest = get_manifest(manifest_file=manifest_file, writeback=False)
-    bundles_to_rebuild = reconcile_bundle(manifest=manifest)
+    with get_manifest(manifest_file=manifest_file) as manifest:
+        bundles_to_rebuild = reconcile_bundle(manifest=manifest)
 
-    re_bundles = [(os.path.split(d)[0], s, e) for (d, s, e) in bundles_to_rebuild]
+    re_bundles = [(get_bundle_name(s, e, os.path.split(d)[0]), s, e) for (d, s, e) in bundles_to_rebuild]
 
-    for directory, start, end in re_bundles:
-        build_bundle(start_dt=start,
-                     end_dt=end,
-                     out_dir=directory,
-                     manifest_file=manifest_file)
+    build_bundle_windows(re_bundles, manifest_file, jobs)
 
 
 def reconcile_bundle(manifest):
-    '''Method used to determine if the manifest matches what is on disk
+    '''Method used to determine if the manifest matches what is on disk.  All TRK
+    files spanning the manifest are fetched with one query ordered by start_date
+    and assigned to the bundle windows in a single merge pass.
     Arguments:
-        manifest - The TRK bundle manifest deserialized via get_manifest
+        manifest - The TRK bundle manifest opened via get_manifest
     Returns:
-        A list of manifest keys that represent the bundles that are out of sync
+        A list of (bundle name, start, end) for the bundles that are out of sync
     '''
+    bundles = list(manifest.bundle_windows_with_files())
+    if len(bundles) == 0:
+        return []
+
+    trk_files = get_trk_files(min([start for _, start, _, _ in bundles]),
+                              max([end for _, _, end, _ in bundles]))
+
     bundles_to_regenerate = []
-    for next_manifest_key in manifest:
-        next_manifest = manifest[next_manifest_key]
-        logger.info('Checking manifest %s', next_manifest)
-        if not os.path.isfile(next_manifest_key):
-            bundles_to_regenerate.append((next_manifest_key, next_manifest['start'], next_manifest['end']))
-            continue
-        trk_files = AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.file_extension == '234')\
-                                                .filter(AncillaryFilesMetadata.start_date >= next_manifest['start'])\
-                                                .filter(AncillaryFilesMetadata.start_date < next_manifest['end']).all()
-        db_trk_filenames = [os.path.join(m.directory_path, m.file_name) for m in trk_files]
-        bundle_filenames = [m['file_name'] for m in next_manifest['bundled_files']]
-
-        if set(db_trk_filenames) != set(bundle_filenames):
-            bundles_to_regenerate.append((next_manifest_key, next_manifest['start'], next_manifest['end']))
+    for (next_manifest_key, start, end, bundle_filenames), db_trk_filenames in assign_to_windows(bundles, trk_files):
+        logger.debug('Checking manifest %s', next_manifest_key)
+        if set(db_trk_filenames) != bundle_filenames or not os.path.isfile(next_manifest_key):
+            logger.info('Bundle %s is out of sync', next_manifest_key)
+            bundles_to_regenerate.append((next_manifest_key, start, end))
     return bundles_to_regenerate
 
 
-def build_bundles(start_dt, end_dt, out_dir, day_increment, manifest_file=None):
+def assign_to_windows(windows, trk_files):
+    '''Generator used to merge TRK files into bundle windows in a single pass
+    Arguments:
+        windows - A sequence of tuples ordered by start whose second and third items
+                  are the window start (inclusive) and end (exclusive)
+        trk_files - A list of (start date, file name) ordered by start date
+    Yields:
+        (window, list of the file names that start within the window)
+    '''
+    first = 0
+    for window in windows:
+        start, end = window[1], window[2]
+        # windows are ordered by start so the first candidate file never moves backwards
+        while first < len(trk_files) and trk_files[first][0] < start:
+            first += 1
+        last = first
+        while last < len(trk_files) and trk_files[last][0] < end:
+            last += 1
+        yield window, [file_name for _, file_name in trk_files[first:last]]
+
+
+def get_trk_files(start_dt, end_dt):
+    '''Method used to query the TRK files that start within a time window
+    Arguments:
+        start_dt - the inclusive start of the window
+        end_dt - the exclusive end of the window
+    Returns:
+        A list of (UTC start date, fully qualified file name) ordered by start date
+    '''
+    query = AncillaryFilesMetadata.query.with_entities(AncillaryFilesMetadata.start_date,
+                                                       AncillaryFilesMetadata.directory_path,
+                                                       AncillaryFilesMetadata.file_name)\
+                                        .filter(AncillaryFilesMetadata.file_extension == '234')\
+                                        .filter(AncillaryFilesMetadata.start_date >= start_dt)\
+                                        .filter(AncillaryFilesMetadata.start_date < end_dt)\
+                                        .order_by(AncillaryFilesMetadata.start_date)
+    return [(time_utilities.to_utc_tz(start_date), os.path.join(directory_path, file_name))
+            for start_date, directory_path, file_name in query]
+
+
+def build_bundles(start_dt, end_dt, out_dir, day_increment, manifest_file=None, jobs=1):
     '''Method used to build a set of TRK bundle that vary based on day_increment
     Arguments:
         start_dt - the start time to use when querying for trk files
         end_dt - the end time to use when querying for trk files
         out_dir - output directory for the bundle file
         day_increment - Fractional day between TRK bundles
-        manifest_file - The manifest shelve file to use
+        manifest_file - The manifest file to use
+        jobs - The number of bundles to build in parallel
     '''
+    windows = []
     while start_dt <= end_dt:
         next_end = min(end_dt, start_dt + timedelta(day_increment))
-        build_bundle(start_dt, next_end, out_dir, manifest_file)
+        windows.append((get_bundle_name(start_dt, next_end, out_dir), start_dt, next_end))
         start_dt += timedelta(day_increment)
+    build_bundle_windows(windows, manifest_file, jobs)
+
+
+def build_bundle_windows(windows, manifest_file=None, jobs=1):
+    '''Method used to build a set of independent TRK bundles.  The TRK files for every
+    window are fetched with one query; the bundles are then written by a pool of
+    jobs worker processes and each bundle is recorded in the manifest as it completes.
+    Arguments:
+        windows - A list of (bundle name, start, end) to build
+        manifest_file - The manifest file to use
+        jobs - The number of bundles to build in parallel
+    '''
+    if len(windows) == 0:
+        return
+    windows = sorted(windows, key=lambda window: window[1])
+    trk_files = get_trk_files(windows[0][1], max([end for _, _, end in windows]))
+    window_files = list(assign_to_windows(windows, trk_files))
+
+    with get_manifest(manifest_file=manifest_file) as manifest:
+        if jobs > 1 and len(window_files) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(write_bundle, bundle_name, files_to_add): (bundle_name, start, end)
+                           for (bundle_name, start, end), files_to_add in window_files}
+                for future in as_completed(futures):
+                    bundle_name, start, end = futures[future]
+                    record_bundle(manifest, bundle_name, start, end, *future.result())
+        else:
+            for (bundle_name, start, end), files_to_add in window_files:
+                record_bundle(manifest, bundle_name, start, end, *write_bundle(bundle_name, files_to_add))
 
 
 def build_bundle(start_dt, end_dt, out_dir, manifest_file=None):
@@ -149,34 +248,40 @@ def build_bundle(start_dt, end_dt, out_dir, manifest_file=None):
         end_dt - the end time to use when querying for trk files
         out_dir - output directory for the bundle file
     '''
-    manifest = get_manifest(manifest_file=manifest_file, persist=True)
+    build_bundle_windows([(get_bundle_name(start_dt, end_dt, out_dir), start_dt, end_dt)], manifest_file)
+
+
+def write_bundle(bundle_name, files_to_add):
+    '''Method used to write a TRK bundle.  Each file is read once and its MD5 is
+    computed from the bytes written into the tar.  This method does not touch the
+    database so it can be run in a worker process.
+    Arguments:
+        bundle_name - The fully qualified bundle file to write
+        files_to_add - The fully qualified TRK files to place in the bundle
+    Returns:
+        (manifest entries for the files bundled, True if the bundle failed)
+    '''
     bundled_files = []
-    bundle_name = 'mvn_anc_trk_{0}_{1}.tgz'.format(get_yydoy(start_dt),
-                                                   get_yydoy(end_dt))
-    bundle_name = os.path.join(out_dir, bundle_name)
     logger.info('working on bundle %s', bundle_name)
-    with tarfile.open(bundle_name, 'w:gz') as tar_file:
-        try:
-            trk_anc_files = AncillaryFilesMetadata.query\
-                .filter(AncillaryFilesMetadata.file_extension == '234')\
-                .filter(AncillaryFilesMetadata.start_date >= start_dt)\
-                .filter(AncillaryFilesMetadata.start_date < end_dt).all()
-
-            for next_trk in trk_anc_files:
-                file_to_add = os.path.join(next_trk.directory_path, next_trk.file_name)
+    try:
+        with tarfile.open(bundle_name, 'w:gz') as tar_file:
+            for file_to_add in files_to_add:
                 logger.debug('Adding %s to tar', file_to_add)
-                tar_file.add(file_to_add, recursive=False)
-                bundled_files.append(get_manifest_entry(file_to_add))
+                bundled_files.append(add_to_bundle(tar_file, file_to_add))
                 logger.info('successfully added %s to bundle', file_to_add)
-        except Exception:
-            logger.exception('Exception occurred while building the TRK bundle')
-            status.add_exception_status(component_id=MAVEN_SDC_COMPONENT.ANC_INGESTER,
-                                        event_id=MAVEN_SDC_EVENTS.FAIL,
-                                        summary='Exception occurred while building the TRK bundle')
-
-        manifest[bundle_name] = {'generation_time': time_utilities.utc_now(),
-                                 'start': start_dt,
-                                 'end': end_dt,
-                                 'bundled_files': bundled_files}
-
-        manifest.close()
+    except Exception:
+        logger.exception('Exception occurred while building the TRK bundle %s', bundle_name)
+        return bundled_files, True
+    return bundled_files, False
+
+
+def record_bundle(manifest, bundle_name, start_dt, end_dt, bundled_files, failed):
+    '''Method used to atomically record a written bundle in the manifest'''
+    if failed:
+        status.add_exception_status(component_id=MAVEN_SDC_COMPONENT.ANC_INGESTER,
+                                    event_id=MAVEN_SDC_EVENTS.FAIL,
+                                    summary='Exception occurred while building the TRK bundle {}'.format(bundle_name))
+    manifest[bundle_name] = {'generation_time': time_utilities.utc_now(),
+                             'start': start_dt,
+                             'end': end_dt,
+                             'bundled_files': bundled_files}
@@ -22,7 +22,11 @@ def main():
                         help='Print the manifest')
     parser.add_argument('-m', '--manifest-file',
                         default=None,
-                        help='Use this manifest')
+                        help='Use this manifest.  A legacy shelve manifest is migrated into <manifest>.sqlite3')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='The number of TRK bundles to build in parallel')
     parser.add_argument('-o', '--output-dir',
                         help='The output directory for the TRK bundle file',
                         default='/maven/data/sdc/trk')
@@ -33,13 +37,13 @@ def main():
         build_trk_bundle.dump_manifest(build_trk_bundle.get_manifest(manifest_file=args.manifest_file))
         return
     if args.type_bundle == 'latest':
-        build_trk_bundle.build_bundle_latest(time_utilities.utc_now(), args.output_dir, args.increment_bundle, args.manifest_file)
+        build_trk_bundle.build_bundle_latest(time_utilities.utc_now(), args.output_dir, args.increment_bundle, args.manifest_file, args.jobs)
     elif args.type_bundle == 'full':
-        build_trk_bundle.build_bundle_full(time_utilities.utc_now(), args.output_dir, args.increment_bundle, args.manifest_file)
+        build_trk_bundle.build_bundle_full(time_utilities.utc_now(), args.output_dir, args.increment_bundle, args.manifest_file, args.jobs)
     elif args.type_bundle == 'incremental':
         start = parse(args.start_date).replace(tzinfo=pytz.UTC) if args.start_date is not None else datetime.min.replace(tzinfo=pytz.UTC)
         end = parse(args.end_date).replace(tzinfo=pytz.UTC) if args.end_date is not None else datetime.min.replace(tzinfo=pytz.UTC)
-        build_trk_bundle.build_bundles(start, end, args.output_dir, args.increment_bundle, args.manifest_file)
+        build_trk_bundle.build_bundles(start, end, args.output_dir, args.increment_bundle, args.manifest_file, args.jobs)
     else:  # use provided start-date and end-date
         start = parse(args.start_date).replace(tzinfo=pytz.UTC) if args.start_date is not None else datetime.min.replace(tzinfo=pytz.UTC)
         end = parse(args.end_date).replace(tzinfo=pytz.UTC) if args.end_date is not None else datetime.min.replace(tzinfo=pytz.UTC)
@@ -0,0 +1,191 @@
+'''
+SQLite backed manifest of the generated TRK bundles.
+
+The manifest records one row per bundle (bundles) and one row per file
+placed in that bundle (bundled_files).  Bundle windows are indexed on their
+start/end times and bundled files on their file name so that the latest
+generation time and reconciliation lookups do not need to deserialize the
+entire manifest.
+'''
+
+import os
+import dbm
+import shelve
+import sqlite3
+import logging
+from datetime import datetime
+from itertools import groupby
+from collections.abc import MutableMapping
+
+from maven_utilities import time_utilities
+
+logger = logging.getLogger('maven.ingest_anc_files.trk_bundle_manifest.log')
+
+# Timestamps are stored as fixed width UTC strings so they sort (and index) chronologically
+timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS bundles (
+           bundle_name TEXT PRIMARY KEY,
+           generation_time TEXT NOT NULL,
+           start_date TEXT NOT NULL,
+           end_date TEXT NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS bundles_start_date_idx ON bundles (start_date)''',
+    '''CREATE INDEX IF NOT EXISTS bundles_end_date_idx ON bundles (end_date)''',
+    '''CREATE TABLE IF NOT EXISTS bundled_files (
+           bundle_name TEXT NOT NULL REFERENCES bundles (bundle_name) ON DELETE CASCADE,
+           file_name TEXT NOT NULL,
+           md5 TEXT,
+           PRIMARY KEY (bundle_name, file_name))''',
+    '''CREATE INDEX IF NOT EXISTS bundled_files_file_name_idx ON bundled_files (file_name)''',
+]
+
+
+def to_timestamp(dt):
+    '''Method used to convert a datetime into the stored manifest timestamp'''
+    return time_utilities.to_utc_tz(dt).strftime(timestamp_format)
+
+
+def from_timestamp(timestamp):
+    '''Method used to convert a stored manifest timestamp into a UTC aware datetime'''
+    return time_utilities.to_utc_tz(datetime.strptime(timestamp, timestamp_format))
+
+
+class TrkBundleManifest(MutableMapping):
+    '''Dictionary like view of the TRK bundle manifest keyed on the bundle file name.
+    Each value is a dictionary of the form:
+        {'generation_time': datetime,
+         'start': datetime,
+         'end': datetime,
+         'bundled_files': [{'file_name': str, 'md5': str}, ...]}
+    '''
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.connection = sqlite3.connect(manifest_file)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        with self.connection:
+            for statement in schema:
+                self.connection.execute(statement)
+
+    def __getitem__(self, bundle_name):
+        row = self.connection.execute('SELECT generation_time, start_date, end_date FROM bundles WHERE bundle_name = ?',
+                                      (bundle_name,)).fetchone()
+        if row is None:
+            raise KeyError(bundle_name)
+        return {'generation_time': from_timestamp(row[0]),
+                'start': from_timestamp(row[1]),
+                'end': from_timestamp(row[2]),
+                'bundled_files': [{'file_name': file_name, 'md5': md5}
+                                  for file_name, md5 in self.connection.execute('SELECT file_name, md5 FROM bundled_files WHERE bundle_name = ? ORDER BY file_name',
+                                                                                (bundle_name,))]}
+
+    def __setitem__(self, bundle_name, entry):
+        with self.connection:
+            self._write_entry(bundle_name, entry)
+
+    def __delitem__(self, bundle_name):
+        with self.connection:
+            cursor = self.connection.execute('DELETE FROM bundles WHERE bundle_name = ?', (bundle_name,))
+        if cursor.rowcount == 0:
+            raise KeyError(bundle_name)
+
+    def __iter__(self):
+        return iter([row[0] for row in self.connection.execute('SELECT bundle_name FROM bundles ORDER BY start_date, bundle_name')])
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM bundles').fetchone()[0]
+
+    def __contains__(self, bundle_name):
+        return self.connection.execute('SELECT 1 FROM bundles WHERE bundle_name = ?', (bundle_name,)).fetchone() is not None
+
+    def _write_entry(self, bundle_name, entry):
+        '''Method used to replace a bundle and its files.  Callers are responsible for the transaction.'''
+        self.connection.execute('DELETE FROM bundles WHERE bundle_name = ?', (bundle_name,))
+        self.connection.execute('INSERT INTO bundles (bundle_name, generation_time, start_date, end_date) VALUES (?, ?, ?, ?)',
+                                (bundle_name,
+                                 to_timestamp(entry['generation_time']),
+                                 to_timestamp(entry['start']),
+                                 to_timestamp(entry['end'])))
+        self.connection.executemany('INSERT OR REPLACE INTO bundled_files (bundle_name, file_name, md5) VALUES (?, ?, ?)',
+                                    [(bundle_name, f['file_name'], f.get('md5')) for f in entry['bundled_files']])
+
+    def latest_end(self):
+        '''Method used to get the latest bundle end time in the manifest
+        Returns:
+            The UTC aware end time of the latest bundle or None if the manifest is empty
+        '''
+        row = self.connection.execute('SELECT MAX(end_date) FROM bundles').fetchone()
+        return from_timestamp(row[0]) if row[0] is not None else None
+
+    def bundle_windows(self):
+        '''Method used to get the (bundle_name, start, end) of every bundle ordered by start time'''
+        return [(bundle_name, from_timestamp(start), from_timestamp(end))
+                for bundle_name, start, end in self.connection.execute('SELECT bundle_name, start_date, end_date FROM bundles ORDER BY start_date, bundle_name')]
+
+    def bundle_windows_with_files(self):
+        '''Generator of (bundle_name, start, end, set of bundled file names) for every bundle,
+        ordered by start time, read with a single query'''
+        rows = self.connection.execute('''SELECT b.bundle_name, b.start_date, b.end_date, f.file_name
+                                          FROM bundles b LEFT OUTER JOIN bundled_files f ON f.bundle_name = b.bundle_name
+                                          ORDER BY b.start_date, b.bundle_name''')
+        for (bundle_name, start, end), bundle_rows in groupby(rows, key=lambda row: row[:3]):
+            yield (bundle_name,
+                   from_timestamp(start),
+                   from_timestamp(end),
+                   set([row[3] for row in bundle_rows if row[3] is not None]))
+
+    def bundled_file_names(self, bundle_name):
+        '''Method used to get the set of file names recorded for a bundle'''
+        return set([row[0] for row in self.connection.execute('SELECT file_name FROM bundled_files WHERE bundle_name = ?', (bundle_name,))])
+
+    def bundles_containing(self, file_name):
+        '''Method used to get the names of the bundles that contain the provided file'''
+        return [row[0] for row in self.connection.execute('SELECT bundle_name FROM bundled_files WHERE file_name = ?', (file_name,))]
+
+    def migrate_shelf(self, shelf_file):
+        '''Method used to perform a one-time import of a legacy shelve manifest.  The
+        import only happens if this manifest is empty and the shelve file exists.
+        Arguments:
+            shelf_file - The fully qualified path to the legacy shelve file
+        Returns:
+            The number of bundles imported
+        '''
+        if len(self) > 0 or not dbm.whichdb(shelf_file):
+            return 0
+        logger.info('Migrating TRK bundle manifest from %s to %s', shelf_file, self.manifest_file)
+        shelf = shelve.open(shelf_file, flag='r')
+        try:
+            with self.connection:
+                for bundle_name in shelf:
+                    self._write_entry(bundle_name, shelf[bundle_name])
+            return len(shelf)
+        finally:
+            shelf.close()
+
+    def close(self):
+        '''Method used to release the underlying database connection'''
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def open_manifest(manifest_file, shelf_file=None):
+    '''Method used to open (creating if needed) the TRK bundle manifest
+    Arguments:
+        manifest_file - The fully qualified path to the sqlite manifest
+        shelf_file - Optional legacy shelve manifest to migrate from
+    Returns:
+        The opened TrkBundleManifest
+    '''
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    manifest = TrkBundleManifest(manifest_file)
+    if shelf_file is not None:
+        manifest.migrate_shelf(shelf_file)
+    return manifest
@@ -0,0 +1,237 @@
+'''
+Verification of written PDS bundles against their checksum and transfer manifests.
+
+Each volume of a bundle is streamed once.  A reader thread decompresses the
+tar stream and queues the member contents while the calling thread hashes
+them, so decompression and hashing overlap (zlib and hashlib both release the
+GIL on large buffers).  The volumes of a multi-volume bundle are verified in
+parallel.
+'''
+import os
+import queue
+import hashlib
+import logging
+import tarfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from maven_status import MAVEN_SDC_EVENTS, MAVEN_SDC_COMPONENT
+from maven_status.status import add_status
+from . import config, bundle_writer
+
+logger = logging.getLogger('maven.make_pds_bundles.bundle_verifier.log')
+
+# Number of problems listed in the status description of a failed verification
+reported_problem_limit = 50
+
+
+class BundleVerificationError(Exception):
+    '''Raised when a written bundle doesn't match its manifests'''
+    pass
+
+
+class BundleVerification():
+    '''The outcome of verifying a bundle'''
+
+    def __init__(self, tarfile_name):
+        self.tarfile_name = tarfile_name
+        self.volume_files = []
+        self.verified = 0
+        self.missing = []
+        self.unexpected = []
+        self.mismatched = []
+        self.missing_labels = []
+        self.duplicate_lidvids = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not (self.missing or self.unexpected or self.mismatched or
+                    self.missing_labels or self.duplicate_lidvids or self.errors)
+
+    def problems(self):
+        '''Returns a description of each problem found'''
+        return (['Unable to read {}'.format(error) for error in self.errors] +
+                ['{} is in the checksum manifest but not the bundle'.format(name) for name in self.missing] +
+                ['{} is in the bundle but not the checksum manifest'.format(name) for name in self.unexpected] +
+                ['{} checksum {} does not match the manifest checksum {}'.format(name, actual, expected)
+                 for name, expected, actual in self.mismatched] +
+                ['{} ({}) is in the transfer manifest but not the bundle'.format(name, lidvid) for lidvid, name in self.missing_labels] +
+                ['{} is listed more than once in the transfer manifest'.format(lidvid) for lidvid in self.duplicate_lidvids])
+
+    def summary(self):
+        return '{} : {} members verified in {} volume(s), {} missing, {} unexpected, {} mismatched, {} missing labels, {} duplicate LIDVIDs, {} errors'.format(
+            os.path.basename(self.tarfile_name), self.verified, len(self.volume_files), len(self.missing), len(self.unexpected),
+            len(self.mismatched), len(self.missing_labels), len(self.duplicate_lidvids), len(self.errors))
+
+
+def member_name(file_name):
+    '''Method used to get the name tarfile gives the member added from file_name'''
+    return file_name.replace(os.sep, '/').lstrip('/')
+
+
+def read_checksum_manifest(checksum_file):
+    '''Method used to read a checksum manifest written by print_checksum_manifest
+    Returns:
+        OrderedDict of {member name: md5}
+    '''
+    checksums = OrderedDict()
+    with open(checksum_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            checksum, file_name = line.rstrip('\n').split('  ', 1)
+            checksums[member_name(file_name)] = checksum
+    return checksums
+
+
+def read_transfer_manifest(manifest_file):
+    '''Method used to read a transfer manifest
+    Returns:
+        A list of (LIDVID, member name)
+    '''
+    lidvids = []
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            lidvid, file_name = line.split(None, 1)
+            lidvids.append((lidvid, member_name(file_name.strip())))
+    return lidvids
+
+
+def bundle_volumes(tarfile_name):
+    '''Method used to get the files of a bundle
+    Returns:
+        [tarfile_name] for a single volume bundle or the existing volumes (see bundle_writer.volume_file_name)
+    '''
+    if os.path.isfile(tarfile_name):
+        return [tarfile_name]
+    volumes = []
+    while os.path.isfile(bundle_writer.volume_file_name(tarfile_name, len(volumes))):
+        volumes.append(bundle_writer.volume_file_name(tarfile_name, len(volumes)))
+    return volumes
+
+
+def read_members(volume_file, chunks, chunk_size):
+    '''Method run on the reader thread of hash_volume.  The contents of each regular member are
+    queued as (name, chunk) followed by (name, None).  The end of the volume is queued as
+    (None, None), or (None, exception) if the volume couldn't be read.
+    '''
+    try:
+        with tarfile.open(volume_file, 'r:gz') as tar_file:
+            for member in tar_file:
+                if not member.isfile():
+                    continue
+                member_file = tar_file.extractfile(member)
+                for chunk in iter(lambda: member_file.read(chunk_size), b''):
+                    chunks.put((member.name, chunk))
+                chunks.put((member.name, None))
+    except Exception as e:
+        chunks.put((None, e))
+    else:
+        chunks.put((None, None))
+
+
+def hash_volume(volume_file, chunk_size=None, queue_depth=None):
+    '''Method used to compute the md5 of every member of a bundle volume in a single pass
+    Arguments:
+        volume_file - The fully qualified name of the .tgz volume
+        chunk_size - The size of the queued reads (defaults to config.checksum_chunk_size)
+        queue_depth - The number of chunks the reader may run ahead (defaults to config.bundle_verify_queue_depth)
+    Returns:
+        OrderedDict of {member name: md5}
+    Raises:
+        The exception raised reading the volume
+    '''
+    chunks = queue.Queue(maxsize=queue_depth or config.bundle_verify_queue_depth)
+    reader = threading.Thread(target=read_members, args=(volume_file, chunks, chunk_size or config.checksum_chunk_size))
+    reader.daemon = True
+    reader.start()
+
+    checksums = OrderedDict()
+    md5 = hashlib.md5()
+    while True:
+        name, chunk = chunks.get()
+        if name is None:
+            reader.join()
+            if chunk is not None:
+                raise chunk
+            return checksums
+        if chunk is None:
+            checksums[name] = md5.hexdigest()
+            md5 = hashlib.md5()
+        else:
+            md5.update(chunk)
+
+
+def verify_bundle(tarfile_name, checksum_file, manifest_file=None, threads=None):
+    '''Method used to verify a bundle against its checksum manifest and transfer manifest.  Every
+    member must be in the checksum manifest with a matching md5 (and vice versa) and every file
+    of the transfer manifest must be a member of the bundle and no versioned LIDVID may repeat.
+    Arguments:
+        tarfile_name - The fully qualified name of the bundle
+        checksum_file - The fully qualified name of the checksum manifest
+        manifest_file - Optional fully qualified name of the transfer manifest
+        threads - The number of volumes verified at once (defaults to config.bundle_verify_threads)
+    Returns:
+        A BundleVerification
+    '''
+    verification = BundleVerification(tarfile_name)
+    verification.volume_files = bundle_volumes(tarfile_name)
+    if len(verification.volume_files) == 0:
+        verification.errors.append('{} : no such bundle'.format(tarfile_name))
+        return verification
+
+    expected = read_checksum_manifest(checksum_file)
+    lidvids = read_transfer_manifest(manifest_file) if manifest_file is not None else []
+
+    actual = {}
+    threads = threads or config.bundle_verify_threads
+    with ThreadPoolExecutor(max_workers=min(threads, len(verification.volume_files))) as executor:
+        futures = [(volume_file, executor.submit(hash_volume, volume_file)) for volume_file in verification.volume_files]
+        for volume_file, future in futures:
+            try:
+                actual.update(future.result())
+            except (tarfile.TarError, OSError, EOFError) as e:
+                logger.error('Unable to read %s : %s', volume_file, str(e))
+                verification.errors.append('{} : {}'.format(volume_file, str(e)))
+
+    for name, checksum in expected.items():
+        if name not in actual:
+            if not verification.errors:
+                verification.missing.append(name)
+        elif actual[name] != checksum:
+            verification.mismatched.append((name, checksum, actual[name]))
+        else:
+            verification.verified += 1
+    verification.unexpected = [name for name in actual if name not in expected]
+
+    seen = set()
+    for lidvid, name in lidvids:
+        # unversioned LIDs may be shared by several products, a version must identify a single product
+        if '::' in lidvid:
+            if lidvid in seen:
+                verification.duplicate_lidvids.append(lidvid)
+            seen.add(lidvid)
+        if name not in actual and not verification.errors:
+            verification.missing_labels.append((lidvid, name))
+    return verification
+
+
+def report_verification(verification):
+    '''Method used to log a verification and report a failed verification to maven_status'''
+    if verification.ok:
+        logger.info('Verified %s', verification.summary())
+        return
+    problems = verification.problems()
+    for problem in problems:
+        logger.error(problem)
+    description = '\n'.join(problems[:reported_problem_limit])
+    if len(problems) > reported_problem_limit:
+        description += '\n... {} more'.format(len(problems) - reported_problem_limit)
+    add_status(component_id=MAVEN_SDC_COMPONENT.PDS_ARCHIVER,
+               event_id=MAVEN_SDC_EVENTS.FAIL,
+               summary='PDS bundle verification failed for {}'.format(verification.summary()),
+               description=description)
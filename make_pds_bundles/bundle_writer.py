@@ -0,0 +1,398 @@
+'''
+Writers used to produce the compressed PDS bundle tarballs.
+
+The tar stream is cut into fixed size blocks which are compressed on a pool of
+threads (zlib releases the GIL) and written, in order, as consecutive gzip
+members.  A multi-member gzip file is a valid gzip stream (RFC 1952) so the
+resulting .tgz is readable by stock tar/gzip and by tarfile.
+
+Because every gzip member is independent, a bundle can be truncated at any
+point where a member and a tar entry end together and appended to again.
+ResumableBundle uses this to checkpoint long running bundles and to restart
+them from the last checkpoint.
+'''
+import os
+import gzip
+import json
+import tarfile
+import logging
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+logger = logging.getLogger('maven.make_pds_bundles.bundle_writer.log')
+
+
+class ParallelGzipWriter():
+    '''Write only file object that gzip compresses independent blocks of its input in parallel'''
+
+    def __init__(self, file_name, compression_level=None, threads=None, block_size=None, append_at=None):
+        '''
+        Arguments:
+            file_name - The file to write
+            compression_level - The gzip compression level (defaults to config.bundle_compression_level)
+            threads - The number of compression threads (defaults to config.bundle_compression_threads)
+            block_size - The number of uncompressed bytes per gzip member (defaults to config.bundle_compression_block_size)
+            append_at - Optional (compressed offset, uncompressed offset) of a gzip member boundary in an
+                        existing file to truncate to and continue writing from
+        '''
+        self.name = file_name
+        self.compression_level = compression_level if compression_level is not None else config.bundle_compression_level
+        self.threads = max(1, threads if threads is not None else config.bundle_compression_threads)
+        self.block_size = block_size if block_size is not None else config.bundle_compression_block_size
+        self.closed = False
+        if append_at is None:
+            self.offset = 0
+            self.fileobj = open(file_name, 'wb')
+        else:
+            compressed_offset, self.offset = append_at
+            self.fileobj = open(file_name, 'r+b')
+            self.fileobj.truncate(compressed_offset)
+            self.fileobj.seek(compressed_offset)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.members_written = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.offset += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        '''Returns the number of uncompressed bytes written'''
+        return self.offset
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compression_level, mtime=0))
+        # bound the memory held by blocks in flight
+        while len(self.pending) > 2 * self.threads:
+            self._write_member(self.pending.popleft().result())
+
+    def _write_member(self, member):
+        self.fileobj.write(member)
+        self.members_written += 1
+
+    def flush(self):
+        '''Compresses any buffered data and writes every outstanding gzip member'''
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_member(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def sync(self):
+        '''Ends the current gzip member and forces everything written to disk
+        Returns:
+            The (compressed offset, uncompressed offset) of the end of the written data
+        '''
+        self.flush()
+        os.fsync(self.fileobj.fileno())
+        return self.fileobj.tell(), self.offset
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self.fileobj.tell() == 0:
+                # always produce a valid (empty) gzip stream
+                self._write_member(gzip.compress(b'', self.compression_level, mtime=0))
+        finally:
+            self.closed = True
+            self.executor.shutdown()
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+@contextmanager
+def open_bundle(tarfile_name, compression_level=None, compression_threads=None):
+    '''Context manager used to open a PDS bundle tarball for writing
+    Arguments:
+        tarfile_name - The fully qualified name of the .tgz to write
+        compression_level - The gzip compression level (defaults to config.bundle_compression_level)
+        compression_threads - The number of compression threads (defaults to config.bundle_compression_threads)
+    Returns:
+        An open tarfile.TarFile that writes through a ParallelGzipWriter
+    '''
+    with ParallelGzipWriter(tarfile_name, compression_level, compression_threads) as writer:
+        logger.debug('Writing %s at level %s on %s threads', tarfile_name, writer.compression_level, writer.threads)
+        with tarfile.open(fileobj=writer, mode='w') as tar_file:
+            yield tar_file
+
+
+def volume_file_name(tarfile_name, volume):
+    '''Method used to get the name of a volume of a multi-volume bundle.  The volume number is
+    appended to the data type of the bundle name, e.g. iuv-pds_bundle-001_<start>_<end>.tgz.1
+    Arguments:
+        tarfile_name - The fully qualified name of the bundle
+        volume - The zero based volume index
+    '''
+    directory, name = os.path.split(tarfile_name)
+    prefix, data_type, remainder = name.split('_', 2)
+    return os.path.join(directory, '{0}_{1}-{2:03d}_{3}'.format(prefix, data_type, volume + 1, remainder))
+
+
+def checkpoint_file_name(tarfile_name):
+    '''Method used to get the name of the checkpoint journal of a bundle'''
+    return tarfile_name + config.bundle_checkpoint_suffix
+
+
+def has_checkpoint(tarfile_name):
+    '''Returns True if the bundle was interrupted and can be resumed'''
+    return os.path.isfile(checkpoint_file_name(tarfile_name))
+
+
+class ResumableBundle():
+    '''A bundle written with a checkpoint journal so that an interrupted run can be resumed.
+
+    The journal (<bundle>.checkpoint) is a file of JSON lines.  The first line describes the bundle
+    and is followed by a line for each member added and a checkpoint line each time the gzip stream
+    is synced to disk.  Members are only trusted once a checkpoint follows them.  On restart the
+    volume being written is truncated to its last checkpoint, its tar entries are checked against
+    the journal and the bundle continues from there; if anything doesn't match (including a change
+    to a bundled file) the bundle is started over.  The journal is removed once the bundle is complete.
+
+    If volume_size is provided, the bundle is split into volumes (see volume_file_name) that are
+    started once the current volume holds volume_size uncompressed bytes.
+    '''
+
+    def __init__(self, tarfile_name, bundle_files, compression_level=None, compression_threads=None,
+                 volume_size=None, checkpoint_interval=None):
+        '''
+        Arguments:
+            tarfile_name - The fully qualified name of the bundle
+            bundle_files - The fully qualified names of the files destined for the bundle
+            compression_level - The gzip compression level (defaults to config.bundle_compression_level)
+            compression_threads - The number of compression threads (defaults to config.bundle_compression_threads)
+            volume_size - Optional number of uncompressed bytes after which a new volume is started
+            checkpoint_interval - The number of uncompressed bytes between checkpoints (defaults to config.bundle_checkpoint_interval)
+        '''
+        self.tarfile_name = tarfile_name
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.volume_size = volume_size
+        self.checkpoint_interval = checkpoint_interval if checkpoint_interval is not None else config.bundle_checkpoint_interval
+        self.checkpoint_file = checkpoint_file_name(tarfile_name)
+        self.volume_files = []
+        self.resumed_members = {}
+        self.volume = 0
+        self.writer = None
+        self.tar_file = None
+        self.last_checkpoint = 0
+
+        resume_at = self._load_checkpoint(set(bundle_files))
+        if resume_at is None:
+            self.journal = open(self.checkpoint_file, 'w')
+            self._journal({'bundle_file': tarfile_name,
+                           'volume_size': volume_size}, sync=True)
+        else:
+            logger.info('Resuming %s from volume %s with %s members', tarfile_name, self.volume, len(self.resumed_members))
+            self._rewrite_journal()
+            self.journal = open(self.checkpoint_file, 'a')
+            if resume_at[0] > 0:
+                self._open_volume(append_at=resume_at)
+
+    def volume_file_name(self, volume):
+        '''Returns the name of a volume of this bundle'''
+        if self.volume_size is None:
+            return self.tarfile_name
+        return volume_file_name(self.tarfile_name, volume)
+
+    def _load_checkpoint(self, bundle_files):
+        '''Method used to restore the state of an interrupted bundle from its journal.
+        Returns:
+            The (compressed offset, uncompressed offset) to resume the current volume from
+            or None if the bundle has to be started over
+        '''
+        if not os.path.isfile(self.checkpoint_file):
+            return None
+        records = []
+        with open(self.checkpoint_file, 'r') as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # torn write at the time of the interruption
+                    break
+
+        resume_at = None
+        if len(records) > 0 and records[0].get('volume_size') == self.volume_size:
+            resume_at = self._restore(records[1:], bundle_files)
+        # the members journaled after the last checkpoint are added again
+        checkpoints = [i for i, record in enumerate(records) if 'checkpoint' in record]
+        self.journal_records = records[:checkpoints[-1] + 1] if checkpoints else records[:1]
+        if resume_at is None:
+            logger.info('Unable to resume %s, starting over', self.tarfile_name)
+            for volume_file in set(r['volume_file'] for r in records if 'volume_file' in r):
+                if os.path.isfile(volume_file):
+                    os.remove(volume_file)
+            self.volume_files = []
+            self.resumed_members = {}
+            self.volume = 0
+        return resume_at
+
+    def _restore(self, records, bundle_files):
+        '''Method used to replay the journal records and verify the bundle against them'''
+        volumes = {}
+        volume_members = {}
+        pending = []
+        for record in records:
+            if 'checkpoint' not in record:
+                pending.append(record)
+                continue
+            volumes[record['volume']] = record
+            volume_members.setdefault(record['volume'], []).extend(pending)
+            pending = []
+
+        members = [m for v in sorted(volume_members) for m in volume_members[v]]
+        for member in members:
+            if member['file_name'] not in bundle_files or not os.path.isfile(member['file_name']):
+                return None
+            stat_result = os.stat(member['file_name'])
+            if stat_result.st_size != member['size'] or stat_result.st_mtime != member['mtime']:
+                logger.info('%s changed since it was bundled', member['file_name'])
+                return None
+
+        # volumes are written in order, every volume but the last must be complete
+        for volume in range(len(volumes)):
+            checkpoint = volumes.get(volume)
+            if checkpoint is None or not os.path.isfile(checkpoint['volume_file']):
+                return None
+            if volume < len(volumes) - 1 and not checkpoint['complete']:
+                return None
+            if checkpoint['complete'] and os.path.getsize(checkpoint['volume_file']) != checkpoint['compressed_offset']:
+                return None
+
+        self.volume_files = [volumes[v]['volume_file'] for v in range(len(volumes))]
+        self.resumed_members = dict((m['file_name'], m['checksum']) for m in members)
+        if len(volumes) == 0:
+            return (0, 0)
+        last = volumes[len(volumes) - 1]
+        if last['complete']:
+            self.volume = len(volumes)
+            return (0, 0)
+
+        # verify the partial volume up to its last checkpoint
+        self.volume = len(volumes) - 1
+        if os.path.getsize(last['volume_file']) < last['compressed_offset']:
+            return None
+        with open(last['volume_file'], 'r+b') as volume_file:
+            volume_file.truncate(last['compressed_offset'])
+        try:
+            with tarfile.open(last['volume_file'], 'r:gz') as partial:
+                names = partial.getnames()
+                # the end of the last entry read is the resume point
+                if partial.offset != last['uncompressed_offset']:
+                    return None
+        except (tarfile.TarError, OSError, EOFError):
+            return None
+        if names != [m['arcname'] for m in volume_members.get(self.volume, [])]:
+            return None
+        self.volume_files.pop()
+        return (last['compressed_offset'], last['uncompressed_offset'])
+
+    def _rewrite_journal(self):
+        '''Method used to cut the journal back to its last checkpoint before it is appended to, so the
+        members added again aren't journaled twice and a torn last line doesn't hide the new records'''
+        with open(self.checkpoint_file + '.tmp', 'w') as journal:
+            for record in self.journal_records:
+                journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def _journal(self, record, sync=False):
+        self.journal.write(json.dumps(record) + '\n')
+        if sync:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def _open_volume(self, append_at=None):
+        volume_file = self.volume_file_name(self.volume)
+        self.writer = ParallelGzipWriter(volume_file, self.compression_level, self.compression_threads, append_at=append_at)
+        self.tar_file = tarfile.open(fileobj=self.writer, mode='w')
+        self.volume_files.append(volume_file)
+        self.last_checkpoint = self.writer.tell()
+        logger.debug('Writing %s at level %s on %s threads', volume_file, self.writer.compression_level, self.writer.threads)
+
+    def _checkpoint(self, complete=False):
+        compressed_offset, uncompressed_offset = self.writer.sync()
+        self._journal({'checkpoint': True,
+                       'volume': self.volume,
+                       'volume_file': self.writer.name,
+                       'compressed_offset': compressed_offset,
+                       'uncompressed_offset': uncompressed_offset,
+                       'complete': complete}, sync=True)
+        self.last_checkpoint = uncompressed_offset
+
+    def _close_volume(self):
+        self.tar_file.close()
+        self._checkpoint(complete=True)
+        self.writer.close()
+        self.tar_file, self.writer = None, None
+        self.volume += 1
+
+    def resumed_checksum(self, file_name):
+        '''Returns the checksum of a file bundled before the bundle was resumed or None'''
+        return self.resumed_members.get(file_name)
+
+    def add(self, file_name, add_function, *args):
+        '''Method used to add a file to the bundle
+        Arguments:
+            file_name - The fully qualified name of the file to add
+            add_function - f(tar_file, file_name, *args) that adds the file to the open tar and returns its ChecksumData
+        Returns:
+            The result of add_function
+        '''
+        if self.tar_file is None:
+            self._open_volume()
+        stat_result = os.stat(file_name)
+        checksum_data = add_function(self.tar_file, file_name, *args)
+        self._journal({'volume': self.volume,
+                       'file_name': file_name,
+                       'arcname': self.tar_file.members[-1].name,
+                       'size': stat_result.st_size,
+                       'mtime': stat_result.st_mtime,
+                       'checksum': checksum_data.checksum})
+
+        if self.volume_size is not None and self.writer.tell() >= self.volume_size:
+            self._close_volume()
+        elif self.writer.tell() - self.last_checkpoint >= self.checkpoint_interval:
+            self._checkpoint()
+        return checksum_data
+
+    def close(self):
+        '''Method used to complete the bundle and remove its journal'''
+        if self.tar_file is None and len(self.volume_files) == 0:
+            self._open_volume()  # an empty bundle
+        if self.tar_file is not None:
+            self._close_volume()
+        self.journal.close()
+        os.remove(self.checkpoint_file)
+        logger.info('Completed %s in %s volume(s)', self.tarfile_name, len(self.volume_files))
+
+    def abort(self):
+        '''Method used to stop writing the bundle, leaving it to be resumed'''
+        if self.writer is not None:
+            self.writer.close()
+        self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
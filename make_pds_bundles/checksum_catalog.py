@@ -0,0 +1,93 @@
+'''
+Persistent catalog of the checksums of bundled files.
+
+Entries are keyed on the fully qualified file name and are only trusted while
+the file's size and mtime still match, so files carried over from a prior PDS
+delivery are not rehashed.  A random sample of trusted entries can be
+recomputed to catch silent corruption.
+'''
+import random
+import logging
+
+from maven_database import db_session
+from maven_database.models import FileChecksum
+from maven_status import MAVEN_SDC_EVENTS, MAVEN_SDC_COMPONENT
+from maven_status.status import add_status
+from maven_utilities import time_utilities
+
+logger = logging.getLogger('maven.make_pds_bundles.checksum_catalog.log')
+
+# Number of file names per IN clause when loading catalog entries
+lookup_batch_size = 500
+
+
+class ChecksumCatalog():
+    '''Checksum catalog entries for a set of files'''
+
+    def __init__(self, file_names, verify_fraction=0.0):
+        '''
+        Arguments:
+            file_names - The fully qualified names of the files whose entries are loaded
+            verify_fraction - The fraction [0,1] of trusted entries to recompute
+        '''
+        self.verify_fraction = verify_fraction
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = []
+        file_names = list(file_names)
+        for i in range(0, len(file_names), lookup_batch_size):
+            for entry in FileChecksum.query.filter(FileChecksum.file_path.in_(file_names[i:i + lookup_batch_size])):
+                self.entries[entry.file_path] = entry
+
+    def get(self, file_name, stat_result):
+        '''Returns the FileChecksum for the file if its stat signature still matches, None otherwise'''
+        entry = self.entries.get(file_name)
+        if entry is not None and entry.matches(stat_result):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def should_verify(self):
+        '''Returns True if a trusted entry should be recomputed'''
+        return self.verify_fraction > 0 and random.random() < self.verify_fraction
+
+    def update(self, file_name, stat_result, content_size, content_md5):
+        '''Records a freshly computed checksum.  If the file has a trusted entry with a
+        different checksum (i.e. a verification failure) the mismatch is reported.
+        '''
+        entry = self.entries.get(file_name)
+        if entry is None:
+            entry = FileChecksum(file_path=file_name,
+                                 file_size=stat_result.st_size,
+                                 mod_time=stat_result.st_mtime,
+                                 content_size=content_size,
+                                 content_md5=content_md5)
+            db_session.add(entry)
+            self.entries[file_name] = entry
+            return
+
+        if entry.matches(stat_result) and entry.content_md5 != content_md5:
+            self.report_mismatch(file_name, entry.content_md5, content_md5)
+
+        entry.file_size = stat_result.st_size
+        entry.mod_time = stat_result.st_mtime
+        entry.content_size = content_size
+        entry.content_md5 = content_md5
+        entry.computed_at = time_utilities.utc_now()
+
+    def report_mismatch(self, file_name, cataloged_md5, computed_md5):
+        '''Reports a file whose content changed without its stat signature changing'''
+        desc = 'Checksum of {} changed from {} to {} without a change in size or mtime'.format(file_name, cataloged_md5, computed_md5)
+        logger.error(desc)
+        self.mismatches.append(file_name)
+        add_status(component_id=MAVEN_SDC_COMPONENT.PDS_ARCHIVER,
+                   event_id=MAVEN_SDC_EVENTS.FAIL,
+                   summary='Checksum catalog mismatch for {}'.format(file_name),
+                   description=desc)
+
+    def commit(self):
+        '''Persists the updated entries'''
+        logger.info('Checksum catalog hits %s misses %s mismatches %s', self.hits, self.misses, len(self.mismatches))
+        db_session.commit()
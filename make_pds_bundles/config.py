@@ -3,7 +3,7 @@ Created on Mar 3, 2015
 
 @author: bstaley
 '''
-
+import os
 from collections import namedtuple
 
 
@@ -982,3 +982,39 @@ instrument_dictionary = {
                  'urn:nasa:pds:maven.swia.calibrated:data.onboard_svy_spec': 'mvn_swi_l2_onboardsvyspec'}}}
 
 filename_time_format = '%Y-%m-%d-%H-%M-%S'
+
+# PDS bundle compression (see bundle_writer.ParallelGzipWriter)
+bundle_compression_level = 9
+bundle_compression_threads = os.cpu_count() or 1
+bundle_compression_block_size = 16 * 1024 * 1024
+
+# Read size used when checksumming files outside of the tar stream
+checksum_chunk_size = 1024 * 1024
+
+# Fraction of checksum catalog entries recomputed by --verify
+checksum_verify_fraction = 0.01
+
+# If True, InventoryFileFinder matches inventories with a temporary table join in the database
+# instead of merging the inventory with the ordered query results
+inventory_sql_join = False
+
+# Resumable PDS bundles (see bundle_writer.ResumableBundle).  A checkpoint is taken every
+# bundle_checkpoint_interval uncompressed bytes; bundle_volume_size (bytes, None for a single
+# volume) caps the uncompressed size of each volume of a bundle.
+bundle_checkpoint_interval = 256 * 1024 * 1024
+bundle_checkpoint_suffix = '.checkpoint'
+bundle_volume_size = None
+
+# Bundle size estimates (see estimate.py).  The fraction of files per instrument/extension
+# that are compressed and the number of bytes used to benchmark the host if nothing is sampled.
+estimate_sample_fraction = 0.01
+estimate_benchmark_size = 32 * 1024 * 1024
+
+# Post-bundle verification (see bundle_verifier.py).  Bundles are checked against their
+# manifests after they are written unless verify_bundles is False (or --skip-bundle-verify is
+# given).  Every bundle is read and decompressed again, which can double the run time.
+# bundle_verify_threads volumes are verified at once and each reader runs at most
+# bundle_verify_queue_depth chunks ahead.
+verify_bundles = True
+bundle_verify_threads = max(1, (os.cpu_count() or 1) // 2)
+bundle_verify_queue_depth = 8
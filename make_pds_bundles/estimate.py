@@ -0,0 +1,215 @@
+'''
+Estimates of the size and generation time of PDS bundles.
+
+A fraction of the files of each (instrument, extension) is read, hashed and
+compressed at the bundle compression level.  The measured ratios are
+extrapolated to every file of the group and the measured read, hash and
+compression throughputs are used to estimate the wall time of the bundle.
+'''
+import os
+import time
+import zlib
+import random
+import hashlib
+import logging
+import tarfile
+from gzip import GzipFile
+
+from maven_utilities.utilities import is_compressed_format
+from . import config
+
+logger = logging.getLogger('maven.make_pds_bundles.estimate.log')
+
+# Approximate tar overhead of a member: its header plus, on average, half a block of padding
+tar_member_overhead = tarfile.BLOCKSIZE + tarfile.BLOCKSIZE // 2
+
+
+class SampleMeasurement():
+    '''Running totals of the sampled files of a group'''
+
+    def __init__(self):
+        self.files = 0
+        self.missing = 0
+        self.file_size = 0
+        self.content_size = 0
+        self.compressed_size = 0
+        self.read_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.compress_seconds = 0.0
+
+    def add(self, other):
+        for attribute in vars(self):
+            setattr(self, attribute, getattr(self, attribute) + getattr(other, attribute))
+
+    def rate(self, seconds):
+        '''Returns the content bytes per second for the provided duration or None if nothing was measured'''
+        return self.content_size / seconds if self.content_size and seconds > 0 else None
+
+
+def measure_file(file_name, compression_level, chunk_size=None):
+    '''Method used to read, hash and compress a file the way it would be bundled.  Compressed
+    inputs are measured on their decompressed contents.
+    Arguments:
+        file_name - The fully qualified name of the file to measure
+        compression_level - The gzip compression level
+        chunk_size - The read size (defaults to config.checksum_chunk_size)
+    Returns:
+        A SampleMeasurement of the file
+    '''
+    chunk_size = chunk_size or config.checksum_chunk_size
+    measurement = SampleMeasurement()
+    measurement.file_size = os.path.getsize(file_name)
+    md5 = hashlib.md5()
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    opener = GzipFile if is_compressed_format(file_name) else open
+    with opener(file_name, 'rb') as f:
+        while True:
+            started = time.perf_counter()
+            chunk = f.read(chunk_size)
+            measurement.read_seconds += time.perf_counter() - started
+            if not chunk:
+                break
+            measurement.content_size += len(chunk)
+
+            started = time.perf_counter()
+            md5.update(chunk)
+            measurement.hash_seconds += time.perf_counter() - started
+
+            started = time.perf_counter()
+            measurement.compressed_size += len(compressor.compress(chunk))
+            measurement.compress_seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    measurement.compressed_size += len(compressor.flush())
+    measurement.compress_seconds += time.perf_counter() - started
+    measurement.files = 1
+    return measurement
+
+
+def benchmark(compression_level, size=None):
+    '''Method used to measure the hash and compression throughput of the host on synthetic data
+    Arguments:
+        compression_level - The gzip compression level
+        size - The number of bytes to process (defaults to config.estimate_benchmark_size)
+    Returns:
+        A SampleMeasurement of the synthetic data (read times are not measured)
+    '''
+    size = size or config.estimate_benchmark_size
+    # half random, half repetitive so the data is neither incompressible nor trivial
+    block = random.Random(0).getrandbits(8 * 4096).to_bytes(4096, 'little') + b'MAVEN SDC PDS ' * 292
+    data = (block * (size // len(block) + 1))[:size]
+    measurement = SampleMeasurement()
+    measurement.content_size = len(data)
+
+    started = time.perf_counter()
+    hashlib.md5(data).hexdigest()
+    measurement.hash_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    measurement.compressed_size = len(zlib.compress(data, compression_level))
+    measurement.compress_seconds = time.perf_counter() - started
+    return measurement
+
+
+def estimate_seconds(content_size, throughput, compression_threads):
+    '''Method used to estimate the wall time to bundle content_size bytes.  Files are read and
+    hashed in turn while compression runs on compression_threads threads, so the slower of the
+    two stages bounds the bundle.
+    Arguments:
+        content_size - The number of uncompressed bytes bundled
+        throughput - The SampleMeasurement whose rates are used
+        compression_threads - The number of compression threads
+    Returns:
+        The estimated seconds or None if the rates are unknown
+    '''
+    read_rate = throughput.rate(throughput.read_seconds)
+    hash_rate = throughput.rate(throughput.hash_seconds)
+    compress_rate = throughput.rate(throughput.compress_seconds)
+    if hash_rate is None or compress_rate is None:
+        return None
+    reader_seconds = content_size / hash_rate + (content_size / read_rate if read_rate else 0.0)
+    return max(reader_seconds, content_size / (compress_rate * compression_threads))
+
+
+class BundleEstimator():
+    '''Accumulates the files of an instrument bundle and estimates its size per file extension'''
+
+    def __init__(self, sample_fraction=None, compression_level=None, rng=None):
+        '''
+        Arguments:
+            sample_fraction - The fraction [0,1] of the files of each extension to measure (defaults to config.estimate_sample_fraction)
+            compression_level - The gzip compression level (defaults to config.bundle_compression_level)
+            rng - Optional random.Random used to choose the samples
+        '''
+        self.sample_fraction = sample_fraction if sample_fraction is not None else config.estimate_sample_fraction
+        self.compression_level = compression_level if compression_level is not None else config.bundle_compression_level
+        self.rng = rng or random.Random()
+        self.groups = {}
+
+    def add(self, file_name, file_size, extension):
+        '''Method used to add a file to the bundle.  Each file is sampled with probability
+        sample_fraction; the first file of an extension is kept in case none are sampled.'''
+        group = self.groups.setdefault(extension, {'files': 0, 'file_size': 0, 'samples': [], 'first': file_name})
+        group['files'] += 1
+        group['file_size'] += file_size or 0
+        if self.rng.random() < self.sample_fraction:
+            group['samples'].append(file_name)
+
+    def add_file(self, file_name):
+        '''Method used to add a file to the bundle by name.  The size is read from the filesystem and
+        compressed files are grouped by the extension of their contents.'''
+        try:
+            file_size = os.path.getsize(file_name)
+            compressed = is_compressed_format(file_name)
+        except (IOError, OSError):
+            file_size, compressed = None, False
+        content_name = os.path.splitext(file_name)[0] if compressed else file_name
+        self.add(file_name, file_size, os.path.splitext(content_name)[1].lstrip('.'))
+
+    def measure(self):
+        '''Method used to measure the samples of each extension
+        Returns:
+            {extension: SampleMeasurement}
+        '''
+        measurements = {}
+        for extension, group in self.groups.items():
+            measurement = SampleMeasurement()
+            for file_name in group['samples'] or [group['first']]:
+                try:
+                    measurement.add(measure_file(file_name, self.compression_level))
+                except (IOError, OSError, EOFError) as e:
+                    logger.warning('Unable to sample %s : %s', file_name, str(e))
+                    measurement.missing += 1
+            measurements[extension] = measurement
+        return measurements
+
+    def estimate(self, measurements):
+        '''Method used to extrapolate the measured samples to every file of each extension
+        Arguments:
+            measurements - The {extension: SampleMeasurement} from measure
+        Returns:
+            {extension: estimate dictionary}
+        '''
+        estimates = {}
+        for extension, group in self.groups.items():
+            measurement = measurements[extension]
+            estimate = {'files': group['files'],
+                        'file_size': group['file_size'],
+                        'sampled_files': measurement.files,
+                        'missing_samples': measurement.missing,
+                        'estimated_content_size': None,
+                        'estimated_compressed_size': None,
+                        'compression_ratio': None}
+            # scale the samples by the cataloged bytes, or by the file count if sizes were not cataloged
+            if group['file_size'] > 0 and measurement.file_size > 0:
+                scale = group['file_size'] / measurement.file_size
+            elif measurement.files > 0:
+                scale = group['files'] / measurement.files
+            else:
+                scale = None
+            if scale is not None:
+                estimate['estimated_content_size'] = int(measurement.content_size * scale + group['files'] * tar_member_overhead)
+                estimate['estimated_compressed_size'] = int(measurement.compressed_size * scale)
+                if measurement.content_size > 0:
+                    estimate['compression_ratio'] = measurement.compressed_size / measurement.content_size
+            estimates[extension] = estimate
+        return estimates
@@ -7,15 +7,22 @@ import os
 import re
 import datetime
 import operator
+import itertools
 import logging
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, Table, MetaData, Column, String, Integer
 
-from . import utilities
-from maven_database.models import ScienceFilesMetadata
+from . import utilities, config
+from maven_database.models import ScienceFilesMetadata, file_root_base_name
 from maven_utilities import time_utilities
 
 logger = logging.getLogger('maven.make_pds_bundles.make_pds_bundles.file_finder.log')
 
+# Strips the .<ext> from a science_files_metadata file_root
+base_name_regex = re.compile(r'\..+$')
+
+# Temporary table used by InventoryFileFinder when matching in the database
+inventory_table_name = 'pds_inventory_entries'
+
 
 class InventoryFileFinder():
     '''Generator class used to find PDS destined data files based on a PDS inventory file of the form:
@@ -50,7 +57,11 @@ class InventoryFileFinder():
                                 'revision')
                                 
     acc_inv_regex = re.compile(acc_inv_pattern)
-    
+
+    timetag_regex = re.compile(r'(?P<YYYYMMDD>[\d]{8})t(?P<HHMMSS>[\d]{6})')
+
+    # Number of science_files_metadata rows fetched per round trip
+    yield_per = 1000
 
     def __init__(self,
                  inv_file,
@@ -61,7 +72,8 @@ class InventoryFileFinder():
                  results_version=None,
                  results_revision=None,
                  missing_file_handler=None,
-                 uprev_inv_file=False):
+                 uprev_inv_file=False,
+                 sql_join=None):
         '''Constructor
         Arguments:
             inv_file : The inventory file to use
@@ -72,6 +84,7 @@ class InventoryFileFinder():
             results_revision : Inventory revision filter (only applied to files found in the inventory)
             missing_file_handler : f(x) for missing files
             uprev_inv_file : If true, increment the revision of the files found in the inventory by 1
+            sql_join : If true, match the inventory in the database using a temporary table (defaults to config.inventory_sql_join)
         '''
 
         self.inv_file = inv_file
@@ -83,101 +96,82 @@ class InventoryFileFinder():
         self.from_dt = results_from_dt
         self.to_dt = results_to_dt
         self.missing_file_handler = missing_file_handler if missing_file_handler else lambda x: None
+        self.sql_join = sql_join if sql_join is not None else config.inventory_sql_join
 
-    # pylint: disable=R0915
-    def generate(self):
-        '''Method used to generate Science Data Files
-        Yields:
-            Fully qualified paths to Science Data Files.
+    def parse_inventory_line(self, line):
+        '''Helper method used to parse a Inventory line
+        Arguments:
+            line : The next line to parse
+        Returns:
+            (base_name,version,revision,start_date)
         '''
 
-        def parse_inventory_line(line):
-            '''Helper method used to parse a Inventory line
-            Arguments:
-                line : The next line to parse
-            Returns:
-                (base_name,version,revision)
-            '''
-            
-            m = self.inv_regex.match(line)
-            if m is None:
-                m = self.acc_inv_regex.match(line)
-            
-            if m is None:
-                raise ValueError("{0} doesn't meet regex {1}".format(line, self.inv_pattern))
-
-            try:
-                base_name = re.sub(r'(?P<YYYYMMDD>[\d]{8})t(?P<HHMMSS>[\d]{6})',
-                                   r'\g<YYYYMMDD>T\g<HHMMSS>', m.group('base'))
-
-                time_string = re.search(r'(?P<YYYYMMDD>[\d]{8})T(?P<HHMMSS>[\d]{6})',
-                                       base_name)
-
-                start_date = time_utilities.to_utc_tz(datetime.datetime.strptime(time_string.group(0), '%Y%m%dt%H%M%S'))
-            except:
-                time_string = re.search(r'(?P<YYYYMMDD>[\d]{8})', base_name)
-                start_date = time_utilities.to_utc_tz(datetime.datetime.strptime(time_string.group(0), '%Y%m%d'))
-
-            version = int(m.group('version'))
-            revision = int(m.group('revision'))
-            
-            if self.uprev_inv_file:
-                revision = revision+1
-
-            return base_name, version, revision, start_date
-
-        def compare(sfmd, inv_tuple, ver, rev):
-            '''Method used to compare a ScienceFileMetadata object and a inventory tuple
-            Arguments:
-                sfmd - The ScienceFileMetadata object to compare
-                ivn_tuple - The inventory tuple (base_name,(version,revision))
-                ver - Version override
-                rev - Revision override
-            Returns:
-                -1 if sfmd < inv_tuple, 1 if sfmd > inv_tuple 0 if sfmd == inv_tuple
-            '''
-            sfmd_base_name = re.sub(r'\..+$', r'', sfmd.file_root)
-            inv_ver_rev = (ver if ver is not None else inv_tuple[1][0],
-                           rev if rev is not None else inv_tuple[1][1])
-
-            def _cmp(a, b):
-                return (a > b) - (a < b)
-
-            return _cmp((sfmd_base_name, (sfmd.version, sfmd.revision)),
-                       (inv_tuple[0], inv_ver_rev))
+        m = self.inv_regex.match(line)
+        if m is None:
+            m = self.acc_inv_regex.match(line)
 
-        logger.info("Processing inventory file :%s", self.inv_file)
+        if m is None:
+            raise ValueError("{0} doesn't meet regex {1}".format(line, self.inv_pattern))
 
-        if not os.path.isfile(self.inv_file):
-            err_msg = "{0} wasn't found on the file system!".format(self.inv_file)
-            logger.error(err_msg)
-            return
+        try:
+            base_name = self.timetag_regex.sub(r'\g<YYYYMMDD>T\g<HHMMSS>', m.group('base'))
 
-        inv_entries = []
-        # ingest inventory file into
-        with open(self.inv_file, 'r') as inv_file:
+            time_string = re.search(r'(?P<YYYYMMDD>[\d]{8})T(?P<HHMMSS>[\d]{6})',
+                                    base_name)
+
+            start_date = time_utilities.to_utc_tz(datetime.datetime.strptime(time_string.group(0), '%Y%m%dt%H%M%S'))
+        except:
+            time_string = re.search(r'(?P<YYYYMMDD>[\d]{8})', base_name)
+            start_date = time_utilities.to_utc_tz(datetime.datetime.strptime(time_string.group(0), '%Y%m%d'))
+
+        version = int(m.group('version'))
+        revision = int(m.group('revision'))
 
-            while True:
-                next_inv_line = inv_file.readline()
+        if self.uprev_inv_file:
+            revision = revision + 1
 
-                if not next_inv_line:
-                    break
+        return base_name, version, revision, start_date
 
+    def read_inventory(self):
+        '''Method used to read and sort the inventory file
+        Returns:
+            A sorted list of (base_name,(version,revision),start_date)
+        '''
+        inv_entries = []
+        with open(self.inv_file, 'r') as inv_file:
+            for next_inv_line in inv_file:
                 try:
-                    next_inv = parse_inventory_line(next_inv_line)
+                    base_name, version, revision, start_date = self.parse_inventory_line(next_inv_line)
                 except ValueError:
                     logger.warning("The line [%s] doesn't appear to be an inventory entry.  Skipping inventory file :%s ", next_inv_line, self.inv_file)
                     continue
-
-                base_name, version, revision, start_date = next_inv
-
                 inv_entries.append((base_name, (version, revision), start_date))
         inv_entries.sort()
-        if len(inv_entries) == 0:
-            logger.warning('No inventory entries found')
-            return
-        # query db to find file existence/location
-        query = ScienceFilesMetadata.query.filter(operator.ge(ScienceFilesMetadata.file_root, inv_entries[0][0]))
+        return inv_entries
+
+    def inventory_key(self, inv_entry):
+        '''Returns the (base_name,(version,revision)) an inventory entry is matched on, applying the version/revision overrides'''
+        return (inv_entry[0],
+                (self.results_version if self.results_version is not None else inv_entry[1][0],
+                 self.results_revision if self.results_revision is not None else inv_entry[1][1]))
+
+    def in_time_range(self, inv_entry):
+        '''Returns True if the inventory entry is within the results time range'''
+        return inv_entry[2] > self.from_dt and inv_entry[2] < self.to_dt
+
+    def build_query(self, inv_entries):
+        '''Method used to build the science_files_metadata query for the inventory
+        Arguments:
+            inv_entries : The sorted inventory entries
+        Returns:
+            A query of (file_root,version,revision,directory_path,file_name) ordered by file_root/absolute_version
+        '''
+        query = ScienceFilesMetadata.query.with_entities(ScienceFilesMetadata.file_root,
+                                                         ScienceFilesMetadata.version,
+                                                         ScienceFilesMetadata.revision,
+                                                         ScienceFilesMetadata.directory_path,
+                                                         ScienceFilesMetadata.file_name)
+        query = query.filter(operator.ge(ScienceFilesMetadata.file_root, inv_entries[0][0]))
 
         query = query.filter(operator.le(ScienceFilesMetadata.file_root, inv_entries[-1][0] + 'Z'))  # the Z is a bit of a hack to find the last entry (db file_root has .<ext>)
         ext_filter = []
@@ -191,47 +185,128 @@ class InventoryFileFinder():
         if self.results_version:
             query = query.filter(ScienceFilesMetadata.version == self.results_version)
         query = query.filter(ScienceFilesMetadata.timetag >= self.from_dt,
-                                ScienceFilesMetadata.timetag < self.to_dt)
+                             ScienceFilesMetadata.timetag < self.to_dt)
         # order by families alphabetically descending version/revision
-        query = query.order_by(ScienceFilesMetadata.file_root, ScienceFilesMetadata.absolute_version)
-        next_inv_entry = inv_entries.pop(0)
+        return query.order_by(ScienceFilesMetadata.file_root, ScienceFilesMetadata.absolute_version)
 
-        missing_inv = []
-        
-        # Verify that there is at least one result in the query, otherwise we won't enter the loop below (and therefore no errors will pop up).   
-        test_query = query.first()
-        if not test_query:
+    def generate(self):
+        '''Method used to generate Science Data Files
+        Yields:
+            Fully qualified paths to Science Data Files.
+        '''
+        logger.info("Processing inventory file :%s", self.inv_file)
+
+        if not os.path.isfile(self.inv_file):
+            err_msg = "{0} wasn't found on the file system!".format(self.inv_file)
+            logger.error(err_msg)
+            return
+
+        inv_entries = self.read_inventory()
+        if len(inv_entries) == 0:
+            logger.warning('No inventory entries found')
+            return
+
+        query = self.build_query(inv_entries)
+
+        # Verify that there is at least one result in the query, otherwise no errors will pop up.
+        if not query.first():
             logger.warning("There were no files on the SDC that matched this data type and time range!  Make sure that files were actually delivered.")
 
+        missing_inv = []
+        if self.sql_join:
+            matches = self.join_in_db(query, inv_entries, missing_inv)
+        else:
+            matches = self.merge_join(query, inv_entries, missing_inv)
         try:
-            for next_sfmd in query.yield_per(20):
-                if compare(next_sfmd, next_inv_entry, self.results_version, self.results_revision) < 0:  # DB is behind inventory
-                    continue  # process next sfmd
-
-                while compare(next_sfmd, next_inv_entry, self.results_version, self.results_revision) > 0:  # DB is ahead of inventory
-                    if next_inv_entry[2] > self.from_dt and next_inv_entry[2] < self.to_dt: # Determine if file is in the time range we're looking for
-                        logger.warning("The inventory entry %s wasn't found in the SDC!", next_inv_entry[0])
-                        missing_inv.append((next_inv_entry))
-                    next_inv_entry = inv_entries.pop(0)
-
-                if compare(next_sfmd, next_inv_entry, self.results_version, self.results_revision) == 0:
-                    yield os.path.join(next_sfmd.directory_path, next_sfmd.file_name)
-                    next_inv_entry = inv_entries.pop(0)
-
-            # gather remaining inv entries
-            for _next in inv_entries:
-                missing_inv.append(_next)
-            
-
-        except IndexError:  # reached end of next_inv_entry list
-            pass
+            for next_file in matches:
+                yield next_file
         finally:
+            matches.close()
             for _next in missing_inv:
                 self.missing_file_handler(_next)
             if hasattr(query, 'session'):
                 query.session.close()
 
+    def merge_join(self, query, inv_entries, missing_inv):
+        '''Generator that merges the ordered query results with the sorted inventory in a single pass
+        Arguments:
+            query : The query built by build_query
+            inv_entries : The sorted inventory entries
+            missing_inv : List that the in range inventory entries not found in the SDC are appended to
+        Yields:
+            Fully qualified paths to Science Data Files.
+        '''
+        inv_iter = iter(inv_entries)
+        next_inv_entry = next(inv_iter, None)
+        next_inv_key = self.inventory_key(next_inv_entry)
+
+        for file_root, version, revision, directory_path, file_name in query.yield_per(self.yield_per):
+            sfmd_key = (base_name_regex.sub('', file_root), (version, revision))
+
+            while sfmd_key > next_inv_key:  # DB is ahead of inventory
+                if self.in_time_range(next_inv_entry):  # Determine if file is in the time range we're looking for
+                    logger.warning("The inventory entry %s wasn't found in the SDC!", next_inv_entry[0])
+                    missing_inv.append(next_inv_entry)
+                next_inv_entry = next(inv_iter, None)
+                if next_inv_entry is None:  # reached end of the inventory
+                    return
+                next_inv_key = self.inventory_key(next_inv_entry)
+
+            if sfmd_key == next_inv_key:
+                yield os.path.join(directory_path, file_name)
+                next_inv_entry = next(inv_iter, None)
+                if next_inv_entry is None:
+                    return
+                next_inv_key = self.inventory_key(next_inv_entry)
+            # otherwise the DB is behind the inventory, process the next sfmd
+
+        # gather remaining inv entries
+        for _next in itertools.chain([next_inv_entry], inv_iter):
+            if self.in_time_range(_next):
+                missing_inv.append(_next)
+
+    def join_in_db(self, query, inv_entries, missing_inv):
+        '''Generator that bulk loads the inventory into a temporary table and matches it
+        against science_files_metadata with a single join
+        Arguments:
+            query : The query built by build_query
+            inv_entries : The sorted inventory entries
+            missing_inv : List that the in range inventory entries not found in the SDC are appended to
+        Yields:
+            Fully qualified paths to Science Data Files.
+        '''
+        session = query.session
+        connection = session.connection()
+        inv_table = Table(inventory_table_name, MetaData(),
+                          Column('base_name', String, nullable=False),
+                          Column('version', Integer, nullable=False),
+                          Column('revision', Integer, nullable=False),
+                          prefixes=['TEMPORARY'])
+        inv_table.create(bind=connection)
+        try:
+            connection.execute(inv_table.insert(),
+                               [{'base_name': base_name, 'version': version, 'revision': revision}
+                                for base_name, (version, revision) in (self.inventory_key(e) for e in inv_entries)])
+
+            sfmd_base_name = file_root_base_name(connection.dialect.name)
+            query = query.add_columns(inv_table.c.base_name)\
+                         .join(inv_table, and_(sfmd_base_name == inv_table.c.base_name,
+                                               ScienceFilesMetadata.version == inv_table.c.version,
+                                               ScienceFilesMetadata.revision == inv_table.c.revision))
+            matched = set()
+            for _, version, revision, directory_path, file_name, base_name in query.yield_per(self.yield_per):
+                inv_key = (base_name, (version, revision))
+                if inv_key in matched:  # only the first file of a family matches an inventory entry
+                    continue
+                matched.add(inv_key)
+                yield os.path.join(directory_path, file_name)
+        finally:
+            inv_table.drop(bind=connection)
 
+        for next_inv_entry in inv_entries:
+            if self.inventory_key(next_inv_entry) not in matched and self.in_time_range(next_inv_entry):
+                logger.warning("The inventory entry %s wasn't found in the SDC!", next_inv_entry[0])
+                missing_inv.append(next_inv_entry)
 
 
 class ScienceQueryFileFinder():
@@ -17,27 +17,33 @@ Last Revised on Tue Aug 12 12:52 2014
 import hashlib
 import os
 import re
-import tarfile
 import sys
 import json
 import csv
 import imp
+import tempfile
+import traceback
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from gzip import GzipFile
 from dateutil.parser import parse
 import logging
 from maven_utilities import time_utilities, constants
-from maven_utilities.utilities import is_compressed_format
+from maven_utilities.utilities import is_compressed_format, HashingReader
 from maven_status import MAVEN_SDC_EVENTS, MAVEN_SDC_COMPONENT
 from maven_status.status import add_status
-from . import results, utilities, config, archive_progress, file_finder
+from maven_database import db_session
+from maven_ops_database.database import db_session as ops_db_session
+from . import results, utilities, config, archive_progress, file_finder, bundle_writer, bundle_verifier, checksum_catalog, estimate
 
 logger = logging.getLogger('maven.make_pds_bundles.make_pds_bundles.log')
 dry_run_logger = logging.getLogger('maven.make_pds_bundles.make_pds_bundles.dryrunlog')
 direct_out_logger = logging.getLogger('maven.make_pds_bundles.make_pds_bundles.directlog')
 
 ChecksumData = namedtuple('ChecksumData', 'checksum fully_qualified_filename')
+InstrumentArchiveResult = namedtuple('InstrumentArchiveResult', 'record error error_traceback')
+InstrumentFiles = namedtuple('InstrumentFiles', 'bundle_files label_files ancillary_metadata')
 output_file_pattern = re.compile(
     r'([a-zA-Z0-9\-]+)_([a-zA-Z0-9\-]+)_([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})_([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})\.([a-zA-Z]+)(\.([0-9]+)|)')
 
@@ -133,23 +139,58 @@ def print_checksum_manifest(target_dir, checksums, checksum_file):
 
 def get_md5_checksums(files):
     '''
-    Calculates the md5 checksum for each file in the bundle
-    We will want to also generate an output file containing this information.
-    For now, just return a list containing each checksum value
+    Calculates the md5 checksum for each file in the bundle.  Files are read
+    config.checksum_chunk_size bytes at a time.
+    Returns a list containing each checksum value
     '''
     checksum = []  # Initialize list of checksums
     for ifile in files:  # Loop over all files to be bundled
         m = hashlib.md5()  # Initialize the md5 checksum value
-        fd = open(ifile, 'rb')  # Open the current file
-        content = fd.readlines()  # Read each lines in the file(?)
-        fd.close()  # Close the file
-        for eachline in content:
-            m.update(eachline)  # Adds value of each line to checksum for file
+        with open(ifile, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(config.checksum_chunk_size), b''):
+                m.update(chunk)
 
         checksum.append(m.hexdigest())
     return checksum
 
 
+def get_checksum(file_name, catalog=None):
+    '''
+    Returns the md5 checksum of a file, reusing the catalog entry when the file's
+    stat signature is unchanged
+    '''
+    if catalog is None:
+        return get_md5_checksums([file_name])[0]
+    stat_result = os.stat(file_name)
+    cached = catalog.get(file_name, stat_result)
+    if cached is not None and not catalog.should_verify():
+        return cached.content_md5
+    checksum = get_md5_checksums([file_name])[0]
+    catalog.update(file_name, stat_result, stat_result.st_size, checksum)
+    return checksum
+
+
+def add_to_tar(tar_file, file_to_tar, catalog=None):
+    '''
+    Streams a file into the tar through a HashingReader so the checksum is computed
+    from the bytes written to the tar in a single read of the file.  If the catalog
+    holds a checksum for the unchanged file the hashing is skipped.
+    Returns the ChecksumData for the added file
+    '''
+    tar_info = tar_file.gettarinfo(file_to_tar)
+    stat_result = os.stat(file_to_tar)
+    cached = catalog.get(file_to_tar, stat_result) if catalog is not None else None
+    with open(file_to_tar, 'rb') as f:
+        if cached is not None and not catalog.should_verify():
+            tar_file.addfile(tar_info, fileobj=f)
+            return ChecksumData(cached.content_md5, file_to_tar)
+        reader = HashingReader(f)
+        tar_file.addfile(tar_info, fileobj=reader)
+    if catalog is not None:
+        catalog.update(file_to_tar, stat_result, tar_info.size, reader.hexdigest())
+    return ChecksumData(reader.hexdigest(), file_to_tar)
+
+
 def get_instrument_filters(instrument, override_inst_config):
     '''
     Returns a dictionary of filters for the database query. 
@@ -169,6 +210,44 @@ def get_instrument_filters(instrument, override_inst_config):
         instrument]
 
 
+def get_uncompressed_size(gzip_file_name):
+    '''
+    Returns the exact decompressed size of a gzip file by streaming it through
+    the decompressor.  The gzip trailer only holds the size, modulo 2**32, of the
+    last member so it can't be trusted for large or multi-member files.
+    '''
+    size = 0
+    with GzipFile(gzip_file_name, 'rb') as gz:
+        for chunk in iter(lambda: gz.read(config.checksum_chunk_size), b''):
+            size += len(chunk)
+    return size
+
+
+def add_decompressed_to_tar(tar_file, gzip_file_name, catalog=None):
+    '''
+    Streams the decompressed contents of a gzip file into the tar as a member named
+    without the .gz, hashing the bytes as they are written.  Nothing is written to
+    the source directory.  If the catalog holds the decompressed size and checksum
+    of the unchanged file, neither the size discovery nor the hashing is repeated.
+    Returns the ChecksumData for the added member
+    '''
+    member_name = os.path.splitext(gzip_file_name)[0]
+    tar_info = tar_file.gettarinfo(gzip_file_name, arcname=member_name)
+    stat_result = os.stat(gzip_file_name)
+    cached = catalog.get(gzip_file_name, stat_result) if catalog is not None else None
+    with GzipFile(gzip_file_name, 'rb') as gz:
+        if cached is not None and not catalog.should_verify():
+            tar_info.size = cached.content_size
+            tar_file.addfile(tar_info, fileobj=gz)
+            return ChecksumData(cached.content_md5, member_name)
+        tar_info.size = cached.content_size if cached is not None else get_uncompressed_size(gzip_file_name)
+        reader = HashingReader(gz)
+        tar_file.addfile(tar_info, fileobj=reader)
+    if catalog is not None:
+        catalog.update(gzip_file_name, stat_result, tar_info.size, reader.hexdigest())
+    return ChecksumData(reader.hexdigest(), member_name)
+
+
 # pylint: disable=W0613
 def tar_bundle_files(target_dir,
                      bundle_files,
@@ -176,17 +255,28 @@ def tar_bundle_files(target_dir,
                      bundle_file,
                      dry_run,
                      progress,
-                     skip_no_label_files=False):
+                     skip_no_label_files=False,
+                     compression_level=None,
+                     compression_threads=None,
+                     verify_fraction=0.0,
+                     volume_size=None):
     '''
     This will:
         1. Define tar output file name as <inst>_<start>_<end>.tar
         2. Go to maven/data/sci/<inst>
         3. Loop through files, appending each to tarball
-        4. Zip the tarball
+        4. Zip the tarball, compressing blocks of the tar stream on
+           compression_threads threads at compression_level
         5. Rename the tarball from *.tar.gz to *.tgz
+    Checksums of files whose size and mtime are unchanged since they were last
+    bundled come from the checksum catalog; verify_fraction of those are recomputed.
+    The tarball is checkpointed as it is written; if a checkpoint of a prior, interrupted
+    run exists the tarball is resumed from it.  If volume_size is provided the tarball
+    is split into volumes of about volume_size uncompressed bytes.
     '''
 
     checksums = []
+    catalog = checksum_catalog.ChecksumCatalog(bundle_files, verify_fraction)
 
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
@@ -201,7 +291,7 @@ def tar_bundle_files(target_dir,
     
     # Loop through the files in the bundle
     if not dry_run:
-        with tarfile.open(tarfile_name, 'w:gz') as tar_file:
+        with bundle_writer.ResumableBundle(tarfile_name, bundle_files, compression_level, compression_threads, volume_size) as bundle:
             for file_to_tar in bundle_files:
                 # strip version/revision and extension
                 base_file = os.path.basename(file_to_tar)
@@ -211,31 +301,26 @@ def tar_bundle_files(target_dir,
                     if skip_no_label_files:
                         continue
 
+                resumed_checksum = bundle.resumed_checksum(file_to_tar)
+                if resumed_checksum is not None:
+                    # compressed files were bundled under their name without the .gz
+                    checksums.append(ChecksumData(resumed_checksum,
+                                                  os.path.splitext(file_to_tar)[0] if is_compressed_format(file_to_tar) else file_to_tar))
+                    continue
+
                 # Is this a compressed file?
                 if is_compressed_format(file_to_tar):
-                    with GzipFile(file_to_tar, 'rb') as gzip:
-                        try:
-                            # Create unzipped file
-                            tmp_filename = os.path.splitext(file_to_tar)[0]
-                            # logger.info('Adding %s to tar', tmp_filename)
-                            with open(tmp_filename, 'wb') as tmp_file:
-                                tmp_file.write(gzip.read())
-                                # Add unzipped file
-                            tar_file.add(tmp_filename)
-                            checksums.append(ChecksumData(get_md5_checksums([tmp_filename])[0], tmp_filename))
-                            # Remove unzipped tar from file system
-                            os.remove(tmp_filename)
-                            # logger.info('Done adding %s to tar as %s', file_to_tar, tmp_filename)
-                            # progress.complete_unit(file_to_tar)
-                        except IOError as e:
-                            logger.error('Error adding %s : %s', file_to_tar, str(e))
-                            # progress.error_unit(file_to_tar)
+                    try:
+                        # Stream the decompressed contents into the tar without the .gz
+                        checksums.append(bundle.add(file_to_tar, add_decompressed_to_tar, catalog))
+                        # progress.complete_unit(file_to_tar)
+                    except IOError as e:
+                        logger.error('Error adding %s : %s', file_to_tar, str(e))
+                        # progress.error_unit(file_to_tar)
                 else:
                     try:
                         # logger.info('Adding %s to tar', file_to_tar)
-                        tar_file.add(file_to_tar,
-                                     recursive=False)
-                        checksums.append(ChecksumData(get_md5_checksums([file_to_tar])[0], file_to_tar))
+                        checksums.append(bundle.add(file_to_tar, add_to_tar, catalog))
                         # logger.info('Done adding %s to tar', file_to_tar)
                         # progress.complete_unit(file_to_tar)
                     except IOError as e:
@@ -248,30 +333,25 @@ def tar_bundle_files(target_dir,
         dry_run_logger.info('gzip %s', tarfile_name)
         for i in bundle_files:
             base_name = re.sub(r'_v\d{2,3}_r\d{2,3}.*', '', os.path.splitext(os.path.basename(i))[0])
-            checksums.append(ChecksumData(get_md5_checksums([i])[0], i))
+            checksums.append(ChecksumData(get_md5_checksums([i])[0] if is_compressed_format(i) else get_checksum(i, catalog), i))
             if base_name not in lidvid_files:
                 dry_run_logger.warning('No label file base name %s was found in the manifest.', base_name)
             dry_run_logger.info('Adding %s to tar', i)
 
+    catalog.commit()
     return checksums
 
 
-def create_event_archive_bundle(target_dir, from_dt, to_dt, bundle_file, manifest_file, checksum_file, file_version,
-                                dry_run):
-    '''Method used to create the PDS bundle for MAVEN SDC and OPs events
+def write_event_files(target_dir, from_dt, to_dt, file_version):
+    '''Method used to write the MAVEN SDC and OPs events csv files bundled as the events
     Arguments:
         target_dir - The full path to the output directory
-        from_dt - The start time for the bundle generation
-        to_dt - The end time for the bundle generation
-        bundle_file - The name of the bundle file
-        manifest_file - The name of the manifest file
-        checksum_file - The name of the checksum file
+        from_dt - The start time of the events
+        to_dt - The end time of the events
         file_version - The bundle version
-        dry_run - True if run is a dry run, False otherwise
+    Returns:
+        The fully qualified SDC events and OPs events file names
     '''
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-
     # Generated Events
     events = utilities.query_for_events(from_dt, to_dt)
     ops_events = utilities.query_for_ops_events(from_dt, to_dt)
@@ -297,6 +377,31 @@ def create_event_archive_bundle(target_dir, from_dt, to_dt, bundle_file, manifes
     with open(ops_file_name, 'w+') as event_file:
         event_file.write(utilities.generate_ops_events_csv(ops_events).getvalue())
 
+    return event_file_name, ops_file_name
+
+
+def create_event_archive_bundle(target_dir, from_dt, to_dt, bundle_file, manifest_file, checksum_file, file_version,
+                                dry_run, compression_level=None, compression_threads=None, verify_fraction=0.0, volume_size=None):
+    '''Method used to create the PDS bundle for MAVEN SDC and OPs events
+    Arguments:
+        target_dir - The full path to the output directory
+        from_dt - The start time for the bundle generation
+        to_dt - The end time for the bundle generation
+        bundle_file - The name of the bundle file
+        manifest_file - The name of the manifest file
+        checksum_file - The name of the checksum file
+        file_version - The bundle version
+        dry_run - True if run is a dry run, False otherwise
+        compression_level - The gzip compression level of the bundle
+        compression_threads - The number of threads used to compress the bundle
+        verify_fraction - The fraction of cataloged checksums to recompute
+        volume_size - Optional uncompressed size at which the bundle is split into volumes
+    '''
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    event_file_name, ops_file_name = write_event_files(target_dir, from_dt, to_dt, file_version)
+
     transfer_file = os.path.join(target_dir, manifest_file)
     # From http://pds.nasa.gov/pds4/doc/sr/v1/StdRef_4.0.8_130507_v1.pdf
     # LID format
@@ -311,8 +416,8 @@ def create_event_archive_bundle(target_dir, from_dt, to_dt, bundle_file, manifes
     ops_events_lid = 'urn:nasa:pds:maven.events:data.events:%s' % os.path.splitext(os.path.basename(ops_file_name))[0]
 
     with open(transfer_file, 'w') as transfer_file:
-        transfer_file.write('%s %s' % (sdc_events_lid, event_file_name))
-        transfer_file.write('%s %s' % (ops_events_lid, ops_file_name))
+        transfer_file.write('%s %s\n' % (sdc_events_lid, event_file_name))
+        transfer_file.write('%s %s\n' % (ops_events_lid, ops_file_name))
 
     checksums = tar_bundle_files(target_dir,
                                  [event_file_name, ops_file_name],
@@ -320,7 +425,11 @@ def create_event_archive_bundle(target_dir, from_dt, to_dt, bundle_file, manifes
                                   (ops_events_lid, ops_file_name)],
                                  bundle_file,
                                  dry_run,
-                                 archive_progress.ArchiveProgress([event_file_name], prefix='Events'))
+                                 archive_progress.ArchiveProgress([event_file_name], prefix='Events'),
+                                 compression_level=compression_level,
+                                 compression_threads=compression_threads,
+                                 verify_fraction=verify_fraction,
+                                 volume_size=volume_size)
 
     print_checksum_manifest(target_dir, checksums, checksum_file)
 
@@ -331,9 +440,12 @@ def create_ancillary_archive_bundle(target_dir,
                                     bundle_file,
                                     manifest_file,
                                     checksum_file,
-                                    products,
-                                    extensions,
-                                    dry_run):
+                                    ancillary_metadata,
+                                    dry_run,
+                                    compression_level=None,
+                                    compression_threads=None,
+                                    verify_fraction=0.0,
+                                    volume_size=None):
     '''Method used to create the PDS bundle for MAVEN ancillary data
     Arguments:
         target_dir - The full path to the output directory
@@ -342,18 +454,16 @@ def create_ancillary_archive_bundle(target_dir,
         bundle_file - The name of the bundle file
         manifest_file - The name of the manifest file
         checksum_file - The name of the checksum file
-        products - The products to be included in the bundle
-        extensions - The file extensions to be included in the bundle
+        ancillary_metadata - The AncillaryFilesMetadata of the files to be included in the bundle
         dry_run - True if run is a dry run, False otherwise
+        compression_level - The gzip compression level of the bundle
+        compression_threads - The number of threads used to compress the bundle
+        verify_fraction - The fraction of cataloged checksums to recompute
+        volume_size - Optional uncompressed size at which the bundle is split into volumes
     '''
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
 
-    ancillary_metadata = utilities.query_for_ancillary_files(product_list=products,
-                                                             extension_list=extensions,
-                                                             from_dt=from_dt,
-                                                             to_dt=end_dt)
-
     progress = archive_progress.ArchiveProgress([f.file_name for f in ancillary_metadata], prefix='Ancillary')
 
     transfer_file = os.path.join(target_dir, manifest_file)
@@ -390,7 +500,11 @@ def create_ancillary_archive_bundle(target_dir,
         for i in lid_zip:
             transfer_file.write(fmr_str % i)
 
-        checksums = tar_bundle_files(target_dir, bundle_files, zip(lids, bundle_files), bundle_file, dry_run, progress)
+        checksums = tar_bundle_files(target_dir, bundle_files, zip(lids, bundle_files), bundle_file, dry_run, progress,
+                                     compression_level=compression_level,
+                                     compression_threads=compression_threads,
+                                     verify_fraction=verify_fraction,
+                                     volume_size=volume_size)
 
         print_checksum_manifest(target_dir, checksums, checksum_file)
 
@@ -450,18 +564,18 @@ def run_report(start, end, instruments, override_inst_config=None):
     for next_instrument in instruments:
         next_instrument_filters = get_instrument_filters(next_instrument, override_inst_config)
 
-        metadata_for_files_in_archive = utilities.get_latest_science_metadata(
-            instrument_list=[next_instrument_filters.instrument],
-            level_list=next_instrument_filters.levels,
-            extension_list=next_instrument_filters.exts,
-            plan_list=next_instrument_filters.plans,
-            from_dt=date_range['start'],
-            to_dt=date_range['end'],
-            version=next_instrument_filters.ver,
-            revision=next_instrument_filters.rev)
+        query_filters = dict(instrument_list=[next_instrument_filters.instrument],
+                             level_list=next_instrument_filters.levels,
+                             extension_list=next_instrument_filters.exts,
+                             plan_list=next_instrument_filters.plans,
+                             from_dt=date_range['start'],
+                             to_dt=date_range['end'],
+                             version=next_instrument_filters.ver,
+                             revision=next_instrument_filters.rev)
 
-        archive_size_in_bytes = sum([meta.file_size for meta in metadata_for_files_in_archive])
-        archive_num_files = len(metadata_for_files_in_archive)
+        # size and count are aggregated by the database, the file listing is streamed
+        archive_num_files, archive_size_in_bytes = utilities.get_latest_science_summary(**query_filters)
+        metadata_for_files_in_archive = utilities.get_latest_science_metadata(stream_results=True, **query_filters)
 
         direct_out_logger.info('=' * report_line_width)
         direct_out_logger.info('={{0: ^{0}}}'.format(report_line_width).format(next_instrument))
@@ -506,6 +620,160 @@ def run_report(start, end, instruments, override_inst_config=None):
         direct_out_logger.info('=' * report_line_width)
 
 
+def run_estimate(start, end, instruments, root_dir, override_inst_config=None, sample_fraction=None, compression_level=None,
+                 compression_threads=None, output_file=None):
+    ''' Method used to estimate the compressed size and generation time of the archive of each
+    instrument.  A sample_fraction of the files of each instrument/extension are compressed and the
+    results extrapolated; the throughput measured while sampling is used to estimate the wall time.
+    The files of each instrument are selected as run_archive would select them.  The estimate is
+    written as JSON.
+    Arguments:
+      start - The start time to estimate
+      end - The end time to estimate
+      instruments - The list of instruments to process
+      root_dir - The root path used for providing a basis for generated archive files
+      override_inst_config - File where instrument_config variable to be used is located
+      sample_fraction - The fraction of files to sample (defaults to config.estimate_sample_fraction)
+      compression_level - The gzip compression level (defaults to config.bundle_compression_level)
+      compression_threads - The number of compression threads (defaults to config.bundle_compression_threads)
+      output_file - The file to write the JSON estimate to (defaults to stdout)
+    Returns:
+      The estimate as a dictionary
+    '''
+    if config.all_key in instruments:
+        instruments = list(config.instrument_config.keys())
+        logger.info('All instruments will be estimated %s', instruments)
+    compression_level = compression_level if compression_level is not None else config.bundle_compression_level
+    compression_threads = compression_threads if compression_threads is not None else config.bundle_compression_threads
+
+    date_range = input_dates(start, end)
+    throughput = estimate.SampleMeasurement()
+    instrument_estimates = {}
+    for next_instrument in instruments:
+        next_instrument_filters = get_instrument_filters(next_instrument, override_inst_config)
+        estimator = estimate.BundleEstimator(sample_fraction, compression_level)
+        # the events are generated as they are bundled so they are written to a scratch directory to be measured
+        with tempfile.TemporaryDirectory() as event_directory:
+            if next_instrument == config.event_key:
+                bundle_files = write_event_files(event_directory, date_range['start'], date_range['end'], None)
+            else:
+                bundle_files = select_instrument_files(next_instrument, next_instrument_filters, date_range['start'],
+                                                       date_range['end'], root_dir).bundle_files
+            for bundle_file in bundle_files:
+                estimator.add_file(bundle_file)
+            measurements = estimator.measure()
+        for measurement in measurements.values():
+            throughput.add(measurement)
+        instrument_estimates[next_instrument] = {'extensions': estimator.estimate(measurements)}
+
+    if throughput.rate(throughput.hash_seconds) is None or throughput.rate(throughput.compress_seconds) is None:
+        logger.info('Nothing was sampled, benchmarking the host')
+        throughput = estimate.benchmark(compression_level)
+
+    total = {'files': 0, 'file_size': 0, 'estimated_content_size': 0, 'estimated_compressed_size': 0}
+    for instrument_estimate in instrument_estimates.values():
+        for key in total:
+            instrument_estimate[key] = sum([e[key] or 0 for e in instrument_estimate['extensions'].values()])
+            total[key] += instrument_estimate[key]
+        instrument_estimate['estimated_seconds'] = estimate.estimate_seconds(instrument_estimate['estimated_content_size'],
+                                                                             throughput, compression_threads)
+    total['estimated_seconds'] = estimate.estimate_seconds(total['estimated_content_size'], throughput, compression_threads)
+
+    results_estimate = {'start': date_range['start'].isoformat(),
+                        'end': date_range['end'].isoformat(),
+                        'sample_fraction': sample_fraction if sample_fraction is not None else config.estimate_sample_fraction,
+                        'compression_level': compression_level,
+                        'compression_threads': compression_threads,
+                        'throughput': {'read_bytes_per_second': throughput.rate(throughput.read_seconds),
+                                       'hash_bytes_per_second': throughput.rate(throughput.hash_seconds),
+                                       'compress_bytes_per_second': throughput.rate(throughput.compress_seconds)},
+                        'instruments': instrument_estimates,
+                        'total': total}
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(results_estimate, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results_estimate, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return results_estimate
+
+
+def select_instrument_files(next_instrument, next_instrument_filters, start, end, root_dir, missing_file_handler=None):
+    '''Method used to select the files bundled for an instrument.  Both archive_instrument and
+    run_estimate use it so the estimate covers the files that would be archived.  The events are
+    generated from the database as they are bundled (see write_event_files) so none are selected.
+    Arguments:
+        next_instrument - The instrument to select the files of
+        next_instrument_filters - The ScienceFileSearchParameters of the instrument
+        start - The UTC start time to archive
+        end - The UTC end time to archive
+        root_dir - The root path used for providing a basis for generated archive files
+        missing_file_handler - Optional f(x) called with inventoried files that are missing from the SDC
+    Returns:
+        An InstrumentFiles of the fully qualified files to bundle, the label files among them and,
+        for the ancillary instrument, the AncillaryFilesMetadata of the files
+    '''
+    if next_instrument == config.event_key:
+        return InstrumentFiles([], [], [])
+
+    if next_instrument == config.ancillary_key:
+        ancillary_metadata = utilities.query_for_ancillary_files(product_list=next_instrument_filters.plans,
+                                                                 extension_list=next_instrument_filters.exts,
+                                                                 from_dt=start,
+                                                                 to_dt=end)
+        return InstrumentFiles(['/'.join([m.directory_path, m.file_name]) for m in ancillary_metadata], [], ancillary_metadata)
+
+    if 'metadata' in next_instrument_filters.plans:
+        metadata_path = os.path.join(root_dir, f'maven/data/sci/{next_instrument_filters.instrument}/metadata')
+
+        bundle_files = []
+        if os.path.isdir(metadata_path):
+            bundle_files = [os.path.join(os.path.abspath(metadata_path), f) for f in os.listdir(metadata_path)
+                            if os.path.isfile(os.path.join(metadata_path, f))]
+        return InstrumentFiles(bundle_files, [], [])
+
+    file_generator = file_finder.InventoryFileFinder(next_instrument_filters.as_inv_file,
+                                                     results_from_dt=start,
+                                                     results_to_dt=end,
+                                                     results_not_extensions=['xml'],
+                                                     uprev_inv_file=next_instrument_filters.uprev_inv_file,
+                                                     missing_file_handler=missing_file_handler) if next_instrument_filters.as_inv_file else \
+        file_finder.ScienceQueryFileFinder(instrument_list=[next_instrument_filters.instrument],
+                                           plan_list=next_instrument_filters.plans,
+                                           level_list=next_instrument_filters.levels,
+                                           extension_list=next_instrument_filters.exts,
+                                           file_name=next_instrument_filters.file_name,
+                                           from_dt=start,
+                                           to_dt=end,
+                                           version=next_instrument_filters.ver,
+                                           revision=next_instrument_filters.rev)
+
+    # get the latest files that match the filters for this instrument
+    bundle_files = list(file_generator.generate())
+
+    label_file_generator = file_finder.InventoryFileFinder(
+        next_instrument_filters.as_inv_file,
+        results_from_dt=start,
+        results_to_dt=end,
+        results_version=next_instrument_filters.label_ver,
+        results_revision=next_instrument_filters.label_rev,
+        results_extensions=['xml'],
+        uprev_inv_file=next_instrument_filters.uprev_inv_file,
+        missing_file_handler=missing_file_handler) if next_instrument_filters.as_inv_file else \
+        file_finder.ScienceQueryFileFinder(instrument_list=[next_instrument_filters.instrument],
+                                           plan_list=next_instrument_filters.plans,
+                                           level_list=next_instrument_filters.levels,
+                                           extension_list=['xml'],
+                                           from_dt=start,
+                                           to_dt=end)
+
+    label_files = list(label_file_generator.generate())
+
+    # combine science data files and label files
+    return InstrumentFiles(set(label_files) | set(bundle_files), label_files, [])
+
+
 def generate_bundle_file_names(inst, from_dt, to_dt, file_version):
     '''Method used to generate the bundle,checksum and manifest file names'''
 
@@ -532,7 +800,8 @@ def generate_bundle_file_names(inst, from_dt, to_dt, file_version):
 
 
 def run_archive(start, end, instruments, root_dir, dry_run, user_notes=None, override_inst_config=None,
-                skip_no_label_files=False):
+                skip_no_label_files=False, compression_level=None, compression_threads=None, verify_fraction=0.0, jobs=1,
+                volume_size=None, verify_bundles=None):
     ''' Method used to run an archive.  This will either generate the PDS4 compliant artifacts
     or print a report.
     Arguments:
@@ -544,14 +813,21 @@ def run_archive(start, end, instruments, root_dir, dry_run, user_notes=None, ove
         user_notes - Optional notes about the archive to be stored in the recorded results
         override_inst_config - File where instrument_config variable to be used is located
         skip_no_label_files - If true, don't bundle files that don't have a corresponding label file
+        compression_level - The gzip compression level of the bundles (defaults to config.bundle_compression_level)
+        compression_threads - The number of threads used to compress each bundle (defaults to config.bundle_compression_threads,
+                              split between the jobs)
+        verify_fraction - The fraction of cataloged checksums to recompute to catch silent corruption
+        jobs - The number of instruments to archive in parallel worker processes
+        volume_size - Optional uncompressed size at which bundles are split into volumes
+        verify_bundles - If true, verify each bundle against its manifests once written (defaults to config.verify_bundles)
     '''
     if config.all_key in instruments:
         instruments = list(config.instrument_config.keys())
         logger.info('All instruments will be processed %s', instruments)
+    verify_bundles = verify_bundles if verify_bundles is not None else config.verify_bundles
 
     start = time_utilities.to_utc_tz(parse(start))
     end = time_utilities.to_utc_tz(parse(end))
-    bundle_file=None
 
     if start > end:
         start, end = end, start
@@ -562,190 +838,292 @@ def run_archive(start, end, instruments, root_dir, dry_run, user_notes=None, ove
 
     generation_time = time_utilities.utc_now()
 
+    if jobs > 1 and len(instruments) > 1:
+        # instruments sharing an archive directory share its version numbering so they are run in turn by one worker
+        instrument_groups = OrderedDict()
+        for next_instrument in instruments:
+            instrument_groups.setdefault(get_instrument_filters(next_instrument, override_inst_config).instrument, []).append(next_instrument)
+        logger.info('Archiving %s instruments on %s processes', len(instruments), jobs)
+        first_error = None
+        workers = min(jobs, len(instrument_groups))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_archive_worker, initargs=(workers,)) as executor:
+            futures = [executor.submit(archive_instruments, instrument_group, start, end, root_dir, dry_run, override_inst_config,
+                                       skip_no_label_files, compression_level, compression_threads, verify_fraction, volume_size, verify_bundles)
+                       for instrument_group in instrument_groups.values()]
+            # record each instrument group as it completes so a failure doesn't lose the other results
+            for future in as_completed(futures):
+                for instrument_result in future.result():
+                    record_instrument_result(instrument_result, generation_time, start, end, dry_run, user_notes)
+                    if instrument_result.error is not None and first_error is None:
+                        first_error = instrument_result.error
+        if first_error is not None:
+            raise first_error
+    else:
+        for next_instrument in instruments:
+            instrument_result = archive_instrument(next_instrument, start, end, root_dir, dry_run, override_inst_config,
+                                                   skip_no_label_files, compression_level, compression_threads, verify_fraction, volume_size,
+                                                   verify_bundles)
+            if instrument_result is None:
+                continue
+            record_instrument_result(instrument_result, generation_time, start, end, dry_run, user_notes)
+            if instrument_result.error is not None:
+                raise instrument_result.error
+
+
+def init_archive_worker(workers=1):
+    '''Process pool initializer used to give each archive worker its own database sessions.  The
+    connections inherited from the parent process are abandoned without being closed so that the
+    parent's connections are left intact.  In-memory databases only exist within the parent's
+    connection so they are kept.  The workers share the CPUs, so the default compression and
+    verification thread counts are split between them.
+    Arguments:
+        workers - The number of archive worker processes
+    '''
+    config.bundle_compression_threads = max(1, config.bundle_compression_threads // workers)
+    config.bundle_verify_threads = max(1, config.bundle_verify_threads // workers)
+    for session in [db_session, ops_db_session]:
+        engine = session.get_bind()
+        if engine.url.database in (None, '', ':memory:'):
+            continue
+        session.registry.clear()
+        engine.dispose(close=False)
+
+
+def archive_instruments(instrument_group, *args):
+    '''Method used to archive a group of instruments in turn, stopping at the first failure
+    Arguments:
+        instrument_group - The instruments to archive
+        args - The remaining archive_instrument arguments
+    Returns:
+        The list of InstrumentArchiveResult
+    '''
+    instrument_results = []
+    for next_instrument in instrument_group:
+        instrument_result = archive_instrument(next_instrument, *args)
+        if instrument_result is None:
+            continue
+        instrument_results.append(instrument_result)
+        if instrument_result.error is not None:
+            break
+    return instrument_results
+
+
+def archive_instrument(next_instrument, start, end, root_dir, dry_run, override_inst_config=None,
+                       skip_no_label_files=False, compression_level=None, compression_threads=None, verify_fraction=0.0,
+                       volume_size=None, verify_bundles=False):
+    ''' Method used to generate the PDS4 archive artifacts for a single instrument.  This is run in a
+    worker process by run_archive when archiving instruments in parallel, so the results are returned
+    to be recorded by the caller.
+    Arguments:
+        next_instrument - The instrument to archive
+        start - The UTC start time to archive
+        end - The UTC end time to archive
+        See run_archive for the remaining arguments
+    Returns:
+        An InstrumentArchiveResult or None if the instrument had nothing to archive
+    '''
+    logger.info('Running PDS archive for %s', next_instrument)
+    logger.info(
+        'Instrument configuration for %s :\n\t %s' % (next_instrument, config.instrument_config[next_instrument]))
     next_instrument_filters = None
-    for next_instrument in instruments:
-        logger.info('Running PDS archive for %s', next_instrument)
-        logger.info(
-            'Instrument configuration for %s :\n\t %s' % (next_instrument, config.instrument_config[next_instrument]))
-        try:
-            archive_directory = None
-            current_file_version = None
-            next_instrument_filters = get_instrument_filters(next_instrument, override_inst_config)
-            bundle_file, checksum_file, manifest_file = None, None, None
-
-            if next_instrument == config.ancillary_key:
-                archive_directory = os.path.join(root_dir, 'maven/data/arc', 'anc')
-                current_file_version = get_latest_version(archive_directory) + 1
-                bundle_file, checksum_file, manifest_file = generate_bundle_file_names(
-                    next_instrument_filters.instrument, start, end, current_file_version)
-
-                create_ancillary_archive_bundle(archive_directory,
-                                                start,
-                                                end,
-                                                bundle_file,
-                                                manifest_file,
-                                                checksum_file,
-                                                next_instrument_filters.plans,
-                                                next_instrument_filters.exts,
-                                                dry_run)
-
-            elif next_instrument == config.event_key:
-                archive_directory = os.path.join(root_dir, 'maven/data/arc', 'events')
-                current_file_version = get_latest_version(archive_directory) + 1
-                bundle_file, checksum_file, manifest_file = generate_bundle_file_names(
-                    next_instrument_filters.instrument, start, end, current_file_version)
-                create_event_archive_bundle(archive_directory,
+    archive_directory = None
+    current_file_version = None
+    bundle_file, checksum_file, manifest_file = None, None, None
+    error, error_traceback = None, None
+    try:
+        next_instrument_filters = get_instrument_filters(next_instrument, override_inst_config)
+
+        if next_instrument == config.ancillary_key:
+            archive_directory = os.path.join(root_dir, 'maven/data/arc', 'anc')
+            current_file_version = get_bundle_version(archive_directory, next_instrument_filters.instrument, start, end)
+            bundle_file, checksum_file, manifest_file = generate_bundle_file_names(
+                next_instrument_filters.instrument, start, end, current_file_version)
+            instrument_files = select_instrument_files(next_instrument, next_instrument_filters, start, end, root_dir)
+
+            create_ancillary_archive_bundle(archive_directory,
                                             start,
                                             end,
                                             bundle_file,
                                             manifest_file,
                                             checksum_file,
-                                            current_file_version,
-                                            dry_run)
-            elif 'metadata' in next_instrument_filters.plans:
-                instrument_dir = next_instrument_filters.instrument
-                metadata_path = os.path.join(root_dir, f'maven/data/sci/{instrument_dir}/metadata')
-
-                bundle_files = []
-                if os.path.isdir(metadata_path):
-                    bundle_files = [os.path.join(os.path.abspath(metadata_path), f) for f in os.listdir(metadata_path) 
-                                    if os.path.isfile(os.path.join(metadata_path, f))]
-
-                archive_directory = os.path.join(root_dir, 'maven/data/arc', instrument_dir)
-                current_file_version = get_latest_version(archive_directory) + 1
-                bundle_file, checksum_file, manifest_file = generate_bundle_file_names(next_instrument, start, end,
-                                                                                       current_file_version)
-                instrument_lidvids = []
-                print_transfer_manifest(instrument_lidvids,
-                                        archive_directory,
-                                        manifest_file)
-                
-                checksums = tar_bundle_files(archive_directory,
-                                             bundle_files,
-                                             instrument_lidvids,
-                                             bundle_file,
-                                             dry_run,
-                                             archive_progress.ArchiveProgress(bundle_files, prefix=next_instrument),
-                                             skip_no_label_files)
-
-                print_checksum_manifest(archive_directory,
-                                        checksums,
-                                        checksum_file)
-            else:
+                                            instrument_files.ancillary_metadata,
+                                            dry_run,
+                                            compression_level,
+                                            compression_threads,
+                                            verify_fraction,
+                                            volume_size)
+
+        elif next_instrument == config.event_key:
+            archive_directory = os.path.join(root_dir, 'maven/data/arc', 'events')
+            current_file_version = get_bundle_version(archive_directory, next_instrument_filters.instrument, start, end)
+            bundle_file, checksum_file, manifest_file = generate_bundle_file_names(
+                next_instrument_filters.instrument, start, end, current_file_version)
+            create_event_archive_bundle(archive_directory,
+                                        start,
+                                        end,
+                                        bundle_file,
+                                        manifest_file,
+                                        checksum_file,
+                                        current_file_version,
+                                        dry_run,
+                                        compression_level,
+                                        compression_threads,
+                                        verify_fraction,
+                                        volume_size)
+        elif 'metadata' in next_instrument_filters.plans:
+            instrument_dir = next_instrument_filters.instrument
+            bundle_files = select_instrument_files(next_instrument, next_instrument_filters, start, end, root_dir).bundle_files
+
+            archive_directory = os.path.join(root_dir, 'maven/data/arc', instrument_dir)
+            current_file_version = get_bundle_version(archive_directory, next_instrument, start, end)
+            bundle_file, checksum_file, manifest_file = generate_bundle_file_names(next_instrument, start, end,
+                                                                                   current_file_version)
+            instrument_lidvids = []
+            print_transfer_manifest(instrument_lidvids,
+                                    archive_directory,
+                                    manifest_file)
+
+            checksums = tar_bundle_files(archive_directory,
+                                         bundle_files,
+                                         instrument_lidvids,
+                                         bundle_file,
+                                         dry_run,
+                                         archive_progress.ArchiveProgress(bundle_files, prefix=next_instrument),
+                                         skip_no_label_files,
+                                         compression_level,
+                                         compression_threads,
+                                         verify_fraction,
+                                         volume_size)
+
+            print_checksum_manifest(archive_directory,
+                                    checksums,
+                                    checksum_file)
+        else:
+            bundle_files, label_files, _ = select_instrument_files(next_instrument, next_instrument_filters, start, end, root_dir,
+                                                                   missing_file_handler=report_missing_sdc_file)
+
+            progress = archive_progress.ArchiveProgress(bundle_files, prefix=next_instrument)
+
+            if bundle_files is None:
+                msg = 'Skipping instrument %s, no archivable files' % next_instrument_filters.instrument
+                logger.info(msg)
+                return None
+
+            for f in bundle_files:
+                if not os.path.isfile(f):
+                    logger.warning('%s was not found on the filesystem!  Continuing', f)
+
+            instrument_lidvids = []
+
+            if next_instrument_filters.instrument in config.instrument_dictionary:
+                instrument_lidvids = generate_transfer_manifest(
+                    config.instrument_dictionary[next_instrument_filters.instrument],
+                    label_files)
+
+            instrument_dir = next_instrument_filters.instrument
+            if instrument_dir == 'kp':
+                instrument_dir = os.path.join(instrument_dir, next_instrument_filters.levels[0])
+
+            archive_directory = os.path.join(root_dir, 'maven/data/arc', instrument_dir)
+            current_file_version = get_bundle_version(archive_directory, next_instrument, start, end)
+            bundle_file, checksum_file, manifest_file = generate_bundle_file_names(next_instrument, start, end,
+                                                                                   current_file_version)
+
+            print_transfer_manifest(instrument_lidvids,
+                                    archive_directory,
+                                    manifest_file)
+
+            checksums = tar_bundle_files(archive_directory,
+                                         bundle_files,
+                                         instrument_lidvids,
+                                         bundle_file,
+                                         dry_run,
+                                         progress,
+                                         skip_no_label_files,
+                                         compression_level,
+                                         compression_threads,
+                                         verify_fraction,
+                                         volume_size)
+
+            print_checksum_manifest(archive_directory,
+                                    checksums,
+                                    checksum_file)
+
+        if verify_bundles and not dry_run:
+            verify_archive(archive_directory, bundle_file, checksum_file, manifest_file)
+
+    except Exception as e:
+        logger.exception('PDS Bundle Failure!')
+        error, error_traceback = e, traceback.format_exc()
+
+    return InstrumentArchiveResult(record=dict(configuration=json.dumps(next_instrument_filters) if next_instrument_filters else '',
+                                               result_directory=archive_directory,
+                                               bundle_file_name=bundle_file,
+                                               manifest_file_name=manifest_file,
+                                               checksum_file_name=checksum_file,
+                                               result_version=current_file_version),
+                                   error=error,
+                                   error_traceback=error_traceback)
+
+
+def verify_archive(archive_directory, bundle_file, checksum_file, manifest_file):
+    '''Method used to verify a written bundle against its checksum and transfer manifests
+    Arguments:
+        archive_directory - The directory holding the bundle and its manifests
+        bundle_file - The name of the bundle
+        checksum_file - The name of the checksum manifest
+        manifest_file - The name of the transfer manifest
+    Raises:
+        BundleVerificationError if the bundle doesn't match its manifests
+    '''
+    verification = bundle_verifier.verify_bundle(os.path.join(archive_directory, bundle_file),
+                                                 os.path.join(archive_directory, checksum_file),
+                                                 os.path.join(archive_directory, manifest_file))
+    bundle_verifier.report_verification(verification)
+    if not verification.ok:
+        raise bundle_verifier.BundleVerificationError('PDS bundle verification failed for ' + verification.summary())
 
-                file_generator = file_finder.InventoryFileFinder(next_instrument_filters.as_inv_file,
-                                                                 results_from_dt=start,
-                                                                 results_to_dt=end,
-                                                                 results_not_extensions=['xml'],
-                                                                 uprev_inv_file=next_instrument_filters.uprev_inv_file,
-                                                                 missing_file_handler=report_missing_sdc_file) if next_instrument_filters.as_inv_file else \
-                    file_finder.ScienceQueryFileFinder(instrument_list=[next_instrument_filters.instrument],
-                                                       plan_list=next_instrument_filters.plans,
-                                                       level_list=next_instrument_filters.levels,
-                                                       extension_list=next_instrument_filters.exts,
-                                                       file_name=next_instrument_filters.file_name,
-                                                       from_dt=start,
-                                                       to_dt=end,
-                                                       version=next_instrument_filters.ver,
-                                                       revision=next_instrument_filters.rev)
-
-                # get the latest files that match the filters for this instrument
-                bundle_files = list(file_generator.generate())
-
-                label_file_generator = file_finder.InventoryFileFinder(
-                    next_instrument_filters.as_inv_file,
-                    results_from_dt=start,
-                    results_to_dt=end,
-                    results_version=next_instrument_filters.label_ver,
-                    results_revision=next_instrument_filters.label_rev,
-                    results_extensions=['xml'],
-                    uprev_inv_file=next_instrument_filters.uprev_inv_file,
-                    missing_file_handler=report_missing_sdc_file) if next_instrument_filters.as_inv_file else \
-                    file_finder.ScienceQueryFileFinder(instrument_list=[next_instrument_filters.instrument],
-                                                       plan_list=next_instrument_filters.plans,
-                                                       level_list=next_instrument_filters.levels,
-                                                       extension_list=['xml'],
-                                                       from_dt=start,
-                                                       to_dt=end)
-
-                label_files = list(label_file_generator.generate())
-
-                # combine science data files and label files
-                bundle_files = set(label_files) | set(bundle_files)
-
-                progress = archive_progress.ArchiveProgress(bundle_files, prefix=next_instrument)
-
-                if bundle_files is None:
-                    msg = 'Skipping instrument %s, no archivable files' % next_instrument_filters.instrument
-                    logger.info(msg)
-                    continue
 
-                for f in bundle_files:
-                    if not os.path.isfile(f):
-                        logger.warning('%s was not found on the filesystem!  Continuing', f)
-
-                instrument_lidvids = []
-
-                if next_instrument_filters.instrument in config.instrument_dictionary:
-                    instrument_lidvids = generate_transfer_manifest(
-                        config.instrument_dictionary[next_instrument_filters.instrument],
-                        label_files)
-
-                instrument_dir = next_instrument_filters.instrument
-                if instrument_dir == 'kp':
-                    instrument_dir = os.path.join(instrument_dir, next_instrument_filters.levels[0])
-
-                archive_directory = os.path.join(root_dir, 'maven/data/arc', instrument_dir)
-                current_file_version = get_latest_version(archive_directory) + 1
-                bundle_file, checksum_file, manifest_file = generate_bundle_file_names(next_instrument, start, end,
-                                                                                       current_file_version)
-
-                print_transfer_manifest(instrument_lidvids,
-                                        archive_directory,
-                                        manifest_file)
-
-                checksums = tar_bundle_files(archive_directory,
-                                             bundle_files,
-                                             instrument_lidvids,
-                                             bundle_file,
-                                             dry_run,
-                                             progress,
-                                             skip_no_label_files)
-
-                print_checksum_manifest(archive_directory,
-                                        checksums,
-                                        checksum_file)
-
-            results.record_results(generation_time=generation_time,
-                                   start_time=start,
-                                   end_time=end,
-                                   command_line=' '.join(sys.argv),
-                                   configuration=json.dumps(next_instrument_filters) if next_instrument_filters else '',
-                                   dry_run=dry_run,
-                                   result_directory=archive_directory,
-                                   bundle_file_name=bundle_file,
-                                   manifest_file_name=manifest_file,
-                                   checksum_file_name=checksum_file,
-                                   result_version=current_file_version,
-                                   generation_result=results.GENERATION_SUCCESS,
-                                   notes=user_notes)
-        except Exception as e:
-            import traceback
-            logger.exception('PDS Bundle Failure!')
-            results.record_results(generation_time=generation_time,
-                                   start_time=start,
-                                   end_time=end,
-                                   command_line=' '.join(sys.argv),
-                                   configuration=json.dumps(next_instrument_filters) if next_instrument_filters else '',
-                                   dry_run=dry_run,
-                                   result_directory=archive_directory,
-                                   bundle_file_name=bundle_file,
-                                   manifest_file_name=manifest_file,
-                                   checksum_file_name=checksum_file,
-                                   result_version=current_file_version,
-                                   generation_result=results.GENERATION_FAILURE,
-                                   notes=user_notes if user_notes else '' + ' ERROR: ' + traceback.format_exc())
-            raise e
+def record_instrument_result(instrument_result, generation_time, start, end, dry_run, user_notes):
+    '''Method used to record the PdsArchiveRecord for an archived instrument
+    Arguments:
+        instrument_result - The InstrumentArchiveResult returned by archive_instrument
+        generation_time - The time the archive run started
+        start - The UTC start time of the archive
+        end - The UTC end time of the archive
+        dry_run - True if this was a dry run
+        user_notes - Optional notes about the archive to be stored in the recorded results
+    '''
+    if instrument_result.error is None:
+        generation_result, notes = results.GENERATION_SUCCESS, user_notes
+    else:
+        generation_result, notes = results.GENERATION_FAILURE, (user_notes or '') + ' ERROR: ' + instrument_result.error_traceback
+    results.record_results(generation_time=generation_time,
+                           start_time=start,
+                           end_time=end,
+                           command_line=' '.join(sys.argv),
+                           dry_run=dry_run,
+                           generation_result=generation_result,
+                           notes=notes,
+                           **instrument_result.record)
+
+
+def get_bundle_version(directory, inst, from_dt, to_dt):
+    '''Method used to get the version of the next bundle.  If the bundle of the latest
+    version was interrupted its version is reused so that the bundle is resumed.
+    Arguments:
+        directory - The archive directory of the bundle
+        inst - The bundle file prefix
+        from_dt - The start of the bundle
+        to_dt - The end of the bundle
+    '''
+    latest_version = get_latest_version(directory)
+    if latest_version > 0:
+        bundle_file = generate_bundle_file_names(inst, from_dt, to_dt, latest_version)[0]
+        if bundle_writer.has_checkpoint(os.path.join(directory, bundle_file)):
+            logger.info('Resuming interrupted bundle %s', bundle_file)
+            return latest_version
+    return latest_version + 1
 
 
 def get_latest_version(directory):
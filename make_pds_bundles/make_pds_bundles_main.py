@@ -31,6 +31,9 @@ def parse_arguments(arguments):
 
       #Dump the instrument configurations for all instruments
       make-pds-bundles.py 2015-01-01 2015-03-01 / -i all -dcl
+
+      #Estimate the size of the All instrument Archives for Jan/Feb of 2015 by compressing 5% of the files
+      make-pds-bundles.py 2015-01-01 2015-03-01 / -i all -e 0.05 --estimate-output estimate.json
     ''')
     parser.add_argument('date_range',
                         nargs=2,
@@ -54,6 +57,17 @@ def parse_arguments(arguments):
     parser.add_argument('-r', '--report',
                         action='store_true',
                         help='Generate a report as opposed to generating the actual archive')
+    parser.add_argument('-e', '--estimate',
+                        type=float,
+                        nargs='?',
+                        const=config.estimate_sample_fraction,
+                        default=None,
+                        metavar='FRACTION',
+                        help='Estimate the compressed size and generation time of the archives by compressing this fraction (default %(const)s) of the files')
+    parser.add_argument('--estimate-output',
+                        default=None,
+                        metavar='FILE',
+                        help='Write the JSON estimate to FILE instead of stdout')
     parser.add_argument('-n', '--notes',
                         default='',
                         help='Add a note to the results record')
@@ -63,11 +77,43 @@ def parse_arguments(arguments):
     parser.add_argument('-s', '--skip-missing-labels',
                         action='store_true',
                         help='Do not bundle files that do not have corresponding label files')
+    parser.add_argument('--compression-level',
+                        type=int,
+                        choices=range(1, 10),
+                        default=config.bundle_compression_level,
+                        help='The gzip compression level of the bundle (default %(default)s)')
+    parser.add_argument('--compression-threads',
+                        type=int,
+                        default=None,
+                        help='The number of threads used to compress the bundle (default {}, split between the --jobs)'.format(
+                            config.bundle_compression_threads))
+    parser.add_argument('--verify',
+                        type=float,
+                        nargs='?',
+                        const=config.checksum_verify_fraction,
+                        default=0.0,
+                        metavar='FRACTION',
+                        help='Recompute this fraction (default %(const)s) of the checksums reused from the checksum catalog')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='The number of instruments to archive in parallel (default %(default)s)')
+    parser.add_argument('--volume-size',
+                        type=int,
+                        default=None,
+                        metavar='MB',
+                        help='Split each bundle into volumes of about this many (uncompressed) megabytes')
+    parser.add_argument('--skip-bundle-verify',
+                        action='store_true',
+                        help='Don\'t verify the written bundles against their checksum and transfer manifests.  Verification reads '
+                             'every bundle again and can double the run time')
     args = parser.parse_args(arguments)
     return args
 
 
-def main(date_range, root_dir, instruments, dry_run, print_instrument_config=False, print_instrument_lid=False, report=False, notes=None, override=None, skip_missing_labels=False):
+def main(date_range, root_dir, instruments, dry_run, print_instrument_config=False, print_instrument_lid=False, report=False, notes=None, override=None, skip_missing_labels=False,
+         compression_level=None, compression_threads=None, verify=0.0, jobs=1, volume_size=None, estimate=None, estimate_output=None,
+         skip_bundle_verify=False):
     '''Method used to call the correct make_pds_bundles script'''
     assert os.path.isdir(root_dir), '%s is not a directory!' % root_dir
     if override:
@@ -79,6 +125,12 @@ def main(date_range, root_dir, instruments, dry_run, print_instrument_config=Fal
         make_pds_bundles.print_instrument_dictionary(instruments)
     if report:
         make_pds_bundles.run_report(date_range[0], date_range[1], instruments)
+    elif estimate is not None:
+        make_pds_bundles.run_estimate(date_range[0], date_range[1], instruments, root_dir, override, estimate,
+                                     compression_level, compression_threads, estimate_output)
     else:
-        make_pds_bundles.run_archive(date_range[0], date_range[1], instruments, root_dir, dry_run, notes, override, skip_missing_labels)
+        make_pds_bundles.run_archive(date_range[0], date_range[1], instruments, root_dir, dry_run, notes, override, skip_missing_labels,
+                                      compression_level, compression_threads, verify, jobs,
+                                      volume_size * 1024 * 1024 if volume_size else config.bundle_volume_size,
+                                      False if skip_bundle_verify else None)
 
@@ -9,7 +9,8 @@ import logging
 import os
 import csv
 from io import StringIO
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import aliased
 
 from maven_database.models import ScienceFilesMetadata, MavenEvent, AncillaryFilesMetadata
 from maven_ops_database.models import OpsMissionEvent
@@ -19,6 +20,9 @@ from maven_utilities import time_utilities
 
 logger = logging.getLogger('maven.make_pds_bundles.make_pds_bundles.utilities.log')
 
+# Number of rows fetched per round trip when streaming results
+stream_batch_size = 1000
+
 
 def query_for_ancillary_files(product_list=None,
                               extension_list=None,
@@ -119,6 +123,43 @@ def query_for_science_files(instrument_list=None,
     Returns
         The list of ScienceFilesMetadata that meet the filter criteria
     '''
+    query = build_science_files_query(instrument_list=instrument_list,
+                                      grouping_list=grouping_list,
+                                      plan_list=plan_list,
+                                      level_list=level_list,
+                                      version=version,
+                                      revision=revision,
+                                      extension_list=extension_list,
+                                      description_list=description_list,
+                                      file_name=file_name,
+                                      from_dt=from_dt,
+                                      to_dt=to_dt,
+                                      latest=latest)
+
+    if stream_results:
+        return query.yield_per(20)
+    # else plain old exhaust and return
+    return query.all()
+
+
+def build_science_files_query(instrument_list=None,
+                              grouping_list=None,
+                              plan_list=None,
+                              level_list=None,
+                              version=None,
+                              revision=None,
+                              extension_list=None,
+                              description_list=None,
+                              file_name=None,
+                              from_dt=datetime.datetime.min,
+                              to_dt=datetime.datetime.max,
+                              latest=False):
+    ''' Method used to build the science_files_metatdata query used by query_for_science_files
+    Arguments:
+        See query_for_science_files
+    Returns
+        The unexecuted ScienceFilesMetadata query
+    '''
     # Correction for W0102 dangerous default value %s as argument
     # If list does not contain any element, default set to empty []
     instrument_list = instrument_list or []
@@ -198,10 +239,7 @@ def query_for_science_files(instrument_list=None,
         else:
             query = query.order_by(ScienceFilesMetadata.file_root.desc(), ScienceFilesMetadata.absolute_version.desc()).distinct(ScienceFilesMetadata.file_root)
 
-    if stream_results:
-        return query.yield_per(20)
-    # else plain old exhaust and return
-    return query.all()
+    return query
 
 
 def get_all_science_files(instrument_list=None,
@@ -253,6 +291,46 @@ def get_all_science_files(instrument_list=None,
     return results
 
 
+def query_for_latest_science_metadata(instrument_list=None,
+                                      grouping_list=None,
+                                      plan_list=None,
+                                      level_list=None,
+                                      version=None,
+                                      revision=None,
+                                      extension_list=None,
+                                      from_dt=datetime.datetime.min,
+                                      to_dt=datetime.datetime.max):
+    ''' Method used to build a query for the latest version/revision of each science file.  The
+    files are ranked within each instrument/level/descriptor/extension/timetag by the database
+    using ROW_NUMBER() and only the top ranked files with a version > 0 are selected.
+    Arguments:
+        See get_latest_science_metadata
+    Returns
+        The unexecuted ScienceFilesMetadata query
+    '''
+    query = build_science_files_query(instrument_list=instrument_list,
+                                      grouping_list=grouping_list,
+                                      level_list=level_list,
+                                      plan_list=plan_list,
+                                      version=version,
+                                      revision=revision,
+                                      extension_list=extension_list,
+                                      from_dt=from_dt,
+                                      to_dt=to_dt)
+    latest_rank = func.row_number().over(partition_by=(ScienceFilesMetadata.instrument,
+                                                       ScienceFilesMetadata.level,
+                                                       ScienceFilesMetadata.descriptor,
+                                                       ScienceFilesMetadata.file_extension,
+                                                       ScienceFilesMetadata.timetag),
+                                         order_by=(ScienceFilesMetadata.version.desc(),
+                                                   ScienceFilesMetadata.revision.desc(),
+                                                   ScienceFilesMetadata.id.desc())).label('latest_rank')
+    ranked = query.add_columns(latest_rank).subquery()
+    latest = aliased(ScienceFilesMetadata, ranked)
+    return db_session.query(latest).filter(ranked.c.latest_rank == 1,
+                                           latest.version > 0)
+
+
 def get_latest_science_metadata(instrument_list=None,
                                 grouping_list=None,
                                 plan_list=None,
@@ -261,7 +339,8 @@ def get_latest_science_metadata(instrument_list=None,
                                 revision=None,
                                 extension_list=None,
                                 from_dt=datetime.datetime.min,
-                                to_dt=datetime.datetime.max):
+                                to_dt=datetime.datetime.max,
+                                stream_results=False):
     ''' Method used to query the science_files_metatdata table for science files of interest
     and return only latest version based on version/revision.  Version 0 files are never returned.
     Arguments:
@@ -274,47 +353,52 @@ def get_latest_science_metadata(instrument_list=None,
         extension_list - The list of extensions to filter
         from_dt - The from time to filter
         to_dt - The to time to filter
+        stream_results - Stream results from database
     Returns
-        The list of fully qualified file names that meet the criteria and are considered
+        The ScienceFilesMetadata that meet the criteria and are considered
         the latest version based on version/revision
     '''
-    # Correction for W0102 dangerous default value %s as argument
-    instrument_list = instrument_list or []
-    grouping_list = grouping_list or []
-    plan_list = plan_list or []
-    level_list = level_list or []
-    extension_list = extension_list or []
+    query = query_for_latest_science_metadata(instrument_list=instrument_list,
+                                              grouping_list=grouping_list,
+                                              level_list=level_list,
+                                              plan_list=plan_list,
+                                              version=version,
+                                              revision=revision,
+                                              extension_list=extension_list,
+                                              from_dt=from_dt,
+                                              to_dt=to_dt)
+    if stream_results:
+        return query.yield_per(stream_batch_size)
+    return query.all()
 
-    results = []
-    query_results = query_for_science_files(instrument_list=instrument_list,
-                                            grouping_list=grouping_list,
-                                            level_list=level_list,
-                                            plan_list=plan_list,
-                                            version=version,
-                                            revision=revision,
-                                            extension_list=extension_list,
-                                            from_dt=from_dt,
-                                            to_dt=to_dt)
-    # Arrange in Instrument:Level:Plan:Ext:Timetag->[(Version,Revision),(metadata)]
-    ordered_results = {}
-    running_max_metadata = []
-    for next_result in query_results:
-        ordered_results.setdefault(next_result.instrument, {}).setdefault(next_result.level, {}).setdefault(next_result.descriptor, {}).setdefault(next_result.file_extension, {}).setdefault(next_result.timetag, []).append(((next_result.absolute_version), next_result))
-
-    for instrument in ordered_results:
-        for level in ordered_results[instrument]:
-            for descriptor in ordered_results[instrument][level]:
-                for ext in ordered_results[instrument][level][descriptor]:
-                    for time in ordered_results[instrument][level][descriptor][ext]:
-                        logger.info('Latest Science Files Result for:\n\t Instrument:%s\n\t Level:%s\n\t Descriptor:%s\n\t Ext:%s\n\t Time:%s\n\t Result:%s',
-                                    instrument, level, descriptor, ext, time, ordered_results[instrument][level][descriptor][ext][time])
-                        _, max_metadata = max(ordered_results[instrument][level][descriptor][ext][time])
-                        running_max_metadata.append(max_metadata)
-    # Filter on versions > 0
-    for next_max_metadata in [m for m in running_max_metadata if m.version > 0]:
-        results.append(next_max_metadata)
 
-    return results
+def get_latest_science_summary(instrument_list=None,
+                               grouping_list=None,
+                               plan_list=None,
+                               level_list=None,
+                               version=None,
+                               revision=None,
+                               extension_list=None,
+                               from_dt=datetime.datetime.min,
+                               to_dt=datetime.datetime.max):
+    ''' Method used to count and size the latest science files in the database
+    Arguments:
+        See get_latest_science_metadata
+    Returns
+        (number of files, total size in bytes)
+    '''
+    latest = query_for_latest_science_metadata(instrument_list=instrument_list,
+                                               grouping_list=grouping_list,
+                                               level_list=level_list,
+                                               plan_list=plan_list,
+                                               version=version,
+                                               revision=revision,
+                                               extension_list=extension_list,
+                                               from_dt=from_dt,
+                                               to_dt=to_dt).subquery()
+    num_files, total_size = db_session.query(func.count(latest.c.id),
+                                             func.coalesce(func.sum(latest.c.file_size), 0)).one()
+    return num_files, int(total_size)
 
 
 def get_latest_science_files(instrument_list=None,
@@ -358,7 +442,8 @@ def get_latest_science_files(instrument_list=None,
                                                   revision=revision,
                                                   extension_list=extension_list,
                                                   from_dt=from_dt,
-                                                  to_dt=to_dt)
+                                                  to_dt=to_dt,
+                                                  stream_results=True)
 
     for m in latest_metadata:
         results.append(os.path.join(m.directory_path, m.file_name))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, BigInteger
+from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, BigInteger, func
 from sqlalchemy.orm import relationship
 from maven_database.database import Base, TableNameMixin
 from maven_utilities import time_utilities
@@ -153,6 +153,13 @@ class ScienceFilesMetadata(Base):
     __repr__ = __str__
 
 
+def file_root_base_name(dialect_name):
+    '''Returns a SQL expression for the portion of ScienceFilesMetadata.file_root before the first period'''
+    if dialect_name == 'postgresql':
+        return func.split_part(ScienceFilesMetadata.file_root, '.', 1)
+    return func.substr(ScienceFilesMetadata.file_root, 1, func.instr(ScienceFilesMetadata.file_root, '.') - 1)
+
+
 class AncillaryFilesMetadata(Base):
     ''' Model for the ancillary_files_metadata table. '''
 
@@ -555,6 +562,47 @@ Notes:%s
     __repr__ = __str__
 
 
+class FileChecksum(Base):
+    '''Model for the file_checksum_catalog table.  Caches the checksum of a file's
+    bundled content keyed on the file's path and stat signature (size + mtime).
+    For gzipped files the content is the decompressed data placed in PDS bundles.'''
+
+    __tablename__ = 'file_checksum_catalog'
+
+    id = Column(Integer, primary_key=True)
+    file_path = Column(String, nullable=False, unique=True, index=True)
+    file_size = Column(BigIntegerType, nullable=False)
+    mod_time = Column(Float, nullable=False)
+    content_size = Column(BigIntegerType, nullable=False)
+    content_md5 = Column(String, nullable=False)
+    computed_at = Column(DateTime(timezone=True), nullable=False)
+
+    def __init__(self,
+                 file_path,
+                 file_size,
+                 mod_time,
+                 content_size,
+                 content_md5,
+                 computed_at=None):
+        '''Build FileChecksum from its parts.'''
+        self.file_path = file_path
+        self.file_size = file_size
+        self.mod_time = mod_time
+        self.content_size = content_size
+        self.content_md5 = content_md5
+        self.computed_at = computed_at or time_utilities.utc_now()
+
+    def matches(self, stat_result):
+        '''Returns True if the provided os.stat result has the same signature as this entry'''
+        return self.file_size == stat_result.st_size and self.mod_time == stat_result.st_mtime
+
+    def __str__(self):
+        '''Returns a string representation of this object.'''
+        return '%s %s %s %s' % (self.file_path, self.file_size, self.mod_time, self.content_md5)
+
+    __repr__ = __str__
+
+
 class MavenStatus(Base):
     '''Model for the maven_status table.'''
 
@@ -8,10 +8,30 @@ atmos_search_url = "http://atmos.nmsu.edu/PDS/data/PDS4/MAVEN/"
 
 env = os.environ.get(constants.python_env, 'production_readonly')
 
+# Concurrency, per request timeout (seconds) and connection retries of the PDS page crawler
+pds_crawl_workers = 8
+pds_crawl_timeout = 60
+pds_crawl_retries = 2
+# Number of crawls of a data product that finds no released files, and the delay (seconds) between them
+pds_empty_crawl_attempts = 3
+pds_empty_crawl_delay = 180
+
+# Directory of the tracking bundles released by the default source generators
+trk_bundle_dir = '/maven/data/sdc/trk'
+
+# Threads, and entries per thread task, used to scan a public site for dead symbolic links
+site_scan_workers = 16
+site_scan_batch_size = 500
+
 if env == 'testing':
     ppi_data_urls = []
     atmos_data_urls = []
+    pds_cache_dir = None
+    pds_empty_crawl_delay = 0
 else:
+    # On disk cache of the PDS pages (revalidated with conditional requests)
+    pds_cache_dir = '/maven/mavenpro/pds_page_cache/'
+
     ppi_data_urls = ["maven.euv.calibrated:data.bands%22",
                      "maven.euv.modelled:data.daily.spectra%22",
                      "maven.euv.modelled:data.minute.spectra%22",
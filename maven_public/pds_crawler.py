@@ -0,0 +1,147 @@
+'''
+Concurrent, cached fetching of the PDS release pages.
+
+Pages are fetched on a bounded pool of threads with a timeout per request.
+If a cache directory is provided every page is kept on disk with its ETag and
+Last-Modified headers and later fetches of the page are conditional requests,
+so pages that haven't changed (e.g. the pages of past months) are only
+revalidated rather than downloaded again.
+'''
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# urllib.request is imported by fetch; it is slow to import and unused by the site builders
+
+from . import config
+
+logger = logging.getLogger('maven.maven_public.pds_crawler.log')
+
+
+class PageCache():
+    '''On disk cache of fetched pages keyed on their URL'''
+
+    def __init__(self, cache_dir):
+        '''
+        Arguments:
+            cache_dir - The directory holding the cached pages (created if needed)
+        '''
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def get(self, url):
+        '''Returns (body, metadata dictionary) of the cached page or None if it isn't cached'''
+        path = self._path(url)
+        try:
+            with open(path + '.json', 'r') as f:
+                metadata = json.load(f)
+            with open(path, 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if metadata.get('url') != url:
+            return None
+        return body, metadata
+
+    def put(self, url, body, etag=None, last_modified=None):
+        '''Method used to cache a page.  The body is written before its metadata (each atomically)
+        so a reader never pairs new metadata with an old body.'''
+        path = self._path(url)
+        for file_name, contents in [(path, body),
+                                    (path + '.json', json.dumps({'url': url,
+                                                                 'etag': etag,
+                                                                 'last_modified': last_modified,
+                                                                 'fetched': time.time()}).encode())]:
+            temp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+            with open(temp_file_name, 'wb') as f:
+                f.write(contents)
+            os.replace(temp_file_name, file_name)
+
+
+class PdsCrawler():
+    '''Fetches PDS pages concurrently through an optional PageCache'''
+
+    def __init__(self, cache_dir=None, workers=None, timeout=None, retries=None):
+        '''
+        Arguments:
+            cache_dir - Optional directory of the page cache (defaults to config.pds_cache_dir, None disables caching)
+            workers - The maximum number of concurrent requests (defaults to config.pds_crawl_workers)
+            timeout - The timeout, in seconds, of each request (defaults to config.pds_crawl_timeout)
+            retries - The number of times a request that fails to connect or times out is retried (defaults to config.pds_crawl_retries)
+        '''
+        cache_dir = cache_dir if cache_dir is not None else config.pds_cache_dir
+        self.cache = PageCache(cache_dir) if cache_dir else None
+        self.workers = workers or config.pds_crawl_workers
+        self.timeout = timeout or config.pds_crawl_timeout
+        self.retries = retries if retries is not None else config.pds_crawl_retries
+        # request counts, updated by the fetch threads
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def fetch(self, url):
+        '''Method used to fetch a page, revalidating the cached copy if there is one
+        Arguments:
+            url - The url of the page
+        Returns:
+            The page body as a string or None if the page doesn't exist or couldn't be read
+        '''
+        from urllib.error import HTTPError, URLError
+        from urllib.request import Request, urlopen
+        cached = self.cache.get(url) if self.cache is not None else None
+        request = Request(url)
+        if cached is not None:
+            if cached[1].get('etag'):
+                request.add_header('If-None-Match', cached[1]['etag'])
+            if cached[1].get('last_modified'):
+                request.add_header('If-Modified-Since', cached[1]['last_modified'])
+
+        for attempt in range(self.retries + 1):
+            self._count('requests')
+            try:
+                with urlopen(request, timeout=self.timeout) as page:
+                    body = page.read()
+                    if self.cache is not None:
+                        self.cache.put(url, body, page.headers.get('ETag'), page.headers.get('Last-Modified'))
+                return body.decode('utf-8')
+            except HTTPError as e:
+                if e.code == 304 and cached is not None:
+                    self._count('not_modified')
+                    return cached[0].decode('utf-8')
+                logger.warning("The page [%s] doesn't appear to exist.", url)
+                return None
+            except (URLError, socket.timeout, ConnectionError) as e:
+                logger.warning('Attempt %s to fetch [%s] failed : %s', attempt + 1, url, str(e))
+            except UnicodeDecodeError:
+                logger.warning("The page [%s] could not be read.", url)
+                return None
+
+        if cached is not None:
+            logger.warning('Using the cached copy of [%s]', url)
+            return cached[0].decode('utf-8')
+        return None
+
+    def fetch_all(self, urls):
+        '''Method used to fetch pages concurrently
+        Arguments:
+            urls - The urls of the pages
+        Returns:
+            A list of the page bodies (None for pages that couldn't be fetched) in the order of urls
+        '''
+        urls = list(urls)
+        if len(urls) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as executor:
+            return list(executor.map(self.fetch, urls))
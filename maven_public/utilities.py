@@ -12,13 +12,14 @@ import time
 import pytz
 import re
 import subprocess
+import stat
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from calendar import monthrange
-from sqlalchemy import or_, not_
-from urllib.request import urlopen, HTTPError
-from . import config
-from maven_database.models import AncillaryFilesMetadata, ScienceFilesMetadata
+from . import config, pds_crawler
 from maven_utilities import time_utilities
-from maven_database import db_session
+# SQLAlchemy and maven_database are imported by the methods that query the database so the
+# module (and the source generators) can be imported without connecting to it
 
 PDS_RELEASE_FLAG = 'RELEASED'
 PDS_SUCCESS_FLAG = 'SUCCESS'
@@ -35,24 +36,38 @@ EUV_L3B_DIR = 'sci/euv/l3b'
 
 directory_time_format = '%Y%m%dT%H%M%S'
 site_sim_dir_pattern = re.compile('site-([0-9]{8}T[0-9]{6})')
+# Name of the file, in each site directory, listing the source files the site released
+release_manifest_name = 'release-manifest.txt'
+# Temporary table (and insert batch size) used to bulk load the released file names
+released_table_name = 'public_released_files'
+released_batch_size = 10000
+# Temporary table used to match the released PDS files against the science file metadata
+pds_released_table_name = 'pds_released_files'
 
 logger = logging.getLogger('maven.maven_public.utilities.log')
 
 public_release_window_date_start = datetime.datetime(2013, 12, 1, tzinfo=pytz.UTC)
 
-current_month = datetime.datetime.now().month
-current_day = datetime.datetime.now().day
-current_year = datetime.datetime.now().year
-if current_month == 1 or (current_month==2 and current_day < 15):
-    public_release_window_date_end = datetime.datetime(current_year-1, 8, 15, tzinfo=pytz.UTC)
-elif (current_month==2 and current_day >= 15) or current_month == 3 or current_month==4 or (current_month==5 and current_day < 15):
-     public_release_window_date_end = datetime.datetime(current_year-1, 11, 15, tzinfo=pytz.UTC)
-elif (current_month==5 and current_day >= 15) or current_month == 6 or current_month==7 or (current_month==8 and current_day < 15):
-     public_release_window_date_end = datetime.datetime(current_year, 2, 15, tzinfo=pytz.UTC)
-elif (current_month==8 and current_day >= 15) or current_month == 9 or current_month==10 or (current_month==11 and current_day < 15):
-     public_release_window_date_end = datetime.datetime(current_year, 5, 15, tzinfo=pytz.UTC)
-elif (current_month==11 and current_day >= 15) or current_month == 12:
-    public_release_window_date_end = datetime.datetime(current_year, 8, 15, tzinfo=pytz.UTC)
+# Releases are made on the 15th of these months and make public the data up to the 15th of
+# the month release_lag_months before the release
+release_months = [2, 5, 8, 11]
+release_lag_months = 3
+
+
+def public_release_window(as_of=None):
+    '''Method used to get the public release window in effect at a time
+    Arguments:
+        as_of - The time of the release (defaults to now)
+    Returns:
+        (start datetime, end datetime) of the data that is publicly released
+    '''
+    as_of = as_of or datetime.datetime.now()
+    released = [month for month in release_months if (as_of.month, as_of.day) >= (month, 15)]
+    year, month = (as_of.year, released[-1]) if released else (as_of.year - 1, release_months[-1])
+    month -= release_lag_months
+    if month < 1:
+        year, month = year - 1, month + 12
+    return public_release_window_date_start, datetime.datetime(year, month, 15, tzinfo=pytz.UTC)
 
 
 class SciQueryMetadata():
@@ -93,6 +108,9 @@ class SciQueryMetadata():
     Returns:
         An SQL query for the requested Ancillary metadata
     '''
+        from sqlalchemy import or_
+        from maven_database import db_session
+        from maven_database.models import ScienceFilesMetadata
         query = db_session.query(
             ScienceFilesMetadata.directory_path, ScienceFilesMetadata.file_name)
 
@@ -188,6 +206,9 @@ class AncQueryMetadata():
     Returns:
         An SQL query for the requested Ancillary metadata
         '''
+        from sqlalchemy import or_, not_
+        from maven_database import db_session
+        from maven_database.models import AncillaryFilesMetadata
         query = db_session.query(
             AncillaryFilesMetadata.directory_path, AncillaryFilesMetadata.file_name)
 
@@ -244,18 +265,22 @@ class AncQueryMetadata():
 
 class PdsQueryMetadata():
 
-    def __init__(self, base_url, data_product_urls, ppi=False):
+    def __init__(self, base_url, data_product_urls, ppi=False, crawler=None, window=None):
         '''
         Class used to generate the list of source files using PDS release information
         Arguments:
             base_url - The base url of the PDS node to search
             data_product_urls - A list of urls where the data products reside
             ppi - Whether or not we're querying the ppi website (instead of atmospheres)
+            crawler - Optional pds_crawler.PdsCrawler used to fetch the PDS pages
+            window - Optional (start, end) public release window to search (defaults to the current public_release_window)
         '''
 
         self.pds_base_url = base_url
         self.pds_data_product_urls = data_product_urls
         self.ppi = ppi
+        self.crawler = crawler
+        self.window = window
 
     @staticmethod
     def _parse_file_name(pds_file):
@@ -276,64 +301,35 @@ class PdsQueryMetadata():
 
         return (base_name, (version, revision))
 
-    @staticmethod
-    def _compare(sfmd, file_tuple):
-        '''Method used to compare a ScienceFileMetadata object and a inventory tuple
-        Arguments:
-            sfmd - The ScienceFileMetadata object to compare
-            file_tuple - The pds file tuple (base_name,(version,revision))
-        Returns:
-            -1 if sfmd < inv_tuple, 1 if sfmd > inv_tuple 0 if sfmd == inv_tuple
-        '''
-
-        sfmd_base_name = sfmd.file_root.split('.')[0]
-
-        return ((sfmd_base_name, (sfmd.version, sfmd.revision)) > file_tuple) - ((sfmd_base_name, (sfmd.version, sfmd.revision)) < file_tuple)
-
-
-    @staticmethod
-    def _valid_label_file(sfmd, file_tuple):
-        '''Method used to determine if the file_tuple represents the correct
-        label file for sfmd.
-        Arguments:
-            sfmd - The ScienceFileMetadata object to compare
-            file_tuple - The pds file tuple (base_name,(version,revision))
+    def crawl(self):
+        '''Method used to crawl every data product, re-crawling those where no released
+        files were found (up to config.pds_empty_crawl_attempts times)
         Returns:
-            True if the file_tuple is the correct label file, else False
+            {data product url: list of released files}
         '''
-
-        #Check that the file roots are the same
-        if sfmd.file_root.split('.')[0] != file_tuple[0]:
-            return False
-
-        #Check that the file is actually a label file
-        if sfmd.file_extension=='xml':
-            if sfmd.instrument == 'iuv' or sfmd.level == 'iuvs':
-                if sfmd.version == 1 and sfmd.revision == 0:
-                    return True
-            else:
-                #Check that version/revision match
-                if sfmd.version == file_tuple[1][0] and sfmd.revision == file_tuple[1][1]:
-                    return True
-        return False
+        crawler = self.crawler or pds_crawler.PdsCrawler()
+        search_urls = {self.pds_base_url + data_product_url: data_product_url for data_product_url in self.pds_data_product_urls}
+        released_files = {}
+        pending = list(search_urls)
+        for attempt in range(config.pds_empty_crawl_attempts):
+            if attempt > 0:
+                time.sleep(config.pds_empty_crawl_delay)
+            found = crawl_pds(pending, ppi=self.ppi, crawler=crawler, window=self.window)
+            pending = []
+            for base_search_url, science_files in found.items():
+                released_files[search_urls[base_search_url]] = science_files
+                if len(science_files) == 0:
+                    logger.warning("No released files were found for the data type %s", search_urls[base_search_url])
+                    pending.append(base_search_url)
+            if len(pending) == 0:
+                break
+        return released_files
 
     def generate(self):
+        released_files = self.crawl()
         for data_product_url in self.pds_data_product_urls:
             pds_released_files = []
-
-            # Find full url to the data product
-            base_search_url = self.pds_base_url + data_product_url
-
-            # Walk through the URL to find the list of released data
-            for i in range(0,3):
-                science_files = walk_through_pds(base_search_url, ppi=self.ppi)
-
-                if len(science_files) == 0:
-                    logger.warning("No released files were found for the data type %s", data_product_url)
-                    time.sleep(180)
-                    continue
-                else:
-                    break
+            science_files = released_files[data_product_url]
 
             # turn inventory files into tuple of the form (basename, (version, revision))
             for f in science_files:
@@ -349,28 +345,68 @@ class PdsQueryMetadata():
                 logger.warning("No released files were found for the data type %s", data_product_url)
                 continue
 
-            pds_released_files.sort()
-
-            next_pds_file = pds_released_files.pop(0)
-
-            try:
-                for f in pds_released_files:
-                    query = ScienceFilesMetadata.query.filter(operator.ge(ScienceFilesMetadata.file_root, f[0]))
-                    query = query.filter(operator.le(ScienceFilesMetadata.file_root, f[0] + 'Z'))
-                    for next_sfmd in query.yield_per(20):
-                        # Check if next_sfmd is the label file for the next_pds_file
-                        # With the above query ordering, label files always come first, so don't move on to the next
-                        # file in pds_released files yet.
-                        if self._valid_label_file(next_sfmd, f):
-                            #logger.info("Releasing: %s", next_sfmd.file_name)
-                            yield os.path.join(next_sfmd.directory_path, next_sfmd.file_name)
-
-                        if self._compare(next_sfmd, f) == 0:
-                            #logger.info("Releasing: %s", next_sfmd.file_name)
-                            yield os.path.join(next_sfmd.directory_path, next_sfmd.file_name)
-            except IndexError:  # reached end of next_inv_entry list
-                pass
+            for released in self.match_released(sorted(set(pds_released_files))):
+                yield released
 
+    def match_released(self, pds_released_files):
+        '''Method used to find the science files, and their label files, of the released PDS files.  The
+        released files are bulk loaded into a temporary table and matched against science_files_metadata
+        with a single join.
+        Arguments:
+            pds_released_files - list of (base_name, (version, revision))
+        Yields:
+            Fully qualified paths to the released science files
+        '''
+        from sqlalchemy import or_, and_, Table, MetaData, Column, String, Integer
+        from maven_database import db_session
+        from maven_database.models import ScienceFilesMetadata, file_root_base_name
+        connection = db_session.connection()
+        pds_table = Table(pds_released_table_name, MetaData(),
+                          Column('base_name', String, nullable=False),
+                          Column('version', Integer, nullable=False),
+                          Column('revision', Integer, nullable=False),
+                          prefixes=['TEMPORARY'])
+        pds_table.create(bind=connection)
+        try:
+            for i in range(0, len(pds_released_files), released_batch_size):
+                connection.execute(pds_table.insert(),
+                                   [{'base_name': base_name, 'version': version, 'revision': revision}
+                                    for base_name, (version, revision) in pds_released_files[i:i + released_batch_size]])
+
+            # IUVS labels are only delivered as v01_r00, every other label matches the version/revision of its file
+            iuvs_label = and_(ScienceFilesMetadata.file_extension == 'xml',
+                              or_(ScienceFilesMetadata.instrument == 'iuv', ScienceFilesMetadata.level == 'iuvs'),
+                              ScienceFilesMetadata.version == 1,
+                              ScienceFilesMetadata.revision == 0)
+            query = db_session.query(ScienceFilesMetadata.directory_path, ScienceFilesMetadata.file_name)\
+                .join(pds_table, and_(file_root_base_name(connection.dialect.name) == pds_table.c.base_name,
+                                      or_(and_(ScienceFilesMetadata.version == pds_table.c.version,
+                                               ScienceFilesMetadata.revision == pds_table.c.revision),
+                                          iuvs_label)))\
+                .distinct()
+            for directory_path, file_name in query.yield_per(1000):
+                yield os.path.join(directory_path, file_name)
+        finally:
+            pds_table.drop(bind=connection)
+
+
+class SourceFile(str):
+    '''A source file name that carries the stat of the file, taken when it was found, so the
+    file isn't stat'ed again when it is released'''
+
+    def __new__(cls, file_name, file_stat=None):
+        source_file = super().__new__(cls, file_name)
+        source_file.stat = file_stat
+        return source_file
+
+
+def is_source_file(source_file):
+    '''Method used to determine if a generated source file is a regular file, using the stat
+    carried by a SourceFile when there is one'''
+    file_stat = getattr(source_file, 'stat', None)
+    if file_stat is not None:
+        return stat.S_ISREG(file_stat.st_mode)
+    return os.path.isfile(source_file)
 
 
 class SystemFileQueryMetadata():
@@ -391,35 +427,49 @@ class SystemFileQueryMetadata():
             end_date - The end date to query
             get_date - A function used to determine a file time. The function is expected
                        to be of the form get_date(<filename>) which returns a datetime.
+                       Defaults to the modification time of the file.
             child_directories - True => recursively search child directories, False => don't recursively search
         '''
-
-        def system_file_get_date(file_name):
-            if not os.path.isfile(file_name):
-                return None
-            return datetime.datetime.fromtimestamp(os.path.getmtime(file_name)).replace(tzinfo=pytz.UTC)
-
         self.base_name_regex = re.compile(base_name_pattern)
         self.root_dir = root_dir
         self.child_directories = child_directories
-        self.get_date = get_date if get_date else system_file_get_date
+        self.get_date = get_date
         self.start_date = start_date
         self.end_date = end_date
 
     def generate(self):
-        '''Generator for the found source file names'''
-        for root, _, files in os.walk(self.root_dir):
-            for file_name in files:
-                if self.base_name_regex.match(file_name):
-                    fn = os.path.join(root, file_name)
-                    file_dt = self.get_date(fn)
+        '''Generator for the found source file names.  The directories are scanned with os.scandir
+        and each matching file is stat'ed once; the stat is carried with the name (see SourceFile).'''
+        directories = [self.root_dir]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop(0))
+            except OSError as e:
+                logger.warning('Unable to scan %s : %s', e.filename, e.strerror)
+                continue
+            with entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.child_directories:
+                            directories.append(entry.path)
+                        continue
+                    if not self.base_name_regex.match(entry.name):
+                        continue
+                    try:
+                        file_stat = entry.stat()
+                    except OSError:  # dead link
+                        continue
+                    if not stat.S_ISREG(file_stat.st_mode):
+                        continue
+                    if self.get_date:
+                        file_dt = self.get_date(entry.path)
+                    else:
+                        file_dt = datetime.datetime.fromtimestamp(file_stat.st_mtime).replace(tzinfo=pytz.UTC)
                     if self.start_date and file_dt < self.start_date:
                         continue
                     if self.end_date and file_dt >= self.end_date:
                         continue
-                    yield fn
-            if not self.child_directories:
-                break
+                    yield SourceFile(entry.path, file_stat)
 
     def __str__(self):
         return 'SystemFileQueryMetadata -'\
@@ -452,171 +502,296 @@ def orbit_file_time_getter(file_name):
 
     return time_utilities.to_utc_tz(datetime.datetime.strptime(m.group('end'), '%y%m%d'))
 
-default_source_generators = [PdsQueryMetadata(config.atmos_search_url, config.atmos_data_urls),
-                             PdsQueryMetadata(config.ppi_search_url, config.ppi_data_urls, ppi=True),
-                             AncQueryMetadata(base_name='sci_anc',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end),
-                             #                            AncQueryMetadata(base_name='sci_anc',
-                             #                                         product='eps',
-                             #                                         end_date=public_release_window_date_end),
-                             AncQueryMetadata(base_name='mvn',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='anc_sci',
-                                              start_date=None,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='mvn_sc',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='mvn_app',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='mvn',
-                                              product='iuv_all',
-                                              start_date=None,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='mvn',
-                                              product='rec',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='mvn',
-                                              product='tst',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             # AncQueryMetadata(base_name='optg',
-                             #                 start_date=public_release_window_date_start,
-                             #                 end_date=public_release_window_date_end,
-                             #                 latest=True),
-                             AncQueryMetadata(base_name='spk',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='MVN',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(product='noHdr',
-                                              start_date=None,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='trj',
-                                              product='orb',
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end,
-                                              latest=True),
-                             AncQueryMetadata(base_name='MVN',
-                                              product='SCLKSCET',
-                                              latest=True),
-                             # Don't provide JPL Radio files to public for now.
-                             #                              AncQueryMetadata(base_name='202MA',
-                             #                                               end_date=public_release_window_date_end,
-                             #                                               latest=True),
-                             SciQueryMetadata(instrument_list=['lpw', 'mag', 'ngi', 'pfp', 'sep', 'sta', 'swe', 'swi'],
-                                              plan_list=['quicklook'],
-                                              file_extension_list=[
-                                                  'png', 'csv'],
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end),
-                             SciQueryMetadata(instrument_list=['iuv'],
-                                              file_extension_list=['png', 'jpg'],
-                                              start_date=public_release_window_date_start,
-                                              end_date=public_release_window_date_end),
-                             SystemFileQueryMetadata(root_dir='/maven/data/sdc/trk',
-                                                     base_name_pattern=trk_bundle_pattern,
-                                                     start_date=public_release_window_date_start,
-                                                     end_date=public_release_window_date_end,
-                                                     get_date=lambda x: public_release_window_date_start,  # time doesn't matter for public release
-                                                     child_directories=False),
-
-                             ]
+
+def get_default_source_generators(as_of=None, settings=None):
+    '''Method used to build the source generators of a public site
+    Arguments:
+        as_of - The time of the release, used to determine the public release window (defaults to now)
+        settings - The configuration providing the PDS urls and the tracking bundle directory (defaults to maven_public.config)
+    Returns:
+        A list of the source generators
+    '''
+    settings = settings or config
+    window_start, window_end = public_release_window(as_of)
+    return [PdsQueryMetadata(settings.atmos_search_url, settings.atmos_data_urls, window=(window_start, window_end)),
+            PdsQueryMetadata(settings.ppi_search_url, settings.ppi_data_urls, ppi=True, window=(window_start, window_end)),
+            AncQueryMetadata(base_name='sci_anc',
+                             start_date=window_start,
+                             end_date=window_end),
+            #                            AncQueryMetadata(base_name='sci_anc',
+            #                                         product='eps',
+            #                                         end_date=window_end),
+            AncQueryMetadata(base_name='mvn',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='anc_sci',
+                             start_date=None,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='mvn_sc',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='mvn_app',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='mvn',
+                             product='iuv_all',
+                             start_date=None,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='mvn',
+                             product='rec',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='mvn',
+                             product='tst',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            # AncQueryMetadata(base_name='optg',
+            #                 start_date=window_start,
+            #                 end_date=window_end,
+            #                 latest=True),
+            AncQueryMetadata(base_name='spk',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='MVN',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(product='noHdr',
+                             start_date=None,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='trj',
+                             product='orb',
+                             start_date=window_start,
+                             end_date=window_end,
+                             latest=True),
+            AncQueryMetadata(base_name='MVN',
+                             product='SCLKSCET',
+                             latest=True),
+            # Don't provide JPL Radio files to public for now.
+            #                              AncQueryMetadata(base_name='202MA',
+            #                                               end_date=window_end,
+            #                                               latest=True),
+            SciQueryMetadata(instrument_list=['lpw', 'mag', 'ngi', 'pfp', 'sep', 'sta', 'swe', 'swi'],
+                             plan_list=['quicklook'],
+                             file_extension_list=[
+                                 'png', 'csv'],
+                             start_date=window_start,
+                             end_date=window_end),
+            SciQueryMetadata(instrument_list=['iuv'],
+                             file_extension_list=['png', 'jpg'],
+                             start_date=window_start,
+                             end_date=window_end),
+            SystemFileQueryMetadata(root_dir=settings.trk_bundle_dir,
+                                    base_name_pattern=trk_bundle_pattern,
+                                    start_date=window_start,
+                                    end_date=window_end,
+                                    get_date=lambda x: window_start,  # time doesn't matter for public release
+                                    child_directories=False),
+
+            ]
+
+
+def get_site_target_file(source_file, source_root_dir, target_root_dir):
+    '''Method used to get the site path of a released source file
+    Arguments:
+        source_file - The fully qualified source file
+        source_root_dir - The root of the directory for the source science data
+        target_root_dir - The root of the site directory tree
+    Returns:
+        The fully qualified site file
+    '''
+    anc_source_root_dir = os.path.join(source_root_dir, ANC_DIR)
+    sci_source_root_dir = os.path.join(source_root_dir, SCI_DIR)
+    sdc_source_root_dir = os.path.join(source_root_dir, SDC_DIR)
+
+    if anc_source_root_dir in source_file:
+        return source_file.replace(anc_source_root_dir, os.path.join(target_root_dir, ANC_DIR))
+    elif sci_source_root_dir in source_file:
+        return source_file.replace(sci_source_root_dir, os.path.join(target_root_dir, SCI_DIR))
+    elif sdc_source_root_dir in source_file:
+        return source_file.replace(sdc_source_root_dir, os.path.join(target_root_dir, SDC_DIR))
+    raise Exception('File %s was not anc or sci' % source_file)
+
+
+def read_release_manifest(site_dir, source_root_dir, sym_link):
+    '''Method used to read the release manifest of a prior site
+    Arguments:
+        site_dir - The prior site directory
+        source_root_dir - The root of the directory for the source science data
+        sym_link - True - the new site uses symbolic links, False - full science file copies
+    Returns:
+        {source file: signature (see get_release_signature) or None} of the files released by
+        the site or None if the site can't be reused (no manifest or built from a different
+        source root or with a different sym_link)
+    '''
+    manifest_file = os.path.join(site_dir, release_manifest_name)
+    if not os.path.isfile(manifest_file):
+        return None
+    header = {}
+    released = {}
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                key, _, value = line[1:].partition('=')
+                header[key] = value
+            elif line:
+                source_file, _, signature = line.partition('\t')
+                released[source_file] = signature or None
+    if header.get('source_root_dir') != source_root_dir or header.get('sym_link') != str(sym_link):
+        logger.info('Site %s was built from %s (sym links %s), rebuilding in full',
+                    site_dir, header.get('source_root_dir'), header.get('sym_link'))
+        return None
+    return released
+
+
+def get_release_signature(source_file):
+    '''Method used to get the signature of a copied source file recorded in the release manifest.
+    A copy is only cloned into the next site if the source file still has the same signature.
+    Returns:
+        The size and modification time of the source file as a string
+    '''
+    stat_result = os.stat(source_file)
+    return '{}\t{}'.format(stat_result.st_size, stat_result.st_mtime_ns)
+
+
+def clone_site_file(previous_target_file, target_file):
+    '''Method used to carry a released file over from the prior site by hard linking its
+    entry (the symbolic link itself or the copied file)
+    Returns:
+        True if the entry was cloned, False otherwise
+    '''
+    try:
+        os.link(previous_target_file, target_file, follow_symlinks=False)
+        return True
+    except OSError as e:
+        logger.debug('Unable to clone %s : %s', previous_target_file, str(e))
+        return False
 
 
 def populate_site(source_generators,
                   target_root_dir,
                   source_root_dir,
-                  sym_link=True):
-    '''Method used to populate the site using the provided source files
+                  sym_link=True,
+                  previous_site_dir=None):
+    '''Method used to populate the site using the provided source files.  If previous_site_dir
+    has a release manifest, files it released are cloned from it and only the newly released
+    files are linked (or copied); files that are no longer released are left out.  Copies are
+    only cloned if the size and modification time of the source file are unchanged, so a source
+    file rewritten in place is copied again.
     Arguments:
         source_generators - The list of source generators used to populate the site
         target_root_dir - The root of the directory tree to populate
         source_root_dir - The root of the directory for the source science data
         sym_link - True - use symbolic links, False - full science file copies
+        previous_site_dir - Optional prior site to build from
+    Returns:
+        The file listing the released source files
     '''
     temp_released_list_file = source_root_dir + "/temp-released-site-list-" + str(datetime.datetime.now()) + '.txt'
+    previous_release = None
+    if previous_site_dir is not None and os.path.abspath(previous_site_dir) != os.path.abspath(target_root_dir):
+        previous_release = read_release_manifest(previous_site_dir, source_root_dir, sym_link)
+    previous_release = previous_release or {}
+
+    released = set()
+    created_dirs = set()
+    cloned = 0
+    if not os.path.isdir(target_root_dir):
+        os.makedirs(target_root_dir, mode=0o755)
     # create the file to ensure it's still created in case there are
     # no source generators
-    open(temp_released_list_file, "a").close()
-    for next_source_generator in source_generators:
-        logger.info('Generating release data for %s', next_source_generator)
-        for source_file in next_source_generator.generate():
-            target_file = source_file
-
-            if not os.path.isfile(source_file):
-                logger.warning('Science file -%s- was not found!', source_file)
-                continue
+    with open(temp_released_list_file, 'a') as released_list, \
+            open(os.path.join(target_root_dir, release_manifest_name), 'w') as release_manifest:
+        release_manifest.write('#source_root_dir={}\n#sym_link={}\n'.format(source_root_dir, sym_link))
+        for next_source_generator in source_generators:
+            logger.info('Generating release data for %s', next_source_generator)
+            for source_file in next_source_generator.generate():
+                if source_file in released:
+                    logger.warning('%s target already exists!' % source_file)
+                    continue
 
-            anc_source_root_dir = os.path.join(source_root_dir, ANC_DIR)
-            sci_source_root_dir = os.path.join(source_root_dir, SCI_DIR)
-            sdc_source_root_dir = os.path.join(source_root_dir, SDC_DIR)
-
-            if anc_source_root_dir in source_file:
-                target_file = source_file.replace(
-                    anc_source_root_dir, os.path.join(target_root_dir, ANC_DIR))
-            elif sci_source_root_dir in source_file:
-                target_file = source_file.replace(
-                    sci_source_root_dir, os.path.join(target_root_dir, SCI_DIR))
-            elif sdc_source_root_dir in source_file:
-                target_file = source_file.replace(
-                    sdc_source_root_dir, os.path.join(target_root_dir, SDC_DIR))
-            else:
-                raise Exception('File %s was not anc or sci' % target_file)
-            # Does target dir exist?
-            target_dir = os.path.dirname(target_file)
-            if not os.path.isdir(target_dir):
-                logger.info('Creating target directory %s', target_dir)
-                os.makedirs(target_dir, mode=0o755)
-
-            if os.path.isfile(target_file):
-                logger.warning('%s target already exists!' % target_file)
-                continue
+                if not is_source_file(source_file):
+                    logger.warning('Science file -%s- was not found!', source_file)
+                    continue
 
-            if sym_link:
-                #logger.debug(
-                #    'Creating symlink from %s to %s', target_file, source_file)
-                try:
-                    os.symlink(source_file, target_file)
-                    os.chmod(target_file, 0o755)
-                except FileExistsError as e:
-                    logger.debug(str(e))
+                target_file = get_site_target_file(source_file, source_root_dir, target_root_dir)
+                # Does target dir exist?
+                target_dir = os.path.dirname(target_file)
+                if target_dir not in created_dirs:
+                    if not os.path.isdir(target_dir):
+                        logger.info('Creating target directory %s', target_dir)
+                        os.makedirs(target_dir, mode=0o755)
+                    created_dirs.add(target_dir)
+
+                # symbolic links follow the source file, copies are cloned only if it is unchanged
+                signature = None if sym_link else get_release_signature(source_file)
+                if source_file in previous_release and (sym_link or previous_release[source_file] == signature) and \
+                        clone_site_file(get_site_target_file(source_file, source_root_dir, previous_site_dir), target_file):
+                    cloned += 1
+                elif os.path.isfile(target_file):
+                    logger.warning('%s target already exists!' % target_file)
                     continue
-            else:
-                logger.debug('Copying from %s to %s', source_file, target_file)
-                shutil.copy(source_file, target_file)
-            with open(temp_released_list_file, 'a') as file:
-                file.write(source_file + '\n')
+                elif sym_link:
+                    #logger.debug(
+                    #    'Creating symlink from %s to %s', target_file, source_file)
+                    try:
+                        os.symlink(source_file, target_file)
+                        os.chmod(target_file, 0o755)
+                    except FileExistsError as e:
+                        logger.debug(str(e))
+                        continue
+                else:
+                    logger.debug('Copying from %s to %s', source_file, target_file)
+                    shutil.copy(source_file, target_file)
+                released.add(source_file)
+                released_list.write(source_file + '\n')
+                release_manifest.write(source_file + ('\t' + signature if signature else '') + '\n')
+
+    logger.info('Released %s files, %s cloned from %s, %s added, %s withdrawn',
+                len(released), cloned, previous_site_dir, len(released) - cloned, len(previous_release.keys() - released))
     return temp_released_list_file
 
 
+def get_current_site_dir(root_dir):
+    '''Method used to get the site directory currently published under root_dir
+    Returns:
+        The site directory the public science link points to or None if there isn't one
+    '''
+    site_symlink_sci_dir = os.path.join(root_dir, SCI_DIR)
+    if not os.path.islink(site_symlink_sci_dir):
+        return None
+    return os.path.dirname(os.path.join(root_dir, os.readlink(site_symlink_sci_dir)))
+
+
 def build_site(root_dir,
                source_root_dir='/maven/data',
                sym_link=True,
-               dry_run=False):
+               dry_run=False,
+               incremental=True,
+               source_generators=None):
     '''Method to be used to build a MAVEN public site
     Arguments:
         root_dir - The public site root directory
         source_root_dir - The directory that contains all the maven data
         sym_link - True - use symbolic links, False - full file copies
         dry_run - If True, we don't modify the database or existing symlinks.  This is generally for testing only.   
+        incremental - If True, the new site is cloned from the published site and only the
+                      release differences are applied, otherwise the site is built in full
+        source_generators - Optional list of source generators (defaults to get_default_source_generators)
     '''
     now = time_utilities.utc_now()
+    if source_generators is None:
+        source_generators = get_default_source_generators(as_of=now)
 
     logger.info('Building site @ %s from source root %s, use sym links %s', root_dir, source_root_dir, sym_link)
 
@@ -632,7 +807,7 @@ def build_site(root_dir,
     if dry_run:
         # Only create a list of the files to be released and then immediately return
         # Results should end up in /maven/data
-        released_files_list = populate_site(source_generators=default_source_generators,
+        released_files_list = populate_site(source_generators=source_generators,
                                         source_root_dir=source_root_dir,
                                         target_root_dir=site_base_dir,
                                         sym_link=sym_link)
@@ -668,10 +843,11 @@ def build_site(root_dir,
     site_symlink_sci_dir = os.path.join(root_dir, SCI_DIR)
     site_symlink_misc_dir = os.path.join(root_dir, MISC_DIR)
     
-    released_files_list = populate_site(source_generators=default_source_generators,
+    released_files_list = populate_site(source_generators=source_generators,
                                         source_root_dir=source_root_dir,
                                         target_root_dir=site_base_dir,
-                                        sym_link=sym_link)
+                                        sym_link=sym_link,
+                                        previous_site_dir=get_current_site_dir(root_dir) if incremental else None)
     
     # This exists as like a triple check to change the permissions
     command = "find " + site_base_dir + " -type d -exec chmod 755 {} ;"
@@ -718,63 +894,183 @@ def build_site(root_dir,
 
 def clear_released():
     '''Method used to mark all science file metadata as not released'''
+    from maven_database import db_session
+    from maven_database.models import AncillaryFilesMetadata, ScienceFilesMetadata
     ScienceFilesMetadata.query.filter(ScienceFilesMetadata.released).update({ScienceFilesMetadata.released: False})
     AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.released).update({AncillaryFilesMetadata.released: False})
     db_session.commit()
 
 
 def update_released(released_file):
-    '''Method used to mark files generated by the source_generators as 'released'
+    '''Method used to mark files generated by the source_generators as 'released'.  The released
+    file names are bulk loaded into a temporary table and each metadata table is updated with a
+    single statement that sets the flag of the released files and clears the flag of any file
+    that is no longer released, all in one transaction.
     Arguments:
         released_file - file path to list of released files
     '''
-    # Clear released flags
-    # clear_released()
-
+    from sqlalchemy import or_, not_, exists, select, Table, MetaData, Column, String
+    from maven_database import db_session
+    from maven_database.models import AncillaryFilesMetadata, ScienceFilesMetadata
     with open(released_file, 'r') as f:
-        for source_file in f:
-            source_file = source_file.rstrip('\n')
-            path, base = os.path.split(source_file)
-            path_parts = path.split(os.sep)
-            meta = None
-
-            if ANC_DIR in path_parts:  # Let's try ancillary tables first for files in .../anc/
-                meta = AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.file_name == base).first()
-                if meta is None:  # File not found in anc, try sci
-                    meta = ScienceFilesMetadata.query.filter(ScienceFilesMetadata.file_name == base).first()
-            else:  # Let's try science first for files in .../sci/
-                meta = ScienceFilesMetadata.query.filter(ScienceFilesMetadata.file_name == base).first()
-                if meta is None:
-                    meta = AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.file_name == base).first()
-
-            if meta is None:
-                logger.warning("Unable to find %s in either the ancillary tables or the science tables!" % base)
-                continue
-            meta.released = True
+        released_names = sorted(set(os.path.basename(line.rstrip('\n')) for line in f if line.strip()))
+
+    connection = db_session.connection()
+    released_table = Table(released_table_name, MetaData(),
+                           Column('file_name', String, primary_key=True),
+                           prefixes=['TEMPORARY'])
+    try:
+        released_table.create(bind=connection)
+        for i in range(0, len(released_names), released_batch_size):
+            connection.execute(released_table.insert(),
+                               [{'file_name': file_name} for file_name in released_names[i:i + released_batch_size]])
+
+        for model in [ScienceFilesMetadata, AncillaryFilesMetadata]:
+            is_released = model.file_name.in_(select(released_table.c.file_name))
+            updated = db_session.query(model).filter(or_(model.released, is_released))\
+                                            .update({model.released: is_released}, synchronize_session=False)
+            logger.info('Updated the released flag of %s %s rows', updated, model.__tablename__)
+
+        unknown = select(released_table.c.file_name)\
+            .where(not_(exists().where(ScienceFilesMetadata.file_name == released_table.c.file_name)))\
+            .where(not_(exists().where(AncillaryFilesMetadata.file_name == released_table.c.file_name)))
+        for (file_name,) in connection.execute(unknown):
+            logger.warning("Unable to find %s in either the ancillary tables or the science tables!" % file_name)
+
+        released_table.drop(bind=connection)
         db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
 
 
-def check_site(root_dir):
+DeadLink = namedtuple('DeadLink', ['path', 'target'])
+
+
+def _find_dead_links(paths):
+    '''Method run on the scan_site pool to check the targets of a batch of site entries
+    Arguments:
+        paths - The fully qualified paths of the entries to check
+    Returns:
+        A list of DeadLink for the entries that aren't (or don't point to) a file or directory
+    '''
+    dead_links = []
+    for path in paths:
+        try:
+            mode = os.stat(path).st_mode
+            if stat.S_ISREG(mode) or stat.S_ISDIR(mode):
+                continue
+        except OSError:
+            pass
+        try:
+            target = os.readlink(path)
+        except OSError:
+            target = None
+        dead_links.append(DeadLink(path, target))
+    return dead_links
+
+
+def _scan_site_entries(root_dir, batch_size):
+    '''Generator used to walk a site, without following symbolic links, in batches of the entries whose
+    targets need to be checked (symbolic links and anything that isn't a regular file or directory)'''
+    batch = []
+    directories = [root_dir]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError as e:
+            logger.warning('Unable to scan %s : %s', e.filename, e.strerror)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    batch.append(entry.path)
+                elif entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif not entry.is_file(follow_symlinks=False):
+                    batch.append(entry.path)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def scan_site(root_dir, workers=None, batch_size=None):
+    '''Generator used to find the dead symbolic links of a site.  The site is walked on the calling thread,
+    without following links, while batches of links are checked on a pool of threads.
+    Arguments:
+        root_dir - The root directory to start the search for dead links
+        workers - The number of threads checking links (defaults to config.site_scan_workers)
+        batch_size - The number of links checked per task (defaults to config.site_scan_batch_size)
+    Generates:
+        A DeadLink (fully qualified path of the link, link target) for each dead link.
+    '''
+    workers = workers or config.site_scan_workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in _scan_site_entries(root_dir, batch_size or config.site_scan_batch_size):
+            pending.append(executor.submit(_find_dead_links, batch))
+            # bound the batches in flight so the walk doesn't run far ahead of the checks
+            while len(pending) > 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def check_site(root_dir, workers=None):
     '''Generator used to report the symbolic links that no longer point to valid MAVEN science files
     Arguments:
         root_dir - The root directory to start the search for dead links
+        workers - The number of threads checking links (defaults to config.site_scan_workers)
     Generates:
         A fully qualified path to a dead link.
     '''
-    for dirpath, _, filenames in os.walk(root_dir, followlinks=True):
-        for filename in [os.path.join(dirpath, filename) for filename in filenames]:
-            if not os.path.isfile(filename):
-                yield filename
+    for dead_link in scan_site(root_dir, workers=workers):
+        yield dead_link.path
 
 
-def clean_site(root_dir):
-    '''Method used to remove any dead symlinks
+def _remove_dead_links(dead_links):
+    '''Method run on the clean_site pool to remove a batch of dead links
+    Returns:
+        The number of links removed
+    '''
+    removed = 0
+    for dead_link in dead_links:
+        logger.info('Removing dead symlink %s', dead_link.path)
+        try:
+            os.unlink(dead_link.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def clean_site(root_dir, workers=None, report=None):
+    '''Method used to remove any dead symlinks.  The links are removed, in batches, on a pool of threads
+    as they are found.
      Arguments:
         root_dir - The root directory to start the search for dead links
+        workers - The number of threads checking and removing links (defaults to config.site_scan_workers)
+        report - Optional callable called with each DeadLink before it is removed
+    Returns:
+        The number of dead links removed
     '''
-    for next_link in check_site(root_dir):
-        logger.info('Removing dead symlink %s', next_link)
-        os.unlink(next_link)
+    workers = workers or config.site_scan_workers
+    batch_size = config.site_scan_batch_size
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        removals = []
+        batch = []
+        for dead_link in scan_site(root_dir, workers=workers):
+            if report is not None:
+                report(dead_link)
+            batch.append(dead_link)
+            if len(batch) >= batch_size:
+                removals.append(executor.submit(_remove_dead_links, batch))
+                batch = []
+        if batch:
+            removals.append(executor.submit(_remove_dead_links, batch))
+        return sum(removal.result() for removal in removals)
 
 
 def remove_old_sites(root_dir, from_time=None):
@@ -813,62 +1109,66 @@ def remove_old_sites(root_dir, from_time=None):
             shutil.rmtree(os.path.join(root_dir, next_dir))
 
 
-def walk_through_pds(url, ppi=False):
-    ''' This method walks through the given URL, finds files that match the science files regex, and returns the list of files.
+def pds_month_urls(url, ppi=False, window=None):
+    '''Method used to get the url of each month of the public release window under a PDS data product url
     Arguments:
-        url: The URL where you would like to begin the walk.
-    Returns: A list of files under that url that match maven science files
+        url: The URL of the data product
+        ppi: Whether or not url is a ppi query (instead of an atmospheres directory)
+        window: Optional (start, end) public release window (defaults to the current public_release_window)
+    Returns: A list of urls, one per month
     '''
+    window_start, window_end = window or public_release_window()
+    pds_data_urls = []
+    year, month = window_start.year, window_start.month
+    while datetime.datetime(year, month, 1, tzinfo=pytz.UTC) <= window_end:  # Stop if exceeding release window
+        year_string = str(year)
+        month_string = str(month).zfill(2)
+        _, end_day = monthrange(year, month)
+
+        if ppi:
+            # The following string looks super messy, but the point is to limit PPI API queries to certain months to avoid generating large amounts of files at a time.
+            # Without all of the odd characters, the string below looks reads something like this:
+            # " AND start_date_time:[* TO 2015-11-01T23:59:59Z] AND stop_date_time:[2014-10-01T00:00:00Z TO *]"
+            ppi_date_query_string = f"%20AND%20start_date_time:%5B*%20TO%20{year_string}-{month_string}-{end_day}T23:59:59Z%5D%20AND%20stop_date_time:%5B{year_string}-{month_string}-01T00:00:00Z%20TO%20*%5D"
+            pds_data_urls.append(url + ppi_date_query_string + config.ppi_suffix)
+            # A sample full URL that actually works is:
+            # https://pds-ppi.igpp.ucla.edu/metadex/product/select?q=collection_id:%22urn:nasa:pds:maven.euv.modelled:data.daily.spectra%22%20AND%20start_date_time:%5B*%20TO%202015-02-01T23:59:59Z%5D%20AND%20stop_date_time:%5B2014-10-11T00:00:00Z%20TO%20*%5D&rows=10000&indent=on&wt=json
+        else:
+            pds_data_urls.append(os.path.join(url, year_string, month_string))
 
-    start_year = public_release_window_date_start.year
-    end_year = public_release_window_date_end.year
-    released_files_list = []
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return pds_data_urls
 
-    for year in range(start_year,end_year+1): # Loops through years
 
-        #Determine which months to loop through
-        if year is start_year:
-            start_month = public_release_window_date_start.month
-        else:
-            start_month = 1
-        months = range(start_month, 13)
-
-        for month in months: # Loops through months
-            page_date = datetime.datetime(year, month, 1, tzinfo=pytz.UTC)
-            if (public_release_window_date_end - page_date).days < 0:  # Stop if exceeding release window
-                # Return the found files
-                return released_files_list
-
-            
-            year_string = str(year)
-            month_string = str(month).zfill(2)
-            _, end_day = monthrange(year, month)
-            
-
-            if ppi:
-                # The following string looks super messy, but the point is to limit PPI API queries to certain months to avoid generating large amounts of files at a time.  
-                # Without all of the odd characters, the string below looks reads something like this:
-                # " AND start_date_time:[* TO 2015-11-01T23:59:59Z] AND stop_date_time:[2014-10-01T00:00:00Z TO *]"
-                ppi_date_query_string = f"%20AND%20start_date_time:%5B*%20TO%20{year_string}-{month_string}-{end_day}T23:59:59Z%5D%20AND%20stop_date_time:%5B{year_string}-{month_string}-01T00:00:00Z%20TO%20*%5D"
-                pds_data_url = url + ppi_date_query_string + config.ppi_suffix
-                # A sample full URL that actually works is: 
-                # https://pds-ppi.igpp.ucla.edu/metadex/product/select?q=collection_id:%22urn:nasa:pds:maven.euv.modelled:data.daily.spectra%22%20AND%20start_date_time:%5B*%20TO%202015-02-01T23:59:59Z%5D%20AND%20stop_date_time:%5B2014-10-11T00:00:00Z%20TO%20*%5D&rows=10000&indent=on&wt=json
-            else:
-                pds_data_url = os.path.join(url, year_string, month_string)
-
-            # Grabs the data page and returns the page as a string
-            try:
-                page = urlopen(pds_data_url)
-            except HTTPError:
-                logger.warning("The page [%s] doesn't appear to exist.", pds_data_url)
-                continue
-            try:
-                page_as_string = page.read().decode("utf-8")
-            except Exception:
-                logger.warning("The page [%s] could not be read.", pds_data_url)
-                continue
-            # Find all science files
-            science_files_found = list(set(re.findall(config.pds_regex, page_as_string)))
-            released_files_list.extend(science_files_found)
+def crawl_pds(urls, ppi=False, crawler=None, window=None):
+    '''Method used to find the released science files under several data product urls.  The pages of every
+    month of every url are fetched concurrently.
+    Arguments:
+        urls: The URLs of the data products
+        ppi: Whether or not the urls are ppi queries (instead of atmospheres directories)
+        crawler: Optional pds_crawler.PdsCrawler used to fetch the pages (defaults to a PdsCrawler using the configured cache)
+        window: Optional (start, end) public release window (defaults to the current public_release_window)
+    Returns: {url: list of files under that url that match maven science files}
+    '''
+    crawler = crawler or pds_crawler.PdsCrawler()
+    window = window or public_release_window()
+    month_urls = [(url, pds_data_url) for url in urls for pds_data_url in pds_month_urls(url, ppi, window)]
+    released_files = {url: [] for url in urls}
+    for (url, _), page_as_string in zip(month_urls, crawler.fetch_all(pds_data_url for _, pds_data_url in month_urls)):
+        if page_as_string is None:
+            continue
+        # Find all science files
+        released_files[url].extend(set(re.findall(config.pds_regex, page_as_string)))
+    return released_files
+
 
-    return released_files_list
+def walk_through_pds(url, ppi=False, crawler=None, window=None):
+    ''' This method walks through the given URL, finds files that match the science files regex, and returns the list of files.
+    Arguments:
+        url: The URL where you would like to begin the walk.
+        ppi: Whether or not url is a ppi query (instead of an atmospheres directory)
+        crawler: Optional pds_crawler.PdsCrawler used to fetch the pages
+        window: Optional (start, end) public release window (defaults to the current public_release_window)
+    Returns: A list of files under that url that match maven science files
+    '''
+    return crawl_pds([url], ppi=ppi, crawler=crawler, window=window)[url]
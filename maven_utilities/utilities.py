@@ -38,6 +38,27 @@ def files_are_same(file1, file2):
     return False
 
     
+class HashingReader():
+    '''File like wrapper that updates a hash with every byte read through it.  Used
+    to compute a checksum in the same pass that copies a file (e.g. into a tar).
+    '''
+
+    def __init__(self, fileobj, hash_constructor=hashlib.md5):
+        self.fileobj = fileobj
+        self.hash = hash_constructor()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        '''Returns the hex digest of the bytes read so far'''
+        return self.hash.hexdigest()
+
+
 def is_compressed_format(filename):
     '''Method used to determine if the provided file is in gzip format
     Returns:
@@ -24,5 +24,13 @@ if __name__ == '__main__':
                            'report': args.report,
                            'notes':args.notes,
                            'override': args.override,
-                           'skip_missing_labels':args.skip_missing_labels}
+                           'skip_missing_labels':args.skip_missing_labels,
+                           'compression_level': args.compression_level,
+                           'compression_threads': args.compression_threads,
+                           'verify': args.verify,
+                           'jobs': args.jobs,
+                           'volume_size': args.volume_size,
+                           'estimate': args.estimate,
+                           'estimate_output': args.estimate_output,
+                           'skip_bundle_verify': args.skip_bundle_verify}
                            )
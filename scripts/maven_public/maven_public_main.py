@@ -27,6 +27,9 @@ def parse_arguments(arguments):
     parser.add_argument('-d', '--dry-run',
                         action='store_true',
                         help='If True, only a list of files to release will be printed out at /maven/data. No files will be released.')
+    parser.add_argument('-f', '--full',
+                        action='store_true',
+                        help='If True, the site is built in full instead of from the currently published site.')
     return parser.parse_args(arguments)
 
 
@@ -40,4 +43,5 @@ if __name__ == '__main__':
 
     maven_public_utils.build_site(root_dir=args.root_dir,
                                   sym_link=args.symbolic_links,
-                                  dry_run=args.dry_run)
+                                  dry_run=args.dry_run,
+                                  incremental=not args.full)
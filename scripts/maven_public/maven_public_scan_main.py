@@ -11,6 +11,7 @@ import sys
 import argparse
 
 from maven_public import utilities as maven_public_utils
+from maven_utilities import maven_log
 
 
 def parse_arguments(arguments):
@@ -23,6 +24,11 @@ def parse_arguments(arguments):
     parser.add_argument('-r', '--remove-links',
                         action='store_true',
                         help='If True, dead symlinks will be removed from the system, if False, dead symlinks will be reported.')
+    parser.add_argument('-o', '--report',
+                        help='The file the dead symlinks (and their targets) are reported to.  Defaults to stdout.')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        help='The number of threads used to check and remove symlinks.')
     return parser.parse_args(arguments)
 
 
@@ -32,8 +38,18 @@ if __name__ == '__main__':
 
     assert os.path.isdir(args.root_dir), '%s is not a directory!' % args.root_dir
 
-    if args.delete_links:
-        maven_public_utils.clean_site(args.root_dir)
-    else:
-        for next_link in maven_public_utils.check_site(args.root_dir):
-            print next_link
+    maven_log.config_logging()
+
+    report = open(args.report, 'w') if args.report else sys.stdout
+    try:
+        def report_link(dead_link):
+            report.write('{} -> {}\n'.format(dead_link.path, dead_link.target))
+
+        if args.remove_links:
+            maven_public_utils.clean_site(args.root_dir, workers=args.workers, report=report_link if args.report else None)
+        else:
+            for dead_link in maven_public_utils.scan_site(args.root_dir, workers=args.workers):
+                report_link(dead_link)
+    finally:
+        if report is not sys.stdout:
+            report.close()
@@ -0,0 +1,242 @@
+'''
+Local HTTP stand-in for the Glacier endpoint used by the aws_archiving tests, and
+helpers to set up a local inventory database.  The tests talk to it through boto's
+own Layer1, so the requests are built, signed and sent the way they are in production.
+'''
+import io
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+from boto.glacier.layer1 import Layer1
+from boto.glacier.layer2 import Layer2
+from boto.glacier.utils import compute_hashes_from_fileobj
+from boto.regioninfo import RegionInfo
+
+from aws_archiving import models
+from aws_archiving.models import GlacierVault, GlacierArchive, GlacierArchiveFile, ErrorLog
+
+UPLOAD_PATH = re.compile(r'^/-/vaults/(?P<vault>[^/]+)/multipart-uploads(?:/(?P<upload_id>[^/]+))?$')
+VAULT_PATH = re.compile(r'^/-/vaults/(?P<vault>[^/]+)$')
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/\*$')
+
+
+def init_test_inventory(db_path):
+    '''Points the inventory at a new sqlite database file and creates its tables'''
+    models.db.init(db_path)
+    models.db.create_tables([GlacierVault, GlacierArchive, GlacierArchiveFile, ErrorLog], safe=True)
+
+
+def compute_hashes(data):
+    '''Returns the (linear hash, tree hash) of data as the str hex digests Glacier's JSON holds'''
+    return tuple(h if isinstance(h, str) else h.decode('ascii') for h in compute_hashes_from_fileobj(io.BytesIO(data)))
+
+
+class GlacierError(Exception):
+
+    def __init__(self, status, code):
+        super(GlacierError, self).__init__(code)
+        self.status = status
+        self.code = code
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class GlacierRequestHandler(BaseHTTPRequestHandler):
+    '''Answers the multipart upload requests of boto's Layer1 from the state of the
+    GlacierStandIn serving it'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_glacier_request()
+
+    def do_POST(self):
+        self.handle_glacier_request()
+
+    def do_PUT(self):
+        self.handle_glacier_request()
+
+    def do_DELETE(self):
+        self.handle_glacier_request()
+
+    def handle_glacier_request(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            self.server.glacier.record_request(self.command, url.path, self.headers)
+            if not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 ') or 'x-amz-date' not in self.headers:
+                raise GlacierError(403, 'MissingAuthenticationTokenException')
+            if self.headers.get('x-amz-glacier-version') != '2012-06-01':
+                raise GlacierError(400, 'InvalidParameterValueException')
+            upload_path = UPLOAD_PATH.match(url.path)
+            vault_path = VAULT_PATH.match(url.path)
+            if vault_path and self.command == 'GET':
+                self.send_json(200, self.server.glacier.describe_vault(vault_path.group('vault')))
+            elif not upload_path:
+                raise GlacierError(404, 'ResourceNotFoundException')
+            else:
+                self.route_upload_request(upload_path.group('upload_id'), parse_qs(url.query), body)
+        except GlacierError as e:
+            self.send_json(e.status, {'code': e.code, 'message': e.code, 'type': 'Client'})
+
+    def route_upload_request(self, upload_id, query, body):
+        glacier = self.server.glacier
+        if self.command == 'POST' and upload_id is None:
+            upload_id = glacier.initiate_multipart_upload(int(self.headers['x-amz-part-size']))
+            self.send_empty(201, {'x-amz-multipart-upload-id': upload_id,
+                                  'Location': '{}/{}'.format(self.path, upload_id)})
+        elif upload_id is None:
+            raise GlacierError(404, 'ResourceNotFoundException')
+        elif self.command == 'PUT':
+            byte_range = CONTENT_RANGE.match(self.headers.get('Content-Range', ''))
+            if not byte_range:
+                raise GlacierError(400, 'InvalidParameterValueException')
+            tree_hash = glacier.upload_part(upload_id, self.headers['x-amz-content-sha256'],
+                                            self.headers['x-amz-sha256-tree-hash'],
+                                            (int(byte_range.group(1)), int(byte_range.group(2))), body)
+            self.send_empty(204, {'x-amz-sha256-tree-hash': tree_hash})
+        elif self.command == 'GET':
+            self.send_json(200, glacier.list_parts(upload_id, query.get('marker', [None])[0]))
+        elif self.command == 'POST':
+            archive_id = glacier.complete_multipart_upload(upload_id, self.headers['x-amz-sha256-tree-hash'],
+                                                           int(self.headers['x-amz-archive-size']))
+            self.send_empty(201, {'x-amz-archive-id': archive_id,
+                                  'Location': '/-/vaults/{}/archives/{}'.format(glacier.vault_name, archive_id)})
+        elif self.command == 'DELETE':
+            glacier.abort_multipart_upload(upload_id)
+            self.send_empty(204)
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GlacierStandIn(object):
+    '''Serves a single vault on a local port.  Multipart uploads and archives are kept in
+    memory and the hashes sent with them are checked the way Glacier does.  Unknown upload
+    ids get a 404, like expired uploads.'''
+
+    def __init__(self, vault_name='test-vault', list_parts_page_size=2):
+        self.vault_name = vault_name
+        self.uploads = {}
+        self.archives = {}
+        self.failing_parts = set()  # start offsets of the parts whose next upload fails
+        self.part_uploads = 0
+        self.upload_count = 0
+        self.list_parts_page_size = list_parts_page_size
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), GlacierRequestHandler)
+        self.server.glacier = self
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get_vault(self):
+        '''Returns a boto vault whose Layer1 sends its requests to this stand-in'''
+        layer1 = Layer1(aws_access_key_id='stand-in', aws_secret_access_key='stand-in',
+                        region=RegionInfo(name='us-west-2', endpoint='127.0.0.1'),
+                        port=self.server.server_port, is_secure=False)
+        # an http_proxy in the environment mustn't take the requests off this host
+        layer1.use_proxy = False
+        # sign for the region and service a Glacier host name gives, not the parts of 127.0.0.1
+        layer1._auth_handler.region_name = 'us-west-2'
+        layer1._auth_handler.service_name = 'glacier'
+        return Layer2(layer1=layer1).get_vault(self.vault_name)
+
+    def record_request(self, method, path, headers):
+        with self.lock:
+            self.requests.append((method, path, headers.get('Authorization')))
+
+    def get_upload_parts(self, upload_id):
+        if upload_id not in self.uploads:
+            raise GlacierError(404, 'ResourceNotFoundException')
+        return self.uploads[upload_id]
+
+    def describe_vault(self, vault_name):
+        if vault_name != self.vault_name:
+            raise GlacierError(404, 'ResourceNotFoundException')
+        with self.lock:
+            return {'VaultName': vault_name,
+                    'VaultARN': 'arn:aws:glacier:us-west-2:000000000000:vaults/{}'.format(vault_name),
+                    'CreationDate': '2012-06-01T00:00:00.000Z', 'LastInventoryDate': None,
+                    'NumberOfArchives': len(self.archives),
+                    'SizeInBytes': sum(len(data) for data in self.archives.values())}
+
+    def initiate_multipart_upload(self, part_size):
+        with self.lock:
+            self.upload_count += 1
+            upload_id = 'upload-{}'.format(self.upload_count)
+            self.uploads[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, upload_id, linear_hash, tree_hash, byte_range, part_data):
+        with self.lock:
+            parts = self.get_upload_parts(upload_id)
+            self.part_uploads += 1
+            if byte_range[0] in self.failing_parts:
+                self.failing_parts.discard(byte_range[0])
+                # not a 5xx, which boto would retry itself
+                raise GlacierError(408, 'RequestTimeoutException')
+        if (linear_hash, tree_hash) != compute_hashes(part_data) or byte_range[1] - byte_range[0] + 1 != len(part_data):
+            raise GlacierError(400, 'InvalidParameterValueException')
+        with self.lock:
+            parts[byte_range[0]] = (part_data, tree_hash)
+        return tree_hash
+
+    def list_parts(self, upload_id, marker=None):
+        with self.lock:
+            parts = sorted(self.get_upload_parts(upload_id).items())
+        start = int(marker or 0)
+        page = parts[start:start + self.list_parts_page_size]
+        next_marker = start + len(page)
+        return {'Parts': [{'RangeInBytes': '{}-{}'.format(offset, offset + len(data) - 1), 'SHA256TreeHash': tree_hash}
+                          for offset, (data, tree_hash) in page],
+                'Marker': str(next_marker) if next_marker < len(parts) else None}
+
+    def complete_multipart_upload(self, upload_id, sha256_treehash, archive_size):
+        with self.lock:
+            parts = self.get_upload_parts(upload_id)
+            data = b''.join(part_data for _, (part_data, _) in sorted(parts.items()))
+            if len(data) != archive_size or compute_hashes(data)[1] != sha256_treehash:
+                raise GlacierError(400, 'InvalidParameterValueException')
+            del self.uploads[upload_id]
+            archive_id = 'archive-{}'.format(upload_id)
+            self.archives[archive_id] = data
+        return archive_id
+
+    def abort_multipart_upload(self, upload_id):
+        with self.lock:
+            self.get_upload_parts(upload_id)
+            del self.uploads[upload_id]
+
+    def expire(self, upload_id):
+        '''Forgets an upload, as Glacier does after a period of inactivity'''
+        with self.lock:
+            del self.uploads[upload_id]
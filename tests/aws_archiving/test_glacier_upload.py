@@ -0,0 +1,129 @@
+'''
+Unit tests for the resumable multipart Glacier uploads, run against a local HTTP Glacier stand-in
+'''
+import os
+import shutil
+import unittest
+import pytest
+
+pytest.importorskip('boto')
+pytest.importorskip('peewee')
+
+from aws_archiving import glacier_upload
+from aws_archiving.models import GlacierVault, GlacierUpload, GlacierUploadPart
+from tests.aws_archiving.glacier_stand_in import GlacierStandIn, compute_hashes, init_test_inventory
+from tests.maven_test_utilities import file_system
+
+MB = 1024 * 1024
+
+
+class TestGlacierUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        init_test_inventory(os.path.join(self.test_root, 'inventory.sqlite3'))
+        self.glacier_vault = GlacierVault.create(aws_region='us-west-2', vault_name='test-vault')
+        self.glacier = GlacierStandIn()
+        self.glacier.start()
+        self.vault = self.glacier.get_vault()
+        self.tarball = os.path.join(self.test_root, 'test.tar')
+        with open(self.tarball, 'wb') as f:
+            f.write(os.urandom(5 * MB + 12345))
+        with open(self.tarball, 'rb') as f:
+            self.tarball_data = f.read()
+
+    def tearDown(self):
+        self.glacier.stop()
+        glacier_upload.models.db.close()
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+
+    def get_uploader(self, retries=0):
+        return glacier_upload.MultipartUploader(self.vault, self.glacier_vault, part_size=MB, threads=3, retries=retries)
+
+    def testTreeHash(self):
+        '''The archive tree hash built from the part hashes matches boto's single pass hashes
+        (compute_hashes_from_fileobj)'''
+        for size in [1, MB - 1, MB, 3 * MB + 5, 5 * MB + 12345]:
+            data = self.tarball_data[:size]
+            for part_size in [MB, 2 * MB, 4 * MB]:
+                parts = [data[i:i + part_size] for i in range(0, size, part_size)]
+                part_tree_hashes = [glacier_upload.part_hashes(part)[1] for part in parts]
+                self.assertEqual(compute_hashes(data)[1], glacier_upload.archive_tree_hash(part_tree_hashes), (size, part_size))
+            self.assertEqual(compute_hashes(data), glacier_upload.part_hashes(data))
+
+    def testSignedRequests(self):
+        '''The upload goes through boto's Layer1 over HTTP, every request signed'''
+        archive_id = self.get_uploader().upload(self.tarball)
+        self.assertEqual(self.tarball_data, self.glacier.archives[archive_id])
+        methods = [method for method, _, _ in self.glacier.requests]
+        # describe the vault, initiate, the 6 parts, complete
+        self.assertEqual(['GET', 'POST'] + ['PUT'] * 6 + ['POST'], methods)
+        for _, _, authorization in self.glacier.requests:
+            self.assertRegex(authorization, r'^AWS4-HMAC-SHA256 Credential=stand-in/\d{8}/us-west-2/glacier/aws4_request,SignedHeaders=')
+
+    def testResumeAfterFailedPart(self):
+        '''An upload that failed on one part resumes with only that part'''
+        self.glacier.failing_parts = {2 * MB}
+        with self.assertRaises(Exception):
+            self.get_uploader().upload(self.tarball)
+        self.assertEqual([self.tarball], glacier_upload.get_pending_uploads(self.glacier_vault))
+        self.assertEqual(5, GlacierUploadPart.select().count())
+
+        part_uploads = self.glacier.part_uploads
+        archive_id = self.get_uploader().upload(self.tarball)
+        self.assertEqual(1, self.glacier.part_uploads - part_uploads)
+        self.assertEqual(self.tarball_data, self.glacier.archives[archive_id])
+        self.assertEqual(1, self.glacier.upload_count)
+        self.assertEqual([], glacier_upload.get_pending_uploads(self.glacier_vault))
+        self.assertEqual(0, GlacierUpload.select().count())
+        self.assertEqual(0, GlacierUploadPart.select().count())
+
+    def testReconcileUnrecordedParts(self):
+        '''Parts Glacier received but that weren't recorded are adopted, recorded parts it
+        doesn't have are uploaded again'''
+        uploader = self.get_uploader()
+        upload = uploader.get_upload(self.tarball, len(self.tarball_data), self.get_modification_time(), MB, self.tarball)
+        # interrupted before parts 0, 1, 2 and 4 were recorded
+        for part_index in [0, 1, 2, 4]:
+            uploader.upload_part(self.tarball, upload.upload_id, part_index, MB)
+        # recorded with a hash Glacier doesn't have, or not received at all
+        GlacierUploadPart.create(glacier_upload=upload, part_index=1, tree_hash='0' * 64)
+        GlacierUploadPart.create(glacier_upload=upload, part_index=3, tree_hash='0' * 64)
+
+        self.assertTrue(uploader.reconcile_parts(upload))
+        self.assertEqual([0, 1, 2, 4], sorted(part.part_index for part in upload.parts))
+
+        part_uploads = self.glacier.part_uploads
+        archive_id = uploader.upload(self.tarball)
+        self.assertEqual(2, self.glacier.part_uploads - part_uploads)
+        self.assertEqual(self.tarball_data, self.glacier.archives[archive_id])
+
+    def testExpiredUpload(self):
+        '''An upload Glacier no longer knows (404) is discarded and started over'''
+        self.glacier.failing_parts = {0}
+        with self.assertRaises(Exception):
+            self.get_uploader().upload(self.tarball)
+        upload = GlacierUpload.get()
+        self.glacier.expire(upload.upload_id)
+
+        archive_id = self.get_uploader().upload(self.tarball)
+        self.assertEqual(self.tarball_data, self.glacier.archives[archive_id])
+        self.assertEqual(2, self.glacier.upload_count)
+        self.assertEqual(0, GlacierUpload.select().count())
+        self.assertEqual(0, GlacierUploadPart.select().count())
+
+    def testChangedFileStartsOver(self):
+        '''An upload isn't resumed once the file changed'''
+        self.glacier.failing_parts = {0}
+        with self.assertRaises(Exception):
+            self.get_uploader().upload(self.tarball)
+        os.utime(self.tarball, (0, 0))
+
+        archive_id = self.get_uploader().upload(self.tarball)
+        self.assertEqual(self.tarball_data, self.glacier.archives[archive_id])
+        self.assertEqual(2, self.glacier.upload_count)
+        self.assertEqual({}, self.glacier.uploads)
+
+    def get_modification_time(self):
+        return glacier_upload.datetime.datetime.fromtimestamp(os.path.getmtime(self.tarball))
@@ -0,0 +1,209 @@
+'''
+Unit tests for finding, archiving and inventorying files, run against a local HTTP Glacier stand-in
+'''
+import os
+import shutil
+import tarfile
+import datetime
+import hashlib
+import threading
+import unittest
+import pytest
+from mock import patch
+
+pytest.importorskip('boto')
+pytest.importorskip('peewee')
+
+from aws_archiving import utilities, config
+from aws_archiving.models import GlacierVault, GlacierArchive, GlacierArchiveFile, GlacierUpload, LatestGlacierArchiveFile
+from tests.aws_archiving.glacier_stand_in import GlacierStandIn, init_test_inventory
+from tests.maven_test_utilities import file_system
+
+AWS_REGION = 'us-west-2'
+VAULT_NAME = 'test-vault'
+
+
+class TestAwsArchivingUtilities(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.data_root = os.path.join(self.test_root, 'data')
+        init_test_inventory(os.path.join(self.test_root, 'inventory.sqlite3'))
+        self.glacier_vault = GlacierVault.create(aws_region=AWS_REGION, vault_name=VAULT_NAME)
+        self.glacier = GlacierStandIn(VAULT_NAME)
+        self.glacier.start()
+        self.vault = self.glacier.get_vault()
+        self.patches = [patch.object(utilities, 'get_vault', return_value=self.vault),
+                        patch.object(config, 'tarball_directory', os.path.join(self.test_root, 'tarballs')),
+                        patch.object(config, 'use_upload', True),
+                        patch.object(config, 'delete_tarball', True)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.glacier.stop()
+        utilities.models.db.close()
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+
+    def build_files(self, file_names, contents='something to fill the file'):
+        return file_system.build_test_files_and_structure(default_file_contents=contents,
+                                                          files_base_dir=self.data_root,
+                                                          files_list=file_names)
+
+    def get_new_or_changed_files(self, excluded_directories=[]):
+        return utilities.get_dict_of_new_or_changed_files(self.data_root, AWS_REGION, VAULT_NAME, excluded_directories)
+
+    def inventory_files(self, file_paths, md5_hash=''):
+        '''Records the files in the inventory as they are on disk'''
+        archive = GlacierArchive.create(glacier_vault=self.glacier_vault, glacier_id='archive', glacier_description='test',
+                                        md5_hash='', when_archived=datetime.datetime.utcnow())
+        for file_path in file_paths:
+            st = os.stat(file_path)
+            GlacierArchiveFile.create(glacier_archive=archive, file_path=file_path, file_size=st.st_size, md5_hash=md5_hash,
+                                      modification_time=datetime.datetime.fromtimestamp(st.st_mtime))
+
+    def testWalkMergeOrder(self):
+        '''The walk yields files in the order sqlite sorts their paths, so inventoried files
+        are matched across the separator boundaries'''
+        files = self.build_files(['a.txt', 'a/x', 'a b/y', 'a0', 'a/b/z', 'a-b', 'excluded/e', 'b'])
+        os.symlink(os.path.join(self.data_root, 'a'), os.path.join(self.data_root, 'a_link'))
+        os.symlink(os.path.join(self.data_root, 'b'), os.path.join(self.data_root, 'b_link'))
+        excluded_directories = [utilities.clean_directory_name(os.path.join(self.data_root, 'excluded'))]
+
+        walked = [file_path for file_path, _ in utilities.walk_files(self.data_root, excluded_directories)]
+        expected = sorted([f for f in files if '/excluded/' not in f] + [os.path.join(self.data_root, 'b_link')])
+        self.assertEqual(expected, walked)
+        self.assertEqual(set(expected), set(self.get_new_or_changed_files(excluded_directories)))
+
+        # every file but one at each boundary is inventoried, the merge doesn't report them
+        new_files = [os.path.join(self.data_root, name) for name in ['a b/y', 'a/b/z', 'a0']]
+        self.inventory_files([f for f in expected if f not in new_files])
+        self.assertEqual([f.file_path for f in LatestGlacierArchiveFile.select().order_by(LatestGlacierArchiveFile.file_path)],
+                         [f for f in walked if f not in new_files])
+        self.assertEqual(sorted(new_files), sorted(self.get_new_or_changed_files(excluded_directories)))
+        self.inventory_files(new_files)
+        self.assertEqual({}, self.get_new_or_changed_files(excluded_directories))
+
+        # only the latest archived version of a file counts
+        with open(files[0], 'a') as f:
+            f.write('more')
+        self.assertEqual([files[0]], list(self.get_new_or_changed_files(excluded_directories)))
+        self.inventory_files(files[:1])
+        self.assertEqual({}, self.get_new_or_changed_files(excluded_directories))
+
+    def testContentHashDedup(self):
+        '''Touched files are only archived again if their content changed, and the unchanged
+        ones aren't hashed again on the next run'''
+        files = self.build_files(['f{}'.format(i) for i in range(5)])
+        self.inventory_files(files, md5_hash=hashlib.md5(b'something to fill the file').hexdigest())
+        changed = files[1]
+        with open(changed, 'w') as f:
+            f.write('SOMETHING TO FILL THE FILE')
+        for file_path in files:
+            os.utime(file_path, (1000000000, 1000000000))
+
+        with patch.object(config, 'use_content_hash', False):
+            self.assertEqual(set(files), set(self.get_new_or_changed_files()))
+
+        with patch.object(config, 'use_content_hash', True), \
+                patch.object(config, 'content_hash_batch_size', 2), \
+                patch.object(utilities, 'get_md5_hashes', side_effect=utilities.get_md5_hashes) as get_md5_hashes:
+            new_or_changed = self.get_new_or_changed_files()
+            self.assertEqual([changed], list(new_or_changed))
+            self.assertEqual(hashlib.md5(b'SOMETHING TO FILL THE FILE').hexdigest(), new_or_changed[changed]['md5_hash'])
+            self.assertEqual(sorted(files), sorted(f for args, _ in get_md5_hashes.call_args_list for f in args[0]))
+
+            get_md5_hashes.reset_mock()
+            self.assertEqual([changed], list(self.get_new_or_changed_files()))
+            self.assertEqual([[changed]], [args[0] for args, _ in get_md5_hashes.call_args_list if args[0]])
+
+        touched_time = datetime.datetime.fromtimestamp(1000000000)
+        self.assertEqual(sorted(f for f in files if f != changed),
+                         sorted(f.file_path for f in LatestGlacierArchiveFile.select().where(LatestGlacierArchiveFile.modification_time == touched_time)))
+
+    def testTarballManifest(self):
+        '''The manifest lists the files tar added with the walk's size and modification time and
+        their md5 hashes, and is what the inventory is recorded from'''
+        files = self.build_files(['m0', 'with space', 'pre_hashed', 'pre_hashed_gone', 'gone'])
+        file_dict = self.get_new_or_changed_files()
+        file_dict[files[2]]['md5_hash'] = 'md5 from the dedup stage'
+        file_dict[files[3]]['md5_hash'] = 'md5 from the dedup stage'
+        expected = dict((f, dict(file_dict[f])) for f in files[:3])
+        os.remove(files[3])
+        os.remove(files[4])
+
+        with patch.object(utilities, 'get_md5_hashes', side_effect=utilities.get_md5_hashes) as get_md5_hashes, \
+                patch.object(utilities, 'get_md5_hash', side_effect=utilities.get_md5_hash) as get_md5_hash:
+            tarball = utilities.build_tarball(file_dict)
+        self.assertEqual({}, file_dict)
+        self.assertEqual([sorted(files[:2] + files[4:])], [args[0] for args, _ in get_md5_hashes.call_args_list])
+        # the tarball is hashed while it is written, not read back
+        self.assertNotIn(tarball, [args[0] for args, _ in get_md5_hash.call_args_list])
+        self.assertEqual([os.path.basename(tarball), os.path.basename(utilities.get_manifest_path(tarball))],
+                         sorted(os.listdir(os.path.dirname(tarball))))
+        tarball_md5_hash, rows = utilities.read_tarball_manifest(tarball)
+        self.assertEqual(utilities.get_md5_hash(tarball), tarball_md5_hash)
+        self.assertEqual(sorted(expected), [row['file_path'] for row in rows])
+        for row in rows:
+            info = expected[row['file_path']]
+            self.assertEqual(info['file_size'], row['file_size'])
+            self.assertEqual(info['modification_time'], row['modification_time'])
+            self.assertEqual(info.get('md5_hash') or utilities.get_md5_hash(row['file_path']), row['md5_hash'])
+        with tarfile.open(tarball) as tf:
+            self.assertEqual(sorted(expected), sorted(os.path.join('/', name) for name in tf.getnames()))
+
+        with patch.object(config, 'inventory_insert_batch_size', 2):
+            utilities.add_archive_to_inventory(tarball, 'archive', AWS_REGION, VAULT_NAME)
+        archive = GlacierArchive.get()
+        self.assertEqual(tarball_md5_hash, archive.md5_hash)
+        self.assertEqual('wal', utilities.models.db.execute_sql('PRAGMA journal_mode').fetchone()[0])
+        self.assertEqual([(row['file_path'], row['file_size'], row['md5_hash'], row['modification_time']) for row in rows],
+                         [(f.file_path, f.file_size, f.md5_hash, f.modification_time)
+                          for f in archive.files.order_by(GlacierArchiveFile.file_path)])
+        utilities.clean_tarball(tarball)
+        self.assertEqual([], os.listdir(config.tarball_directory))
+
+    def testUploadedArchiveInventoriedAfterBuildFailure(self):
+        '''A tarball that finishes uploading after the build stage failed is still inventoried'''
+        self.build_files(['a{}'.format(i) for i in range(4)])
+        build_tarball = utilities.build_tarball
+        put_unless_stopped = utilities.put_unless_stopped
+        builds = []
+        build_stopped = threading.Event()
+
+        def build_then_fail(file_dict):
+            builds.append(file_dict)
+            if len(builds) > 1:
+                raise IOError('build failed')
+            return build_tarball(file_dict)
+
+        def put_then_signal(q, item, stop):
+            put_unless_stopped(q, item, stop)
+            if item is None:
+                build_stopped.set()
+
+        complete_multipart_upload = self.vault.layer1.complete_multipart_upload
+
+        def complete_once_build_stopped(*args):
+            # the upload finishes after the build stage failed and stopped the pipeline
+            self.assertTrue(build_stopped.wait(10))
+            return complete_multipart_upload(*args)
+
+        self.vault.layer1.complete_multipart_upload = complete_once_build_stopped
+        with patch.object(config, 'max_tar_size', 1), \
+                patch.object(utilities, 'build_tarball', side_effect=build_then_fail), \
+                patch.object(utilities, 'put_unless_stopped', side_effect=put_then_signal), \
+                patch.object(utilities, 'log_error') as log_error:
+            utilities.archive_new_or_changed_files(self.get_new_or_changed_files(), AWS_REGION, VAULT_NAME)
+
+        self.assertEqual(1, log_error.call_count)
+        self.assertEqual(1, len(self.glacier.archives))
+        archive = GlacierArchive.get()
+        self.assertIn(archive.glacier_id, self.glacier.archives)
+        self.assertEqual([os.path.join(self.data_root, 'a0')], [f.file_path for f in archive.files])
+        self.assertEqual(0, GlacierUpload.select().count())
+        self.assertEqual([], os.listdir(config.tarball_directory))
+        self.assertEqual(['a1', 'a2', 'a3'], sorted(os.path.basename(f) for f in self.get_new_or_changed_files()))
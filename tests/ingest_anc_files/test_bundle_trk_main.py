@@ -25,7 +25,7 @@ class TestBuildTrkBundleMain(unittest.TestCase):
         self.output_dir_temp = os.path.join(self.root_dir_temp, 'output_trk')
         os.mkdir(self.output_dir_temp)
 
-        build_trk_bundle.shelf_file = self.root_dir_temp + '/.trk_bundle_manifest'
+        build_trk_bundle.manifest_db_file = self.root_dir_temp + '/.trk_bundle_manifest.sqlite3'
         sys.argv = ['TestBuildTrkBundleMain', '--start-date', '2015-01-02', '--end-date',
                     '2015-01-06', '-t', 'latest', '--print-manifest',
                     '--output-dir', self.output_dir_temp]
@@ -6,6 +6,10 @@ Created on Sep 25, 2015
 '''
 import unittest
 import os
+import shelve
+import hashlib
+import tarfile
+from unittest import mock
 from maven_utilities import constants
 os.environ[constants.python_env] = 'testing'
 from shutil import rmtree
@@ -24,7 +28,7 @@ class TestTrkBundle(unittest.TestCase):
         os.makedirs(self.test_src)
         self.test_out = os.path.join(self.test_root, 'out')
         os.makedirs(self.test_out)
-        # hijack the shelve
+        # hijack the manifest
         self.manifest_file = os.path.join(self.test_root, '.test_trk_manifest')
 
         self.test_trk_files_2014 = ['143630140SC202DSS35_noHdr.234',
@@ -100,7 +104,7 @@ class TestTrkBundle(unittest.TestCase):
                                       self.manifest_file)
 
         self.assertEqual(1, len(os.listdir(self.test_out)))
-        manifest = build_trk_bundle.get_manifest(manifest_file=self.manifest_file, writeback=False)
+        manifest = build_trk_bundle.get_manifest(manifest_file=self.manifest_file)
         manifest_keys = list(manifest.keys())
 
         self.check_manifest(manifest_keys[0],
@@ -116,7 +120,7 @@ class TestTrkBundle(unittest.TestCase):
 
         self.assertEqual(2, len(os.listdir(self.test_out)))
 
-        manifest = build_trk_bundle.get_manifest(manifest_file=self.manifest_file, writeback=False)
+        manifest = build_trk_bundle.get_manifest(manifest_file=self.manifest_file)
 
         latest_key = sorted(manifest.keys())[-1]
 
@@ -154,6 +158,103 @@ class TestTrkBundle(unittest.TestCase):
                             manifest[manifest_keys[0]]['start'],
                             end_dt)
 
+    def testLatestEnd(self):
+        '''Test the manifest latest end lookup '''
+        manifest = build_trk_bundle.get_manifest(manifest_file=self.manifest_file)
+        self.assertIsNone(manifest.latest_end())
+        manifest.close()
+
+        end_dt = build_trk_bundle.get_dt_from_yydoy(2015, 1)
+        build_trk_bundle.build_bundles(build_trk_bundle.get_dt_from_yydoy(2014, 300), end_dt, self.test_out, 30, self.manifest_file)
+
+        with build_trk_bundle.get_manifest(manifest_file=self.manifest_file) as manifest:
+            self.assertEqual(end_dt, manifest.latest_end())
+            self.assertEqual(len(os.listdir(self.test_out)), len(manifest))
+            trk_file = os.path.join(self.test_src, self.test_trk_files_2014[0])
+            self.assertEqual(1, len(manifest.bundles_containing(trk_file)))
+
+    def testReconcileOutOfSync(self):
+        '''Test that reconciliation only reports the bundle windows that changed '''
+        start_dt = build_trk_bundle.get_dt_from_yydoy(2014, 300)
+        end_dt = build_trk_bundle.get_dt_from_yydoy(2015, 30)
+        build_trk_bundle.build_bundles(start_dt, end_dt, self.test_out, 30, self.manifest_file)
+
+        with build_trk_bundle.get_manifest(manifest_file=self.manifest_file) as manifest:
+            self.assertEqual([], build_trk_bundle.reconcile_bundle(manifest))
+
+        new_trk = '150050155SC202DSS35_noHdr.234'
+        file_system.build_test_files_and_structure('More text', self.test_src, [new_trk])
+        mdfi_utils.insert_ancillary_file_metadatum(mdfi_utils.get_metadata_for_ancillary_file(os.path.join(self.test_src, new_trk)))
+
+        with build_trk_bundle.get_manifest(manifest_file=self.manifest_file) as manifest:
+            out_of_sync = build_trk_bundle.reconcile_bundle(manifest)
+        self.assertEqual(1, len(out_of_sync))
+        bundle_name, bundle_start, bundle_end = out_of_sync[0]
+        new_trk_start = build_trk_bundle.get_dt_from_yydoy(2015, 5)
+        self.assertTrue(bundle_start <= new_trk_start < bundle_end)
+
+    def testParallelBuild(self):
+        '''Test building bundle windows in a process pool '''
+        start_dt = build_trk_bundle.get_dt_from_yydoy(2014, 300)
+        end_dt = build_trk_bundle.get_dt_from_yydoy(2015, 30)
+        build_trk_bundle.build_bundles(start_dt, end_dt, self.test_out, 30, self.manifest_file, jobs=2)
+
+        with build_trk_bundle.get_manifest(manifest_file=self.manifest_file) as manifest:
+            self.assertEqual(len(os.listdir(self.test_out)), len(manifest))
+            bundled = []
+            for bundle_name in manifest:
+                entries = manifest[bundle_name]['bundled_files']
+                with tarfile.open(bundle_name, 'r:gz') as tar_file:
+                    self.assertEqual(sorted([e['file_name'].lstrip('/') for e in entries]), sorted(tar_file.getnames()))
+                for entry in entries:
+                    with open(entry['file_name'], 'rb') as f:
+                        self.assertEqual(hashlib.md5(f.read()).hexdigest(), entry['md5'])
+                bundled.extend([e['file_name'] for e in entries])
+        self.assertEqual(sorted([os.path.join(self.test_src, f) for f in self.test_trk_files]), sorted(bundled))
+
+    def build_legacy_shelf(self, legacy_shelf, bundle_name, start_dt, end_dt):
+        '''Helper method used to write a legacy shelve manifest'''
+        shelf = shelve.open(legacy_shelf)
+        shelf[bundle_name] = {'generation_time': time_utilities.utc_now(),
+                              'start': start_dt,
+                              'end': end_dt,
+                              'bundled_files': [{'file_name': 'a.234', 'md5': 'abc'},
+                                                {'file_name': 'b.234', 'md5': 'def'}]}
+        shelf.close()
+
+    def testShelfMigration(self):
+        '''Test the one-time migration of a legacy shelve manifest '''
+        start_dt = build_trk_bundle.get_dt_from_yydoy(2014, 1)
+        end_dt = build_trk_bundle.get_dt_from_yydoy(2014, 100)
+        bundle_name = os.path.join(self.test_out, 'mvn_anc_trk_14001_14100.tgz')
+        legacy_shelf = os.path.join(self.test_root, '.legacy_trk_manifest')
+        self.build_legacy_shelf(legacy_shelf, bundle_name, start_dt, end_dt)
+
+        with mock.patch.object(build_trk_bundle, 'shelf_file', legacy_shelf), \
+                mock.patch.object(build_trk_bundle, 'manifest_db_file', self.manifest_file):
+            with build_trk_bundle.get_manifest() as manifest:
+                self.check_manifest(bundle_name, manifest, ['a.234', 'b.234'], start_dt, end_dt)
+                # a populated manifest is never re-migrated
+                self.assertEqual(0, manifest.migrate_shelf(legacy_shelf))
+
+            # a custom manifest isn't migrated from the default shelve
+            with build_trk_bundle.get_manifest(manifest_file=os.path.join(self.test_root, '.custom_trk_manifest')) as manifest:
+                self.assertEqual(0, len(manifest))
+
+    def testShelfManifestFile(self):
+        '''Test a legacy shelve given as the manifest is migrated into a sibling sqlite manifest '''
+        start_dt = build_trk_bundle.get_dt_from_yydoy(2014, 1)
+        end_dt = build_trk_bundle.get_dt_from_yydoy(2014, 100)
+        bundle_name = os.path.join(self.test_out, 'mvn_anc_trk_14001_14100.tgz')
+        legacy_shelf = os.path.join(self.test_root, '.legacy_trk_manifest')
+        self.build_legacy_shelf(legacy_shelf, bundle_name, start_dt, end_dt)
+
+        for _ in range(2):
+            with build_trk_bundle.get_manifest(manifest_file=legacy_shelf) as manifest:
+                self.assertEqual(legacy_shelf + '.sqlite3', manifest.manifest_file)
+                self.check_manifest(bundle_name, manifest, ['a.234', 'b.234'], start_dt, end_dt)
+        self.assertFalse(build_trk_bundle.is_shelf_file(legacy_shelf + '.sqlite3'))
+
     def check_manifest(self, manifest_key, manifest, file_list, start_dt, end_dt):
         '''Helper method used to check the results of a TRK manifest '''
         self.assertIn(build_trk_bundle.get_yydoy(start_dt), manifest_key)
@@ -0,0 +1,111 @@
+'''
+Unit tests for the PDS bundle verifier
+'''
+import os
+import gzip
+import shutil
+import unittest
+from maven_utilities import constants
+os.environ[constants.python_env] = 'testing'
+from maven_database.models import MavenStatus
+from maven_status import MAVEN_SDC_EVENTS
+from make_pds_bundles import make_pds_bundles, bundle_verifier, archive_progress
+from tests.maven_test_utilities import file_system, db_utils
+
+
+class TestBundleVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.src_dir = os.path.join(self.test_root, 'src')
+        self.arc_dir = os.path.join(self.test_root, 'arc')
+        os.makedirs(self.src_dir)
+        self.src_files = []
+        for i in range(3):
+            src_file = os.path.join(self.src_dir, 'mvn_tst_l2_data{}_20150101_v01_r01.dat'.format(i))
+            with open(src_file, 'wb') as f:
+                f.write(os.urandom(50000) + 'test data {}'.format(i).encode() * 1000)
+            self.src_files.append(src_file)
+        self.gz_file = os.path.join(self.src_dir, 'mvn_tst_l2_data_20150101_v01_r01.xml.gz')
+        with gzip.open(self.gz_file, 'wb') as gz:
+            gz.write(b'label contents')
+        self.src_files.append(self.gz_file)
+        self.label_file = os.path.splitext(self.gz_file)[0]
+        self.lidvids = [('urn:nasa:pds:maven.tst:data.data::1.1', self.label_file)]
+        self.bundle_file = 'tst-pds_bundle_2015-01-01-00-00-00_2015-01-02-00-00-00.tgz.1'
+        self.checksum_file = 'tst-checksum_manifest_2015-01-01-00-00-00_2015-01-02-00-00-00.txt.1'
+        self.manifest_file = 'tst-transfer_manifest_2015-01-01-00-00-00_2015-01-02-00-00-00.txt.1'
+
+    def tearDown(self):
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+        db_utils.delete_data()
+
+    def write_bundle(self, volume_size=None):
+        checksums = make_pds_bundles.tar_bundle_files(self.arc_dir, self.src_files, self.lidvids, self.bundle_file, False,
+                                                      archive_progress.ArchiveProgress(self.src_files, prefix='tst'), volume_size=volume_size)
+        make_pds_bundles.print_checksum_manifest(self.arc_dir, checksums, self.checksum_file)
+        make_pds_bundles.print_transfer_manifest(self.lidvids, self.arc_dir, self.manifest_file)
+
+    def verify(self):
+        return bundle_verifier.verify_bundle(os.path.join(self.arc_dir, self.bundle_file),
+                                             os.path.join(self.arc_dir, self.checksum_file),
+                                             os.path.join(self.arc_dir, self.manifest_file))
+
+    def rewrite_checksum_manifest(self, rewrite):
+        checksum_file = os.path.join(self.arc_dir, self.checksum_file)
+        with open(checksum_file) as f:
+            lines = f.readlines()
+        with open(checksum_file, 'w') as f:
+            f.writelines(rewrite(lines))
+
+    def testVerifyBundle(self):
+        '''Every member of a written bundle matches its manifests'''
+        self.write_bundle()
+        verification = self.verify()
+        self.assertTrue(verification.ok, verification.problems())
+        self.assertEqual(len(self.src_files), verification.verified)
+        self.assertEqual(1, len(verification.volume_files))
+        make_pds_bundles.verify_archive(self.arc_dir, self.bundle_file, self.checksum_file, self.manifest_file)
+
+    def testVerifyMultiVolumeBundle(self):
+        '''Every volume of a multi-volume bundle is verified'''
+        self.write_bundle(volume_size=60000)
+        verification = self.verify()
+        self.assertTrue(verification.ok, verification.problems())
+        self.assertGreater(len(verification.volume_files), 1)
+        self.assertEqual(len(self.src_files), verification.verified)
+
+    def testManifestMismatches(self):
+        '''Changed, dropped and added checksum manifest entries are reported'''
+        self.write_bundle()
+        extra_file = os.path.join(self.src_dir, 'not_bundled.dat')
+        self.rewrite_checksum_manifest(lambda lines: ['0' * 32 + lines[0][32:]] + lines[1:-1] + ['{}  {}\n'.format('0' * 32, extra_file)])
+        with open(os.path.join(self.arc_dir, self.manifest_file), 'a') as f:
+            f.write('urn:nasa:pds:maven.tst:data.data::1.1 {}\n'.format(extra_file))
+
+        verification = self.verify()
+        self.assertFalse(verification.ok)
+        self.assertEqual([bundle_verifier.member_name(self.src_files[0])], [m[0] for m in verification.mismatched])
+        self.assertEqual([bundle_verifier.member_name(extra_file)], verification.missing)
+        self.assertEqual([bundle_verifier.member_name(self.label_file)], verification.unexpected)
+        self.assertEqual([bundle_verifier.member_name(extra_file)], [name for _, name in verification.missing_labels])
+        self.assertEqual(['urn:nasa:pds:maven.tst:data.data::1.1'], verification.duplicate_lidvids)
+        self.assertEqual(len(self.src_files) - 2, verification.verified)
+
+        failures = MavenStatus.query.filter(MavenStatus.event_id == MAVEN_SDC_EVENTS.FAIL.name)
+        failures_before = failures.count()
+        with self.assertRaises(bundle_verifier.BundleVerificationError):
+            make_pds_bundles.verify_archive(self.arc_dir, self.bundle_file, self.checksum_file, self.manifest_file)
+        self.assertEqual(failures_before + 1, failures.count())
+
+    def testTruncatedBundle(self):
+        '''A bundle that can't be read is reported without listing every member as missing'''
+        self.write_bundle()
+        bundle_file = os.path.join(self.arc_dir, self.bundle_file)
+        with open(bundle_file, 'r+b') as f:
+            f.truncate(os.path.getsize(bundle_file) // 2)
+        verification = self.verify()
+        self.assertFalse(verification.ok)
+        self.assertEqual(1, len(verification.errors))
+        self.assertEqual([], verification.missing)
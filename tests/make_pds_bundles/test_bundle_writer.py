@@ -0,0 +1,179 @@
+'''
+Unit tests for the parallel gzip PDS bundle writer
+'''
+import os
+import gzip
+import shutil
+import tarfile
+import unittest
+import subprocess
+from collections import namedtuple
+from make_pds_bundles import bundle_writer
+from tests.maven_test_utilities import file_system
+
+
+ChecksumData = namedtuple('ChecksumData', 'checksum fully_qualified_filename')
+
+
+class TestBundleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.src_files = []
+        for i in range(5):
+            src_file = os.path.join(self.test_root, 'mvn_tst_l2_data{}_20150101_v01_r01.dat'.format(i))
+            with open(src_file, 'wb') as f:
+                f.write(os.urandom(20000) + b'repetitive data ' * 5000)
+            self.src_files.append(src_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+
+    def testMultiMemberGzip(self):
+        '''Blocks are written as consecutive gzip members that decompress to the tar stream'''
+        out_file = os.path.join(self.test_root, 'bundle.tgz')
+        with bundle_writer.ParallelGzipWriter(out_file, compression_level=6, threads=4, block_size=10000) as writer:
+            with tarfile.open(fileobj=writer, mode='w') as tar_file:
+                for src_file in self.src_files:
+                    tar_file.add(src_file, arcname=os.path.basename(src_file))
+            self.assertGreater(writer.members_written, 1)
+
+        with tarfile.open(out_file, 'r:gz') as tar_file:
+            self.assertEqual(sorted([os.path.basename(f) for f in self.src_files]), sorted(tar_file.getnames()))
+            for src_file in self.src_files:
+                with open(src_file, 'rb') as f:
+                    self.assertEqual(f.read(), tar_file.extractfile(os.path.basename(src_file)).read())
+
+        if shutil.which('tar'):
+            listing = subprocess.check_output(['tar', '-tzf', out_file]).decode().split()
+            self.assertEqual(sorted([os.path.basename(f) for f in self.src_files]), sorted(listing))
+
+    def testEmptyBundle(self):
+        '''An empty bundle is still a valid tgz'''
+        out_file = os.path.join(self.test_root, 'empty.tgz')
+        with bundle_writer.open_bundle(out_file, compression_level=1, compression_threads=2):
+            pass
+        with tarfile.open(out_file, 'r:gz') as tar_file:
+            self.assertEqual([], tar_file.getnames())
+        with gzip.open(out_file) as f:
+            self.assertEqual(0, len(f.read()) % tarfile.BLOCKSIZE)
+
+    def add_file(self, tar_file, file_name):
+        self.added.append(file_name)
+        tar_file.add(file_name, arcname=os.path.basename(file_name))
+        return ChecksumData(os.path.basename(file_name), file_name)
+
+    def assertBundleContents(self, tgz_files, src_files):
+        names = []
+        for tgz_file in tgz_files:
+            with tarfile.open(tgz_file, 'r:gz') as tar_file:
+                names.extend(tar_file.getnames())
+                for name in tar_file.getnames():
+                    with open(os.path.join(self.test_root, name), 'rb') as f:
+                        self.assertEqual(f.read(), tar_file.extractfile(name).read())
+        self.assertEqual([os.path.basename(f) for f in src_files], names)
+
+    def testResumeInterruptedBundle(self):
+        '''An interrupted bundle continues from its last checkpoint'''
+        self.added = []
+        out_file = os.path.join(self.test_root, 'tst-pds_bundle_2015_2016.tgz.1')
+        try:
+            with bundle_writer.ResumableBundle(out_file, self.src_files, compression_threads=2, checkpoint_interval=1) as bundle:
+                for src_file in self.src_files[:3]:
+                    bundle.add(src_file, self.add_file)
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        self.assertTrue(bundle_writer.has_checkpoint(out_file))
+        # data written after the last checkpoint is discarded
+        with open(out_file, 'ab') as f:
+            f.write(b'partial member')
+
+        self.added = []
+        checksums = []
+        with bundle_writer.ResumableBundle(out_file, self.src_files, compression_threads=2, checkpoint_interval=1) as bundle:
+            for src_file in self.src_files:
+                resumed = bundle.resumed_checksum(src_file)
+                checksums.append(resumed if resumed is not None else bundle.add(src_file, self.add_file).checksum)
+        self.assertEqual(self.src_files[3:], self.added)
+        self.assertEqual([os.path.basename(f) for f in self.src_files], checksums)
+        self.assertFalse(bundle_writer.has_checkpoint(out_file))
+        self.assertBundleContents([out_file], self.src_files)
+
+    def testResumeTwice(self):
+        '''A bundle resumes from each interruption, including ones that leave members after the
+        last checkpoint and a torn journal line'''
+        out_file = os.path.join(self.test_root, 'tst-pds_bundle_2015_2016.tgz.1')
+
+        def interrupted_run(checkpointed, unchecked):
+            self.added = []
+            bundle = bundle_writer.ResumableBundle(out_file, self.src_files, compression_threads=2, checkpoint_interval=1)
+            for src_file in checkpointed:
+                if bundle.resumed_checksum(src_file) is None:
+                    bundle.add(src_file, self.add_file)
+            bundle.checkpoint_interval = 10 ** 9
+            for src_file in unchecked:
+                bundle.add(src_file, self.add_file)
+            bundle.abort()
+            with open(bundle_writer.checkpoint_file_name(out_file), 'a') as journal:
+                journal.write('{"volume": 0, "file_na')
+            return self.added
+
+        self.assertEqual(self.src_files[:3], interrupted_run(self.src_files[:2], self.src_files[2:3]))
+        self.assertEqual(self.src_files[2:4], interrupted_run(self.src_files[:3], self.src_files[3:4]))
+
+        self.added = []
+        with bundle_writer.ResumableBundle(out_file, self.src_files, compression_threads=2, checkpoint_interval=1) as bundle:
+            for src_file in self.src_files:
+                if bundle.resumed_checksum(src_file) is None:
+                    bundle.add(src_file, self.add_file)
+        self.assertEqual(self.src_files[3:], self.added)
+        self.assertBundleContents([out_file], self.src_files)
+
+    def testResumeAfterFileChange(self):
+        '''A bundle is started over if a file it already holds has changed'''
+        self.added = []
+        out_file = os.path.join(self.test_root, 'tst-pds_bundle_2015_2016.tgz.1')
+        bundle = bundle_writer.ResumableBundle(out_file, self.src_files, checkpoint_interval=1)
+        for src_file in self.src_files[:2]:
+            bundle.add(src_file, self.add_file)
+        bundle.abort()
+        with open(self.src_files[0], 'ab') as f:
+            f.write(b'more data')
+
+        with bundle_writer.ResumableBundle(out_file, self.src_files, checkpoint_interval=1) as bundle:
+            self.assertIsNone(bundle.resumed_checksum(self.src_files[1]))
+            for src_file in self.src_files:
+                bundle.add(src_file, self.add_file)
+        self.assertBundleContents([out_file], self.src_files)
+
+    def testMultiVolumeBundle(self):
+        '''Volumes are started once the current volume reaches the volume size'''
+        self.added = []
+        out_file = os.path.join(self.test_root, 'tst-pds_bundle_2015_2016.tgz.1')
+        with bundle_writer.ResumableBundle(out_file, self.src_files, volume_size=200000) as bundle:
+            for src_file in self.src_files:
+                bundle.add(src_file, self.add_file)
+        self.assertFalse(os.path.isfile(out_file))
+        self.assertEqual(3, len(bundle.volume_files))
+        self.assertEqual(os.path.join(self.test_root, 'tst-pds_bundle-001_2015_2016.tgz.1'), bundle.volume_files[0])
+        self.assertBundleContents(bundle.volume_files, self.src_files)
+
+    def testResumeMultiVolumeBundle(self):
+        '''Completed volumes are kept when a multi-volume bundle is resumed'''
+        self.added = []
+        out_file = os.path.join(self.test_root, 'tst-pds_bundle_2015_2016.tgz.1')
+        bundle = bundle_writer.ResumableBundle(out_file, self.src_files, volume_size=200000, checkpoint_interval=1)
+        for src_file in self.src_files[:3]:
+            bundle.add(src_file, self.add_file)
+        bundle.abort()
+
+        self.added = []
+        with bundle_writer.ResumableBundle(out_file, self.src_files, volume_size=200000, checkpoint_interval=1) as bundle:
+            for src_file in self.src_files:
+                if bundle.resumed_checksum(src_file) is None:
+                    bundle.add(src_file, self.add_file)
+        self.assertEqual(self.src_files[3:], self.added)
+        self.assertEqual(3, len(bundle.volume_files))
+        self.assertBundleContents(bundle.volume_files, self.src_files)
@@ -0,0 +1,76 @@
+'''
+Unit tests for the PDS bundle checksum catalog
+'''
+import os
+import gzip
+import shutil
+import hashlib
+import unittest
+from unittest import mock
+from maven_utilities import constants
+os.environ[constants.python_env] = 'testing'
+from maven_database.models import FileChecksum, MavenStatus
+from make_pds_bundles import make_pds_bundles
+from maven_utilities.utilities import HashingReader
+from tests.maven_test_utilities import file_system, db_utils
+
+
+class TestChecksumCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.src_dir = os.path.join(self.test_root, 'src')
+        self.arc_dir = os.path.join(self.test_root, 'arc')
+        os.makedirs(self.src_dir)
+        self.src_files = []
+        for i in range(3):
+            src_file = os.path.join(self.src_dir, 'mvn_tst_l2_data{}_20150101_v01_r01.dat'.format(i))
+            with open(src_file, 'wb') as f:
+                f.write('test data {}'.format(i).encode() * 100)
+            self.src_files.append(src_file)
+        self.gz_file = os.path.join(self.src_dir, 'mvn_tst_l2_data_20150101.xml.gz')
+        with gzip.open(self.gz_file, 'wb') as gz:
+            gz.write(b'label contents')
+        self.src_files.append(self.gz_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+        db_utils.delete_data()
+
+    def bundle(self, bundle_file, verify_fraction=0.0):
+        with mock.patch('make_pds_bundles.make_pds_bundles.HashingReader', side_effect=HashingReader) as hashing_reader:
+            checksums = make_pds_bundles.tar_bundle_files(self.arc_dir, self.src_files, [], bundle_file, False, None,
+                                                          verify_fraction=verify_fraction)
+        return dict((c.fully_qualified_filename, c.checksum) for c in checksums), hashing_reader.call_count
+
+    def testReuseCatalog(self):
+        '''Unchanged files are not rehashed on a later delivery'''
+        first, hashed = self.bundle('first.tgz')
+        self.assertEqual(len(self.src_files), hashed)
+        self.assertEqual(len(self.src_files), FileChecksum.query.count())
+        self.assertEqual(hashlib.md5(b'label contents').hexdigest(), first[os.path.splitext(self.gz_file)[0]])
+
+        second, hashed = self.bundle('second.tgz')
+        self.assertEqual(0, hashed)
+        self.assertEqual(first, second)
+
+        # a changed stat signature forces a rehash
+        with open(self.src_files[0], 'ab') as f:
+            f.write(b'more')
+        third, hashed = self.bundle('third.tgz')
+        self.assertEqual(1, hashed)
+        self.assertNotEqual(first[self.src_files[0]], third[self.src_files[0]])
+
+    def testVerify(self):
+        '''Verification catches content that changed without a stat change'''
+        first, _ = self.bundle('first.tgz')
+        st = os.stat(self.src_files[1])
+        with open(self.src_files[1], 'r+b') as f:
+            f.write(b'X')
+        os.utime(self.src_files[1], ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        second, hashed = self.bundle('second.tgz', verify_fraction=1.0)
+        self.assertEqual(len(self.src_files), hashed)
+        self.assertNotEqual(first[self.src_files[1]], second[self.src_files[1]])
+        self.assertEqual(1, MavenStatus.query.count())
@@ -0,0 +1,65 @@
+'''
+Unit tests for the PDS bundle size estimates
+'''
+import os
+import gzip
+import random
+import shutil
+import unittest
+from make_pds_bundles import estimate
+from tests.maven_test_utilities import file_system
+
+
+class TestEstimate(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.content = os.urandom(10000) + b'repetitive data ' * 5000
+
+    def tearDown(self):
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+
+    def testMeasureCompressedFile(self):
+        '''Compressed inputs are measured on their decompressed contents'''
+        plain_file = os.path.join(self.test_root, 'mvn_tst_l2_data_20150101_v01_r01.dat')
+        with open(plain_file, 'wb') as f:
+            f.write(self.content)
+        compressed_file = plain_file + '.gz'
+        with gzip.open(compressed_file, 'wb') as f:
+            f.write(self.content)
+
+        plain = estimate.measure_file(plain_file, 6)
+        compressed = estimate.measure_file(compressed_file, 6)
+        self.assertEqual(len(self.content), plain.content_size)
+        self.assertEqual(len(self.content), compressed.content_size)
+        self.assertEqual(plain.compressed_size, compressed.compressed_size)
+        self.assertEqual(len(gzip.compress(self.content, 6)), plain.compressed_size)
+        self.assertEqual(os.path.getsize(compressed_file), compressed.file_size)
+
+    def testExtrapolateSamples(self):
+        '''The sampled ratios are scaled to every file of the extension'''
+        estimator = estimate.BundleEstimator(sample_fraction=0.0, compression_level=6, rng=random.Random(0))
+        for i in range(10):
+            file_name = os.path.join(self.test_root, 'mvn_tst_l2_data{}_20150101_v01_r01.dat'.format(i))
+            with open(file_name, 'wb') as f:
+                f.write(self.content)
+            estimator.add(file_name, len(self.content), 'dat')
+
+        # nothing is sampled at a fraction of 0 so the first file stands in for the extension
+        measurements = estimator.measure()
+        self.assertEqual(1, measurements['dat'].files)
+        dat_estimate = estimator.estimate(measurements)['dat']
+        self.assertEqual(10, dat_estimate['files'])
+        self.assertEqual(1, dat_estimate['sampled_files'])
+        self.assertEqual(10 * measurements['dat'].compressed_size, dat_estimate['estimated_compressed_size'])
+        self.assertEqual(10 * (len(self.content) + estimate.tar_member_overhead), dat_estimate['estimated_content_size'])
+        self.assertIsNotNone(estimate.estimate_seconds(dat_estimate['estimated_content_size'], measurements['dat'], 2))
+
+    def testMissingSample(self):
+        '''Files that can not be read are counted and do not produce an estimate'''
+        estimator = estimate.BundleEstimator(sample_fraction=1.0)
+        estimator.add(os.path.join(self.test_root, 'missing.dat'), 100, 'dat')
+        dat_estimate = estimator.estimate(estimator.measure())['dat']
+        self.assertEqual(1, dat_estimate['missing_samples'])
+        self.assertIsNone(dat_estimate['estimated_compressed_size'])
@@ -9,6 +9,7 @@ import shutil
 import os
 import tarfile
 import smtplib
+import datetime
 
 try:
     from tests.make_pds_bundles import utilities as test_utilities
@@ -19,10 +20,10 @@ from tests.maven_test_utilities import mail_utilities, log_handlers, file_system
 from maven_status import MAVEN_SDC_EVENTS
 from maven_database.models import ScienceFilesMetadata, AncillaryFilesMetadata, PdsArchiveRecord, MavenStatus
 from maven_ops_database.database import init_db
-from make_pds_bundles import make_pds_bundles, config
+from make_pds_bundles import make_pds_bundles, config, file_finder
 from make_pds_bundles.results import GENERATION_SUCCESS
 from maven_utilities.file_pattern import *
-from maven_utilities import constants, maven_config
+from maven_utilities import constants, maven_config, time_utilities
 os.environ[constants.python_env] = 'testing'
 
 # Setup in-memory database
@@ -150,6 +151,32 @@ class TestInventoryGeneration(unittest.TestCase):
             else:
                 self.fail("%s wasn't found in any maven status" % pattern_to_check)
 
+    def test_sql_join_matches_merge_join(self):
+        extra_sci_files = ['mvn_iuv_l1a_not-in-sdc_20141019T075533_v06_r00.fits',
+                           'mvn_iuv_l1a_zz-not-in-sdc_20141019T075533_v06_r00.fits']
+        self.generate_pds_inventory_file(file_names=self.test_good_files + self.test_out_of_window_files + extra_sci_files,
+                                         urn='maven.iuvs.raw',
+                                         level='limb',
+                                         file_name=self.inv_file_path)
+        start = time_utilities.to_utc_tz(datetime.datetime(2014, 1, 1))
+        end = time_utilities.to_utc_tz(datetime.datetime(2015, 1, 1))
+
+        results = {}
+        for sql_join in [False, True]:
+            missing = []
+            finder = file_finder.InventoryFileFinder(self.inv_file_path,
+                                                     results_from_dt=start,
+                                                     results_to_dt=end,
+                                                     results_not_extensions=['xml'],
+                                                     missing_file_handler=missing.append,
+                                                     sql_join=sql_join)
+            results[sql_join] = (sorted(finder.generate()), sorted(missing))
+
+        self.assertEqual(results[False], results[True])
+        found, missing = results[False]
+        self.assertEqual(sorted(self.test_good_files), sorted([os.path.basename(f) for f in found]))
+        self.assertEqual(len(extra_sci_files) + len(self.test_out_of_window_files), len(missing))
+
     def generate_pds_inventory_file(self,
                                     file_names,
                                     urn,
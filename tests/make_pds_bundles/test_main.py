@@ -5,6 +5,7 @@ Created on Jun 11, 2015
 """
 import os
 import sys
+import json
 import smtplib
 import unittest
 from shutil import rmtree
@@ -72,3 +73,14 @@ class TestMakePdsArchiveMain(unittest.TestCase):
         args = make_pds_bundles_main.parse_arguments(sys.argv[1:])
         with self.assertRaises(TypeError):
             make_pds_bundles_main.main(**vars(args))        
+
+    def testMainEstimate(self):
+        output_file = os.path.join(self.root_dir, 'estimate.json')
+        sys.argv = ['TestMakePdsArchiveMain', '2015-01-01', '2015-02-01', self.root_dir, '-i', 'swi', '-e', '0.5', '--estimate-output', output_file]
+        args = make_pds_bundles_main.parse_arguments(sys.argv[1:])
+        self.assertEqual(0.5, args.estimate)
+        make_pds_bundles_main.main(**vars(args))
+        with open(output_file) as f:
+            estimate = json.load(f)
+        self.assertEqual(0.5, estimate['sample_fraction'])
+        self.assertEqual(0, estimate['total']['files'])
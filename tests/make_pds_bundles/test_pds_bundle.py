@@ -5,6 +5,7 @@ Created on Mar 3, 2015
 """
 
 import unittest
+from unittest import mock
 import pytest
 import shutil
 import re
@@ -17,11 +18,13 @@ import tarfile
 import smtplib
 import csv
 import gzip
+import hashlib
+import json
 from dateutil.parser import parse
 from maven_database.models import PdsArchiveRecord
 from maven_ops_database.database import init_db
-from make_pds_bundles import config, make_pds_bundles
-from make_pds_bundles.results import GENERATION_SUCCESS
+from make_pds_bundles import config, make_pds_bundles, bundle_verifier
+from make_pds_bundles.results import GENERATION_SUCCESS, GENERATION_FAILURE
 from make_pds_bundles.make_pds_bundles import direct_out_logger, print_instrument_config
 from tests.maven_test_utilities import file_system, db_utils, log_handlers
 from tests.maven_test_utilities import mail_utilities
@@ -145,6 +148,60 @@ class TestPdsBundles(unittest.TestCase):
     def test_results_single_instrument(self):
         self.run_result_generation(['euv'], False, 1)
 
+    def test_results_parallel_instruments(self):
+        instruments = ['euv', 'lpw', 'swe', 'swi']
+        make_pds_bundles.run_archive(self.test_start, self.test_end, instruments, self.test_root, False, jobs=2)
+        results = PdsArchiveRecord.query.all()
+        self.assertEqual(len(instruments), len(results))
+        self.assertTrue(all([x.generation_result == GENERATION_SUCCESS for x in results]))
+
+        # each instrument's bundle was written by a worker and recorded by the parent
+        for instrument in instruments:
+            arc_location = os.path.join(self.test_root, 'maven/data/arc', instrument)
+            tgz_file = os.path.join(arc_location, [f for f in os.listdir(arc_location) if '.tgz' in f][0])
+            self.assertIn(arc_location, [x.result_directory for x in results])
+            with tarfile.open(tgz_file, 'r:gz') as opened_tgz_file:
+                bundled = [os.path.basename(n) for n in opened_tgz_file.getnames()]
+            expected = [f for f in self.test_success_files if '_{}_'.format(instrument[:3]) in f]
+            self.assertTrue(set(expected) <= set(bundled), '%s not in %s' % (expected, bundled))
+
+    def test_archive_worker_threads(self):
+        '''The default compression and verification threads are split between the archive workers'''
+        with mock.patch.object(config, 'bundle_compression_threads', 8), mock.patch.object(config, 'bundle_verify_threads', 4):
+            make_pds_bundles.init_archive_worker(3)
+            self.assertEqual(2, config.bundle_compression_threads)
+            self.assertEqual(1, config.bundle_verify_threads)
+            make_pds_bundles.init_archive_worker(8)
+            self.assertEqual(1, config.bundle_compression_threads)
+
+    def test_results_failure_notes(self):
+        '''The traceback of a failed instrument is recorded after the user notes'''
+        with mock.patch.object(make_pds_bundles, 'tar_bundle_files', side_effect=IOError('disk full')):
+            with self.assertRaises(IOError):
+                make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False, user_notes='reprocessed')
+        notes = PdsArchiveRecord.query.one().notes
+        self.assertTrue(notes.startswith('reprocessed ERROR: '), notes)
+        self.assertIn('disk full', notes)
+
+    def test_results_bundle_verification_failure(self):
+        print_checksum_manifest = make_pds_bundles.print_checksum_manifest
+
+        def drop_last_checksum(target_dir, checksums, checksum_file):
+            print_checksum_manifest(target_dir, checksums[:-1], checksum_file)
+
+        with mock.patch.object(make_pds_bundles, 'print_checksum_manifest', side_effect=drop_last_checksum):
+            with self.assertRaises(bundle_verifier.BundleVerificationError):
+                make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False)
+        results = PdsArchiveRecord.query.all()
+        self.assertEqual(1, len(results))
+        self.assertEqual(GENERATION_FAILURE, results[0].generation_result)
+        self.assertIn('1 unexpected', results[0].notes)
+
+        # verification can be skipped
+        with mock.patch.object(make_pds_bundles, 'print_checksum_manifest', side_effect=drop_last_checksum):
+            make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False, verify_bundles=False)
+        self.assertEqual(GENERATION_SUCCESS, PdsArchiveRecord.query.order_by(PdsArchiveRecord.id.desc()).first().generation_result)
+
     def test_main_manifest(self):
         make_pds_bundles.run_archive(self.test_start, self.test_end, [config.all_key], self.test_root, True)
 
@@ -182,6 +239,73 @@ class TestPdsBundles(unittest.TestCase):
                 test_file_without_path = os.path.split(test_file)[1]
                 self.assertTrue(test_file_without_path in [os.path.split(f.name)[1] for f in opened_tgz_file], 'File %s was not in the tgz %s' % (test_file_without_path, [f.name for f in opened_tgz_file]))
 
+    def test_checksum_manifest_matches_tarball(self):
+        make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False)
+
+        arc_location = os.path.join(self.test_root, 'maven/data/arc', 'swi')
+        tgz_file = os.path.join(arc_location, [f for f in os.listdir(arc_location) if '.tgz' in f][0])
+        checksum_file = os.path.join(arc_location, [f for f in os.listdir(arc_location) if f.startswith('checksum')][0])
+        with open(checksum_file, 'r') as f:
+            manifest_checksums = dict((os.path.basename(name), checksum) for checksum, name in [line.split() for line in f])
+
+        with tarfile.open(tgz_file, 'r:gz') as opened_tgz_file:
+            members = [m for m in opened_tgz_file if m.isfile()]
+            self.assertEqual(len(members), len(manifest_checksums))
+            for member in members:
+                tar_checksum = hashlib.md5(opened_tgz_file.extractfile(member).read()).hexdigest()
+                self.assertEqual(manifest_checksums[os.path.basename(member.name)], tar_checksum)
+
+    @mock.patch.object(config, 'bundle_checkpoint_interval', 0)
+    def test_resume_interrupted_bundle(self):
+        add_to_tar = make_pds_bundles.add_to_tar
+        added = []
+
+        def interrupted_add_to_tar(tar_file, file_to_tar, catalog=None):
+            if len(added) == 2:
+                raise RuntimeError('interrupted')
+            added.append(file_to_tar)
+            return add_to_tar(tar_file, file_to_tar, catalog)
+
+        with mock.patch.object(make_pds_bundles, 'add_to_tar', interrupted_add_to_tar):
+            with self.assertRaises(RuntimeError):
+                make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False)
+
+        arc_location = os.path.join(self.test_root, 'maven/data/arc', 'swi')
+        self.assertEqual(1, len([f for f in os.listdir(arc_location) if f.endswith(config.bundle_checkpoint_suffix)]))
+
+        with mock.patch.object(make_pds_bundles, 'add_to_tar', side_effect=add_to_tar) as resumed_add_to_tar:
+            make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False)
+        # the files bundled before the interruption were not added again
+        self.assertFalse(set(added) & set([c[0][1] for c in resumed_add_to_tar.call_args_list]))
+
+        # the interrupted version was resumed and completed
+        self.assertEqual([], [f for f in os.listdir(arc_location) if f.endswith(config.bundle_checkpoint_suffix)])
+        tgz_files = [f for f in os.listdir(arc_location) if '.tgz' in f]
+        self.assertEqual(1, len(tgz_files), tgz_files)
+        self.assertTrue(tgz_files[0].endswith('.tgz.1'))
+        checksum_file = os.path.join(arc_location, [f for f in os.listdir(arc_location) if f.startswith('checksum')][0])
+        with open(checksum_file, 'r') as f:
+            manifest_checksums = dict((os.path.basename(name), checksum) for checksum, name in [line.split() for line in f])
+        with tarfile.open(os.path.join(arc_location, tgz_files[0]), 'r:gz') as opened_tgz_file:
+            members = [m for m in opened_tgz_file if m.isfile()]
+            self.assertEqual(sorted(manifest_checksums), sorted([os.path.basename(m.name) for m in members]))
+            for member in members:
+                tar_checksum = hashlib.md5(opened_tgz_file.extractfile(member).read()).hexdigest()
+                self.assertEqual(manifest_checksums[os.path.basename(member.name)], tar_checksum)
+
+    def test_compressed_member_streamed(self):
+        make_pds_bundles.run_archive(self.test_start, self.test_end, ['swi'], self.test_root, False)
+
+        compressed_file = [f[1] for f in self.metadata_for_test_files if os.path.basename(f[1]) in self.test_success_compressed_files][0]
+        # the source directory only ever holds the compressed file
+        self.assertFalse(os.path.exists(os.path.splitext(compressed_file)[0]))
+
+        arc_location = os.path.join(self.test_root, 'maven/data/arc', 'swi')
+        tgz_file = os.path.join(arc_location, [f for f in os.listdir(arc_location) if '.tgz' in f][0])
+        with tarfile.open(tgz_file, 'r:gz') as opened_tgz_file:
+            member = opened_tgz_file.getmember(os.path.splitext(compressed_file)[0].lstrip('/'))
+            self.assertEqual(b'filling up gzip_file', opened_tgz_file.extractfile(member).read())
+
     def test_metadata_tarball(self):
         make_pds_bundles.run_archive(self.test_start, self.test_end, ['ngi-meta'], self.test_root, False)
 
@@ -295,6 +419,38 @@ class TestPdsBundles(unittest.TestCase):
         for f in self.test_success_files:
             self.assertTrue(self.test_handler.contains(f))
 
+    def test_run_estimate(self):
+        output_file = os.path.join(self.test_root, 'estimate.json')
+        estimate = make_pds_bundles.run_estimate(self.test_start, self.test_end, ['swi', 'euv'], self.test_root, sample_fraction=1.0, output_file=output_file)
+        with open(output_file) as f:
+            self.assertEqual(json.load(f), json.loads(json.dumps(estimate)))
+
+        # 3 swi cdfs, 3 swi xmls (one gzipped) and 3 euv cdfs, 1 euv xml as run_archive selects them
+        self.assertEqual(10, estimate['total']['files'])
+        self.assertEqual(['cdf', 'xml'], sorted(estimate['instruments']['swi']['extensions']))
+        for instrument_estimate in estimate['instruments'].values():
+            for extension_estimate in instrument_estimate['extensions'].values():
+                self.assertEqual(extension_estimate['files'], extension_estimate['sampled_files'])
+                self.assertEqual(0, extension_estimate['missing_samples'])
+                self.assertTrue(extension_estimate['estimated_compressed_size'] > 0)
+            self.assertIsNotNone(instrument_estimate['estimated_seconds'])
+        self.assertIsNotNone(estimate['total']['estimated_seconds'])
+
+    def test_run_estimate_ancillary(self):
+        '''The ancillary and event estimates cover the files run_archive would bundle'''
+        anc_filters = config.instrument_config[config.ancillary_key]._replace(plans=['prod1', 'prod2'])
+        with mock.patch.dict(config.instrument_config, {config.ancillary_key: anc_filters}):
+            estimate = make_pds_bundles.run_estimate(self.test_start, self.test_end, [config.ancillary_key, config.event_key],
+                                                     self.test_root, sample_fraction=1.0, output_file=os.path.join(self.test_root, 'estimate.json'))
+
+        anc_estimate = estimate['instruments'][config.ancillary_key]
+        self.assertEqual(len(self.generated_anc_files), anc_estimate['files'])
+        self.assertEqual(len(self.generated_anc_files) * len('some anc data'), anc_estimate['file_size'])
+        self.assertTrue(anc_estimate['estimated_compressed_size'] > 0)
+        # the SDC and OPs events csv files
+        self.assertEqual(2, estimate['instruments'][config.event_key]['files'])
+        self.assertEqual(['csv'], list(estimate['instruments'][config.event_key]['extensions']))
+
     def test_run_instrument_filters(self):
         override_config_dir = os.path.join(self.test_root, 'maven')
         override_config_file = os.path.join(override_config_dir, 'test_config.py')
@@ -112,6 +112,22 @@ class Test(unittest.TestCase):
         results = utilities.get_latest_science_files(instrument_list=['euv'])
         self.assertEqual(6, len(results))
 
+    def testGetLatestScienceMetadataPerGroup(self):
+        results = utilities.get_latest_science_metadata(instrument_list=['euv'], level_list=['l2'])
+        self.assertEqual(['mvn_euv_l2_bands_20141113_v01_r01.cdf'], [m.file_name for m in results])
+
+        streamed = utilities.get_latest_science_metadata(instrument_list=['euv'], stream_results=True)
+        self.assertEqual(sorted([m.file_name for m in utilities.get_latest_science_metadata(instrument_list=['euv'])]),
+                         sorted([m.file_name for m in streamed]))
+
+    def testGetLatestScienceSummary(self):
+        latest = utilities.get_latest_science_metadata(instrument_list=['euv'])
+        num_files, total_size = utilities.get_latest_science_summary(instrument_list=['euv'])
+        self.assertEqual(len(latest), num_files)
+        self.assertEqual(sum([m.file_size for m in latest]), total_size)
+
+        self.assertEqual((0, 0), utilities.get_latest_science_summary(instrument_list=['not-an-instrument']))
+
     def testQueryAncillaryFiles(self):
         metadata_count = 0
         self.assertEqual(int(AncillaryFilesMetadata.query.count()), metadata_count)
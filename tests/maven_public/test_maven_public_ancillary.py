@@ -21,8 +21,7 @@ from tests.maven_test_utilities import file_system, db_utils
 class TestPublicAncillary(unittest.TestCase):
 
     def setUp(self):
-        # copy list
-        self.source_generators = maven_public_utils.default_source_generators[:]
+        self.source_generators = maven_public_utils.get_default_source_generators()
 
         self.test_root = file_system.get_temp_root_dir()
         self.site_root = os.path.join(self.test_root, 'site')
@@ -79,9 +78,9 @@ class TestPublicAncillary(unittest.TestCase):
 
         # Add orbit data
         db_utils.insert_orbit(number=1,
-                              periapse=maven_public_utils.public_release_window_date_end - 
+                              periapse=maven_public_utils.public_release_window()[1] - 
                               timedelta(days=1),
-                              apoapse=maven_public_utils.public_release_window_date_end - timedelta(days=1))
+                              apoapse=maven_public_utils.public_release_window()[1] - timedelta(days=1))
         # Add ancillary files to metadata
         for anc_metadata in maven_file_indexer_utils.generate_metadata_for_ancillary_file([os.path.join(self.anc_data_root, f) for f in self.all_anc_files]):
             db_utils.insert_ancillary_file_metadata(file_name=anc_metadata.file_name,
@@ -128,17 +127,16 @@ class TestPublicAncillary(unittest.TestCase):
         rmtree(self.test_root)
         self.assertFalse(os.path.isdir(self.test_root))
         db_utils.delete_data(MavenOrbit, AncillaryFilesMetadata)
-        maven_public_utils.default_source_generators = self.source_generators
 
     def testPopulateAncillaryAll(self):
-        for next_gen in maven_public_utils.default_source_generators:
+        for next_gen in self.source_generators:
             if isinstance(next_gen, maven_public_utils.AncQueryMetadata) or isinstance(next_gen, maven_public_utils.SciQueryMetadata):
                 next_gen.latest = False
-        for next_gen in maven_public_utils.default_source_generators:
+        for next_gen in self.source_generators:
             if isinstance(next_gen, maven_public_utils.SystemFileQueryMetadata):
                 next_gen.root_dir = self.anc_data_root
 
-        maven_public_utils.build_site(self.site_root, self.data_root, True)
+        maven_public_utils.build_site(self.site_root, self.data_root, True, source_generators=self.source_generators)
 
         # assert all links exist.
         self.assertTrue(os.path.exists(
@@ -159,14 +157,14 @@ class TestPublicAncillary(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(self.site_root, maven_public_utils.OPTG_DIR, next_public_file)))
 
     def testPopulateAncillaryLatest(self):
-        for next_gen in maven_public_utils.default_source_generators:
+        for next_gen in self.source_generators:
             if isinstance(next_gen, maven_public_utils.AncQueryMetadata) or isinstance(next_gen, maven_public_utils.SciQueryMetadata):
                 next_gen.latest = True
-        for next_gen in maven_public_utils.default_source_generators:
+        for next_gen in self.source_generators:
             if isinstance(next_gen, maven_public_utils.SystemFileQueryMetadata):
                 next_gen.root_dir = self.anc_data_root
 
-        maven_public_utils.build_site(self.site_root, self.data_root, True)
+        maven_public_utils.build_site(self.site_root, self.data_root, True, source_generators=self.source_generators)
 
         # assert all links exist.
         self.assertTrue(os.path.exists(
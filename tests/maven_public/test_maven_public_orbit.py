@@ -16,8 +16,7 @@ from tests.maven_test_utilities import file_system
 class TestPublicOrbit(unittest.TestCase):
 
     def setUp(self):
-        # copy list
-        self.source_generators = maven_public_utils.default_source_generators[:]
+        self.source_generators = maven_public_utils.get_default_source_generators()
 
         self.test_root = file_system.get_temp_root_dir()
         self.site_root = os.path.join(self.test_root, 'site')
@@ -41,14 +40,13 @@ class TestPublicOrbit(unittest.TestCase):
     def tearDown(self):
         rmtree(self.test_root)
         self.assertFalse(os.path.isdir(self.test_root))
-        maven_public_utils.default_source_generators = self.source_generators
 
     def testPopulateOrbitFiles(self):
-        #for next_gen in maven_public_utils.default_source_generators:
+        #for next_gen in self.source_generators:
         #    if isinstance(next_gen, maven_public_utils.SystemFileQueryMetadata):
         #        next_gen.root_dir = self.anc_data_root
 
-        maven_public_utils.build_site(self.site_root, self.data_root, True)
+        maven_public_utils.build_site(self.site_root, self.data_root, True, source_generators=self.source_generators)
 
         # assert all links exist.
         self.assertTrue(os.path.exists(
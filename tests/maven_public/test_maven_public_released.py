@@ -92,6 +92,23 @@ class TestPublicReleased(unittest.TestCase):
         self.assertTrue(len(db_results) == 0)
 
 
+    def testUpdateReleasedClearsStale(self):
+        # everything starts released, only part of it is released again
+        withdrawn = self.sci_files[:10] + self.anc_files[:10]
+        with open(self.released_list_file, 'w') as f:
+            for file_name in self.sci_files[10:] + self.anc_files[10:] + ['mvn_unknown_l1_20090516_v01_r01.txt']:
+                f.write(os.path.join(self.sci_data_root, file_name) + '\n')
+
+        maven_public_utils.update_released(self.released_list_file)
+        self.assertEqual(set(self.sci_files[10:]),
+                         set([r.file_name for r in ScienceFilesMetadata.query.filter(ScienceFilesMetadata.released)]))
+        self.assertEqual(set(self.anc_files[10:]),
+                         set([r.file_name for r in AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.released)]))
+        self.assertEqual(len(withdrawn),
+                         ScienceFilesMetadata.query.filter(ScienceFilesMetadata.released == False).count() +
+                         AncillaryFilesMetadata.query.filter(AncillaryFilesMetadata.file_name.in_(withdrawn))
+                                                     .filter(AncillaryFilesMetadata.released == False).count())
+
 class TestMetadataGenerator():
 
     def __init__(self, list_of_return_data):
@@ -5,7 +5,10 @@ Created on Jan 20, 2016
 '''
 import unittest
 import os
+import datetime
+import pytz
 from shutil import rmtree
+from mock import patch
 
 from maven_public import utilities as maven_public_utils
 from tests.maven_test_utilities import file_system
@@ -58,6 +61,74 @@ class TestMavenPublicUtils(unittest.TestCase):
             self.assertTrue(os.path.islink(next_file))
             self.assertTrue(os.path.isfile(os.path.realpath(next_file)))
 
+    def testScanNestedSite(self):
+        '''Links are checked without following them, across batches and sub directories'''
+        nested_root = os.path.join(self.test_sym_root, 'nested', 'deeper')
+        os.makedirs(nested_root)
+        os.symlink(os.path.join('..', '..', self.removed_files[0]), os.path.join(nested_root, 'relative_dead'))
+        os.symlink(os.path.join('..', '..', self.existing_files[0]), os.path.join(nested_root, 'relative_live'))
+        os.symlink(self.test_file_root, os.path.join(nested_root, 'directory_link'))
+        os.symlink(os.path.join(self.test_root, 'missing_directory'), os.path.join(nested_root, 'dead_directory_link'))
+
+        dead_links = list(maven_public_utils.scan_site(self.test_sym_root, workers=2, batch_size=3))
+        self.assertEqual(set(self.removed_files + ['relative_dead', 'dead_directory_link']),
+                         set(os.path.basename(dead_link.path) for dead_link in dead_links))
+        self.assertIn(maven_public_utils.DeadLink(os.path.join(nested_root, 'relative_dead'), os.path.join('..', '..', self.removed_files[0])),
+                      dead_links)
+
+        self.assertEqual(len(dead_links), maven_public_utils.clean_site(self.test_sym_root, workers=2))
+        self.assertEqual([], list(maven_public_utils.check_site(self.test_sym_root)))
+        self.assertTrue(os.path.islink(os.path.join(nested_root, 'relative_live')))
+
+    def testPublicReleaseWindow(self):
+        '''The release window ends 3 months before the latest quarterly release'''
+        for as_of, window_end in [(datetime.datetime(2020, 1, 1), datetime.datetime(2019, 8, 15)),
+                                  (datetime.datetime(2020, 2, 14), datetime.datetime(2019, 8, 15)),
+                                  (datetime.datetime(2020, 2, 15), datetime.datetime(2019, 11, 15)),
+                                  (datetime.datetime(2020, 5, 14), datetime.datetime(2019, 11, 15)),
+                                  (datetime.datetime(2020, 5, 15), datetime.datetime(2020, 2, 15)),
+                                  (datetime.datetime(2020, 8, 15), datetime.datetime(2020, 5, 15)),
+                                  (datetime.datetime(2020, 11, 14), datetime.datetime(2020, 5, 15)),
+                                  (datetime.datetime(2020, 12, 31), datetime.datetime(2020, 8, 15))]:
+            start, end = maven_public_utils.public_release_window(as_of)
+            self.assertEqual(maven_public_utils.public_release_window_date_start, start)
+            self.assertEqual(window_end.replace(tzinfo=pytz.UTC), end, as_of)
+
+        source_generators = maven_public_utils.get_default_source_generators(as_of=datetime.datetime(2020, 5, 15))
+        self.assertEqual({datetime.datetime(2020, 2, 15, tzinfo=pytz.UTC)},
+                         set(g.end_date for g in source_generators if isinstance(g, maven_public_utils.SciQueryMetadata)))
+
+    def testSystemFileQueryStatReuse(self):
+        '''System files are found with their stat, which populate_site uses instead of stat'ing again'''
+        source_root = os.path.join(self.test_root, 'data')
+        trk_root = os.path.join(source_root, maven_public_utils.SDC_DIR, 'trk')
+        file_system.build_test_files_and_structure(default_file_contents='something to fill the file',
+                                                   files_base_dir=trk_root,
+                                                   files_list=['mvn_anc_trk_15166_15180.tgz', 'mvn_anc_trk_15180_15194.tgz', 'other.txt'])
+        file_system.build_test_files_and_structure(default_file_contents='something to fill the file',
+                                                   files_base_dir=os.path.join(trk_root, 'old'),
+                                                   files_list=['mvn_anc_trk_14166_14180.tgz'])
+        os.symlink(os.path.join(trk_root, 'missing'), os.path.join(trk_root, 'mvn_anc_trk_15194_15208.tgz'))
+        os.utime(os.path.join(trk_root, 'mvn_anc_trk_15180_15194.tgz'), (0, 0))
+
+        query = maven_public_utils.SystemFileQueryMetadata(root_dir=trk_root,
+                                                           base_name_pattern=maven_public_utils.trk_bundle_pattern,
+                                                           start_date=datetime.datetime(2000, 1, 1, tzinfo=pytz.UTC))
+        found = list(query.generate())
+        self.assertEqual([os.path.join(trk_root, 'mvn_anc_trk_15166_15180.tgz'), os.path.join(trk_root, 'old', 'mvn_anc_trk_14166_14180.tgz')], found)
+        self.assertTrue(all(source_file.stat is not None for source_file in found))
+        query.child_directories = False
+        self.assertEqual(found[:1], list(query.generate()))
+
+        query.child_directories = True
+        site_root = os.path.join(self.test_root, 'sites', 'site-1')
+        with patch('os.path.isfile', side_effect=os.path.isfile) as isfile:
+            released_list = maven_public_utils.populate_site([query], site_root, source_root)
+        self.assertEqual([], [args for args, _ in isfile.call_args_list if args[0] in found])
+        with open(released_list) as f:
+            self.assertEqual(found, f.read().split())
+        os.remove(released_list)
+
     def testBuildSiteSymlink(self):
         '''Tests build_site that the sym links exist and are created'''
         maven_public_utils.build_site(root_dir=self.test_root,
@@ -70,3 +141,77 @@ class TestMavenPublicUtils(unittest.TestCase):
 
         site_symlink_anc_dir = os.path.join(self.test_root, maven_public_utils.ANC_DIR)
         self.assertTrue(os.path.islink(site_symlink_anc_dir))
+
+    def testIncrementalSite(self):
+        '''A site built from a prior site clones the files it released and applies only the changes'''
+        source_root = os.path.join(self.test_root, 'data')
+        sci_files = [os.path.join(source_root, maven_public_utils.SCI_DIR, 'test', name) for name in self.test_files]
+        file_system.build_test_files_and_structure(default_file_contents='something to fill the file',
+                                                   files_base_dir=os.path.join(source_root, maven_public_utils.SCI_DIR, 'test'),
+                                                   files_list=self.test_files)
+
+        class ListGenerator():
+            def __init__(self, files):
+                self.files = files
+
+            def generate(self):
+                return iter(self.files)
+
+        first_site = os.path.join(self.test_root, 'sites', 'site-1')
+        second_site = os.path.join(self.test_root, 'sites', 'site-2')
+        maven_public_utils.populate_site([ListGenerator(sci_files[:8])], first_site, source_root)
+        released_list = maven_public_utils.populate_site([ListGenerator(sci_files[2:])], second_site, source_root,
+                                                         previous_site_dir=first_site)
+
+        with open(released_list) as f:
+            self.assertEqual(sci_files[2:], f.read().split())
+        self.assertEqual(set(sci_files[2:]), set(maven_public_utils.read_release_manifest(second_site, source_root, True)))
+        for source_file in sci_files:
+            first_target = maven_public_utils.get_site_target_file(source_file, source_root, first_site)
+            second_target = maven_public_utils.get_site_target_file(source_file, source_root, second_site)
+            if source_file in sci_files[:2]:
+                # withdrawn
+                self.assertFalse(os.path.lexists(second_target))
+                continue
+            self.assertTrue(os.path.islink(second_target))
+            self.assertEqual(source_file, os.readlink(second_target))
+            if source_file in sci_files[:8]:
+                # released by both sites, the entry is shared with the prior site
+                self.assertTrue(os.path.samestat(os.lstat(first_target), os.lstat(second_target)))
+            else:
+                self.assertFalse(os.path.lexists(first_target))
+
+        # a prior site built with copies is not reused for a symbolic link site
+        self.assertIsNone(maven_public_utils.read_release_manifest(second_site, source_root, False))
+
+    def testIncrementalSiteCopies(self):
+        '''A copied file is only cloned from the prior site if its source file is unchanged'''
+        source_root = os.path.join(self.test_root, 'data')
+        sci_dir = os.path.join(source_root, maven_public_utils.SCI_DIR, 'test')
+        sci_files = [os.path.join(sci_dir, name) for name in self.test_files[:2]]
+        file_system.build_test_files_and_structure(default_file_contents='something to fill the file',
+                                                   files_base_dir=sci_dir,
+                                                   files_list=self.test_files[:2])
+
+        class ListGenerator():
+            def generate(self):
+                return iter(sci_files)
+
+        first_site = os.path.join(self.test_root, 'sites', 'site-1')
+        second_site = os.path.join(self.test_root, 'sites', 'site-2')
+        os.remove(maven_public_utils.populate_site([ListGenerator()], first_site, source_root, sym_link=False))
+        # rewrite the first source file in place under the same name
+        with open(sci_files[0], 'w') as f:
+            f.write('something new')
+        os.utime(sci_files[0], ns=(0, os.stat(sci_files[0]).st_mtime_ns + 1000000000))
+        os.remove(maven_public_utils.populate_site([ListGenerator()], second_site, source_root, sym_link=False,
+                                                   previous_site_dir=first_site))
+
+        changed, unchanged = [[maven_public_utils.get_site_target_file(f, source_root, site) for site in (first_site, second_site)]
+                              for f in sci_files]
+        with open(changed[1]) as f:
+            self.assertEqual('something new', f.read())
+        self.assertFalse(os.path.samestat(os.stat(changed[0]), os.stat(changed[1])))
+        self.assertTrue(os.path.samestat(os.stat(unchanged[0]), os.stat(unchanged[1])))
+        self.assertEqual(maven_public_utils.get_release_signature(sci_files[0]),
+                         maven_public_utils.read_release_manifest(second_site, source_root, False)[sci_files[0]])
@@ -0,0 +1,147 @@
+'''
+Unit tests for the PDS page crawler, run against a local HTTP server
+'''
+import os
+import sys
+import shutil
+import threading
+import subprocess
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from maven_utilities import constants
+os.environ[constants.python_env] = 'testing'
+
+from maven_public import utilities as maven_public_utils, pds_crawler
+from tests.maven_test_utilities import file_system, db_utils
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PdsStandIn(BaseHTTPRequestHandler):
+    '''Serves server.pages ({path: body}) with an ETag and honours If-None-Match'''
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hash(body))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPdsCrawler(unittest.TestCase):
+
+    def setUp(self):
+        self.test_root = file_system.get_temp_root_dir()
+        self.cache_dir = os.path.join(self.test_root, 'cache')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PdsStandIn)
+        self.server.pages = {}
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def tearDown(self):
+        self.stop_server()
+        db_utils.delete_data()
+        shutil.rmtree(self.test_root)
+        self.assertFalse(os.path.isdir(self.test_root))
+
+    def testLazyImports(self):
+        '''Importing the site builders doesn't load the database or http dependencies'''
+        modules = subprocess.check_output([sys.executable, '-c',
+                                           'import sys, maven_public.utilities; print(" ".join(sys.modules))'],
+                                          cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))).decode().split()
+        for module in ['urllib.request', 'sqlalchemy', 'maven_database', 'make_pds_bundles']:
+            self.assertNotIn(module, modules)
+
+    def testConditionalRevalidation(self):
+        '''Cached pages are revalidated and only changed pages are downloaded again'''
+        self.server.pages = {'/a': b'page a', '/b': b'page b'}
+        crawler = pds_crawler.PdsCrawler(cache_dir=self.cache_dir, workers=2, timeout=5)
+        urls = [self.base_url + 'a', self.base_url + 'b', self.base_url + 'missing']
+        self.assertEqual(['page a', 'page b', None], crawler.fetch_all(urls))
+        self.assertTrue(all(etag is None for _, etag in self.server.requests))
+
+        self.server.pages['/b'] = b'page b changed'
+        crawler = pds_crawler.PdsCrawler(cache_dir=self.cache_dir, workers=2, timeout=5)
+        self.assertEqual(['page a', 'page b changed', None], crawler.fetch_all(urls))
+        self.assertEqual(1, crawler.not_modified)
+        self.assertEqual('page b changed', pds_crawler.PdsCrawler(cache_dir=self.cache_dir).fetch(urls[1]))
+
+    def testUnreachableUsesCache(self):
+        '''The cached copy of a page is used when the server can't be reached'''
+        url = self.base_url + 'a'
+        self.server.pages = {'/a': b'page a'}
+        pds_crawler.PdsCrawler(cache_dir=self.cache_dir, timeout=5).fetch(url)
+        self.stop_server()
+        crawler = pds_crawler.PdsCrawler(cache_dir=self.cache_dir, timeout=1, retries=1)
+        self.assertEqual('page a', crawler.fetch(url))
+        self.assertEqual(2, crawler.requests)
+        self.assertIsNone(pds_crawler.PdsCrawler(timeout=1, retries=0).fetch(url))
+
+    def testWalkThroughPds(self):
+        '''Every month of the release window is crawled and the science files are found'''
+        month_urls = maven_public_utils.pds_month_urls(self.base_url + 'product')
+        start, end = maven_public_utils.public_release_window()
+        self.assertEqual((end.year - start.year) * 12 + end.month - start.month + 1, len(month_urls))
+        self.assertEqual(self.base_url + 'product/2013/12', month_urls[0])
+
+        self.server.pages = {'/product/2013/12': b'<a>mvn_tst_l2_data_20131201_v01_r01.cdf</a> mvn_tst_l2_data_20131201_v01_r01.xml',
+                             '/product/2014/02': b'<a>mvn_tst_l2_data_20140201_v02_r00.cdf</a>'}
+        crawler = pds_crawler.PdsCrawler(cache_dir=self.cache_dir, workers=4, timeout=5)
+        self.assertEqual(['mvn_tst_l2_data_20131201_v01_r01', 'mvn_tst_l2_data_20140201_v02_r00'],
+                         maven_public_utils.walk_through_pds(self.base_url + 'product', crawler=crawler))
+        self.assertEqual(len(month_urls), len(self.server.requests))
+
+        pds_query = maven_public_utils.PdsQueryMetadata(self.base_url, ['product', 'empty'], crawler=crawler)
+        released = pds_query.crawl()
+        self.assertEqual(2, len(released['product']))
+        self.assertEqual([], released['empty'])
+
+    def testPdsReleaseMatching(self):
+        '''The released files and their labels are matched against the science file metadata'''
+        for file_name, instrument, level, version, revision in [('mvn_tst_l2_data_20131201_v01_r01.cdf', 'tst', 'l2', 1, 1),
+                                                                ('mvn_tst_l2_data_20131201_v01_r01.xml', 'tst', 'l2', 1, 1),
+                                                                ('mvn_tst_l2_data_20131201_v01_r02.cdf', 'tst', 'l2', 1, 2),
+                                                                ('mvn_tst_l2_data_20131202_v01_r01.cdf', 'tst', 'l2', 1, 1),
+                                                                ('mvn_iuv_l1b_disk_20131201_v02_r01.fits.gz', 'iuv', 'l1b', 2, 1),
+                                                                ('mvn_iuv_l1b_disk_20131201_v01_r00.xml', 'iuv', 'l1b', 1, 0),
+                                                                ('mvn_iuv_l1b_disk_20131201_v01_r01.xml', 'iuv', 'l1b', 1, 1)]:
+            root, extension = file_name.split('_v')[0], file_name.split('.', 1)[1]
+            db_utils.insert_science_files_metadata(file_name=file_name, file_root='{}.{}'.format(root, extension), dir_path='/data',
+                                                   instrument=instrument, level=level, version=version, revision=revision,
+                                                   extension=extension.split('.')[0])
+        self.server.pages = {'/product/2013/12': b'mvn_tst_l2_data_20131201_v01_r01.cdf mvn_tst_l2_data_20131201_v01_r01.xml '
+                                                 b'mvn_iuv_l1b_disk_20131201_v02_r01.fits.gz'}
+        pds_query = maven_public_utils.PdsQueryMetadata(self.base_url, ['product'],
+                                                        crawler=pds_crawler.PdsCrawler(workers=4, timeout=5))
+        self.assertEqual(['/data/mvn_iuv_l1b_disk_20131201_v01_r00.xml',
+                          '/data/mvn_iuv_l1b_disk_20131201_v02_r01.fits.gz',
+                          '/data/mvn_tst_l2_data_20131201_v01_r01.cdf',
+                          '/data/mvn_tst_l2_data_20131201_v01_r01.xml'],
+                         sorted(pds_query.generate()))
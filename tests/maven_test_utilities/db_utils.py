@@ -15,7 +15,7 @@ from maven_orbit import orbit_db_session
 from maven_database.models import MavenEventType, MavenEvent, MavenEventTag, ScienceFilesMetadata, \
     MavenStatus
 from maven_database.models import AncillaryFilesMetadata, InSituKpQueryParameter, KpFilesMetadata, InSituKeyParametersData
-from maven_database.models import MavenLog, MavenDropboxMgrMove, PdsArchiveRecord, MavenOrbit
+from maven_database.models import MavenLog, MavenDropboxMgrMove, PdsArchiveRecord, MavenOrbit, FileChecksum
 from maven_ops_database.models import OpsMissionEvent, OpsMissionEventOrbitNumber, OpsMissionEventType
 from maven_ops_database.database import db_session as ops_db_session
 
@@ -374,7 +374,7 @@ def delete_data(*to_delete):
     '''
     master_order = [MavenOrbit, InSituKeyParametersData, InSituKpQueryParameter, KpFilesMetadata, ScienceFilesMetadata,
                     MavenEventTag, MavenEvent, MavenEventType, AncillaryFilesMetadata,
-                    MavenDropboxMgrMove, MavenLog, PdsArchiveRecord, MavenStatus]
+                    MavenDropboxMgrMove, MavenLog, PdsArchiveRecord, MavenStatus, FileChecksum]
 
     ordered_to_delete = sorted(to_delete, key=master_order.index)
 
@@ -9,10 +9,12 @@ import unittest
 import os
 import time
 import tarfile
+import hashlib
+from io import BytesIO
 from shutil import rmtree
 from maven_utilities import constants
 os.environ[constants.python_env] = 'testing'
-from maven_utilities.utilities import listdir_files, file_is_old_enough, get_file_root_plus_extension, is_compressed_format, get_absolute_version, files_are_same
+from maven_utilities.utilities import listdir_files, file_is_old_enough, get_file_root_plus_extension, is_compressed_format, get_absolute_version, files_are_same, HashingReader
 from tests.maven_test_utilities.file_system import get_temp_root_dir
 
 
@@ -120,3 +122,12 @@ class MavenUtilitiesUnitTests(unittest.TestCase):
         with open(src_path, 'a') as f:
             f.write('a little bit more')
         self.assertFalse(files_are_same(src_path, dest_path))
+
+    def testHashingReader(self):
+        '''utilities.HashingReader should hash exactly the bytes read through it'''
+        contents = b'some test content ' * 1000
+        reader = HashingReader(BytesIO(contents))
+        while reader.read(100):
+            pass
+        self.assertEqual(len(contents), reader.bytes_read)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), reader.hexdigest())